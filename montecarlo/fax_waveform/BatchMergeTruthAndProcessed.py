@@ -12,9 +12,17 @@ import math as math
 import glob
 from subprocess import Popen, PIPE
 
+from slurm_submit import render_submit_script, write_file, make_dir, remove_path, partition_name, submit_array, array_task_ids, submit_after, PAX_ENV
+from production_state import ProductionState, active_job_ids, recorded_commands, record_command
+from queue_throttler import QueueThrottler
+from task_farm import submit_farm
+from stage_worker import python_stage, worker_session
+from manifest import read_manifest, lookup
+from runtime_history import time_limit, timed_commands, params_key
+
 if len(sys.argv)<=1:
     print("======== Usage =========")
-    print("python BatchMergeTruthAndProcessed.py <config file> <truth csv path> <processed root path> <output path> <(opt)relative path for submission> <(opt) if use public node (1) optional (2 for use kicp nodes)> <(opt)Submit ID> <(opt) if use arrays in output (1) (default 0)> <(opt) minitree type; 0(default): Basics, 1: S1S2Properties, 2: PeakEfficiency> <(opt) save afterpulses in arrays (default 0)>")
+    print("python BatchMergeTruthAndProcessed.py <config file> <truth csv path> <processed root path> <output path> <(opt)relative path for submission> <(opt) if use public node (1) optional (2 for use kicp nodes)> <(opt)Submit ID> <(opt) if use arrays in output (1) (default 0)> <(opt) minitree type; 0(default): Basics, 1: S1S2Properties, 2: PeakEfficiency> <(opt) save afterpulses in arrays (default 0)> <(opt) submit one job array (1, default), one job per file (0) or a task farm of a few allocations (2)> <(opt) production state db, to skip the files already merged; none (default) to skip> <(opt) production manifest to pair the truth and processed files from (and record the merged ones); none (default) to scan the paths>")
     exit()
 
 CurrentEXE = sys.argv[0]
@@ -37,8 +45,18 @@ if len(sys.argv)>8:
 MinitreeType=0
 if len(sys.argv)>9:
     MinitreeType = int(sys.argv[9])
+save_ap = '0'
 if len(sys.argv)>10:
     save_ap = sys.argv[10]
+IfJobArray = 1
+if len(sys.argv)>11:
+    IfJobArray = int(sys.argv[11])
+StateFile = "none"
+if len(sys.argv)>12 and sys.argv[12]!='none':
+    StateFile = os.path.abspath(sys.argv[12])
+ManifestFile = "none"
+if len(sys.argv)>13 and sys.argv[13]!='none':
+    ManifestFile = os.path.abspath(sys.argv[13])
 
 
 #######################
@@ -47,8 +65,19 @@ if len(sys.argv)>10:
 MaxNumJob = 64
 if not IfPublicNode:
     MaxNumJob=200
+# task farm: workers per allocation and tasks for each worker to run in one allocation
+FarmWorkers = 16
+FarmTasksPerWorker = 30
 CurrentPath = os.getcwd()
 CurrentUser = getpass.getuser()
+# time limit from the recorded runtimes of the merge jobs with the same parameters
+MergeParams = params_key(IfPublicNode, MinitreeType, ArrayOutput)
+TimeLimit = time_limit("merge", MergeParams, "00:05:00")
+# with a state db, files already merged or still in the queue are skipped
+State = None
+if StateFile!="none":
+    State = ProductionState(StateFile)
+    ActiveJobs = active_job_ids(CurrentUser)
 EXE_Path = CurrentEXE.split("BatchMergeTruthAndProcessed.py")[0]
 if ArrayOutput==1:
     EXE1 = CurrentPath+"/"+EXE_Path+"TruthSorting_arrays.py"
@@ -63,92 +92,146 @@ else:
 #######################
 ## Get the list 
 #######################
-FileList = glob.glob(TruthCSVPath+"/*.csv")
-# trail to IDList
-IDList = []
-for filename in FileList:
-    ID = filename.split("FakeWaveform_XENON1T_")[1].split("_truth.csv")[0]
-    IDList.append(ID)
-
-# create temporary directory
+# with a manifest, truth and processed files are paired by subrun from its index
+if ManifestFile!="none":
+    Index = read_manifest(ManifestFile)
+    TruthFiles = lookup(Index, "truth_csv")
+    ProcessedFiles = lookup(Index, "basics" if MinitreeType==0 else "reduced")
+    IDList = sorted(TruthFiles)
+else:
+    FileList = glob.glob(TruthCSVPath+"/*.csv")
+    # trail to IDList
+    IDList = []
+    for filename in FileList:
+        ID = filename.split("FakeWaveform_XENON1T_")[1].split("_truth.csv")[0]
+        IDList.append(ID)
+
+# create temporary directory (removed once all the merge jobs are over)
 TmpPath = OutputPath+"/TmpFolder_"+str(SubmitID)
-if os.path.exists(TmpPath):
-    subp.call("rm -r "+TmpPath, shell=True)
-subp.call("mkdir "+TmpPath, shell=True)
+make_dir(TmpPath, clean=True)
+
+def remove_tmp_path_after(JobIDs, SubmitDir):
+    # the jobs of the array or farm are still to run: a last job removes the temporary path
+    JobIDs = [JobID for JobID in JobIDs if JobID is not None]
+    if not JobIDs:
+        remove_path(TmpPath)
+    elif submit_after("merge_"+str(SubmitID)+"_cleanup", ["rm -rf "+TmpPath], SubmitDir, JobIDs, IfPublicNode) is None:
+        print("Could not submit the removal of "+TmpPath)
+
+def task_commands(TruthCSVFilename, TmpOutputFilename, ProcessedRootFilename, OutputFilename):
+    if ArrayOutput:
+        Commands = [python_stage(EXE1, TruthCSVFilename+" "+TmpOutputFilename+" 0 "+save_ap)]
+    else:
+        Commands = [python_stage(EXE1, TruthCSVFilename+" "+TmpOutputFilename)]
+    Commands.append(python_stage(EXE2, AbsoluteConfigFile+" "+TmpOutputFilename+" "+ProcessedRootFilename+" "+OutputFilename))
+    return Commands
+
+def unit_commands(ID_job, TruthCSVFilename, TmpOutputFilename, ProcessedRootFilename, OutputFilename, RemoveTmp):
+    Commands = task_commands(TruthCSVFilename, TmpOutputFilename, ProcessedRootFilename, OutputFilename)
+    if RemoveTmp:
+        Commands.append("rm -f "+TmpOutputFilename)
+    if ManifestFile!="none":
+        Commands.append("python "+CurrentPath+"/"+EXE_Path+"manifest.py add "+ManifestFile+" "+ID_job+" merge merged="+OutputFilename)
+    return Commands
+
+def job_commands(ID_job, TruthCSVFilename, TmpOutputFilename, ProcessedRootFilename, OutputFilename, RemoveTmp):
+    # truth sorting and merging share the imports of one warm worker
+    Commands = worker_session() + unit_commands(ID_job, TruthCSVFilename, TmpOutputFilename, ProcessedRootFilename,
+                                                OutputFilename, RemoveTmp)
+    if State is None:
+        return timed_commands(Commands, "merge", MergeParams) + ["exit $EXIT_CODE"]
+    return recorded_commands(Commands, StateFile, "merge", ID_job, [OutputFilename], MergeParams)
+
+def record_jobs(IDs, JobIDs):
+    if State is None:
+        return
+    for (ID_job, JobID) in zip(IDs, JobIDs):
+        if JobID is not None:
+            State.submitted("merge", ID_job, JobID)
 
 ######################
 ## Submission
 ######################
+AbsoluteConfigFile = CurrentPath+"/"+ConfigFile
+ArrayTaskArgs = []
+Submissions = []
+SubmittedIDs = []
 for j, ID_job in enumerate(IDList):
+    if State is not None and not State.to_submit("merge", [ID_job], ActiveJobs):
+        print("Done or running -> "+ID_job)
+        continue
     # create submit directory
     SubmitPath = CurrentPath + "/" +RelativeSubmitPath + "/" + str(j) + "_" + str(SubmitID)
     if RelativeSubmitPath[0]=='/':
         SubmitPath = RelativeSubmitPath + "/" + str(j) + "_" + str(SubmitID)
-    if os.path.exists(SubmitPath):
-        subp.call("rm -r "+SubmitPath, shell=True)
-    subp.call("mkdir "+SubmitPath, shell=True)
+    make_dir(SubmitPath, clean=True)
     # create submit file
     SubmitFile = SubmitPath + "/submit"
-    if os.path.exists(SubmitFile):
-        subp.call("rm "+SubmitFile, shell=True)
     # start to fill the submitted job
-    OneProcessedFile = glob.glob(ProcessedRootPath+"/FakeWaveform_XENON1T_"+ID_job+"*.root")
-    if len(OneProcessedFile)==0:
-        continue
-    ProcessedRootFilename = OneProcessedFile[0]
-    TruthCSVFilename = TruthCSVPath+"/FakeWaveform_XENON1T_"+ID_job+"_truth.csv"
+    if ManifestFile!="none":
+        if ID_job not in ProcessedFiles:
+            continue
+        ProcessedRootFilename = ProcessedFiles[ID_job]
+        TruthCSVFilename = TruthFiles[ID_job]
+    else:
+        OneProcessedFile = glob.glob(ProcessedRootPath+"/FakeWaveform_XENON1T_"+ID_job+"*.root")
+        if len(OneProcessedFile)==0:
+            continue
+        ProcessedRootFilename = OneProcessedFile[0]
+        TruthCSVFilename = TruthCSVPath+"/FakeWaveform_XENON1T_"+ID_job+"_truth.csv"
     TmpOutputFilename = TmpPath+"/FakeWaveform_XENON1T_"+ID_job+"_tmp.pkl"
     OutputFilename = OutputPath+"/FakeWaveform_XENON1T_"+ID_job+"_merged.pkl"
-    AbsoluteConfigFile = CurrentPath+"/"+ConfigFile
     if len(ProcessedRootFilename)<2 or len(TruthCSVFilename)<2:
         continue
     print("To process -> "+ID_job)
-    # create the submit 
-    subp.call("echo '#!/bin/bash\n' >> "+SubmitFile, shell=True)
-    subp.call("echo '#SBATCH --output="+SubmitPath+"/myout_"+str(SubmitID)+"_"+str(j)+".txt \n' >> "+SubmitFile, shell=True)
-    subp.call("echo '#SBATCH --error="+SubmitPath+"/myerr_"+str(SubmitID)+"_"+str(j)+".txt\n' >> "+SubmitFile, shell=True)
-    subp.call("echo '#SBATCH --time=00:05:00\n' >> "+SubmitFile, shell=True)
-    if not IfPublicNode:
-        subp.call("echo '#SBATCH --account=pi-lgrandi\n' >> "+SubmitFile, shell=True)
-        subp.call("echo '#SBATCH --qos=xenon1t\n' >> "+SubmitFile, shell=True)
-        subp.call("echo '#SBATCH --partition=xenon1t\n' >> "+SubmitFile, shell=True)
-    elif IfPublicNode==2:
-        subp.call("echo '#SBATCH --account=pi-lgrandi\n' >> "+SubmitFile, shell=True)
-        subp.call("echo '#SBATCH --qos=xenon1t-kicp\n' >> "+SubmitFile, shell=True)
-        subp.call("echo '#SBATCH --partition=kicp\n' >> "+SubmitFile, shell=True)
-    subp.call("echo '. /home/mcfate/Env/GlobalPAXEnv.sh\n\n' >> "+SubmitFile, shell=True)
     if ArrayOutput:
         print('running ' + TruthCSVFilename)
-        subp.call("echo 'python "+EXE1+" "+TruthCSVFilename+" "+TmpOutputFilename+" 0 "+save_ap+"' >> "+SubmitFile, shell=True)
-    else:
-        subp.call("echo 'python "+EXE1+" "+TruthCSVFilename+" "+TmpOutputFilename+"' >> "+SubmitFile, shell=True)
-    subp.call("echo 'python "+EXE2+" "+AbsoluteConfigFile+" "+TmpOutputFilename+" "+ProcessedRootFilename+" "+OutputFilename+"' >> "+SubmitFile, shell=True)
+    if IfJobArray:
+        ArrayTaskArgs.append([TruthCSVFilename, TmpOutputFilename, ProcessedRootFilename, OutputFilename, SubmitPath, j, ID_job])
+        continue
+    # create the submit 
+    Commands = job_commands(ID_job, TruthCSVFilename, TmpOutputFilename, ProcessedRootFilename, OutputFilename, False)
+    write_file(SubmitFile, render_submit_script(Commands,
+                                                SubmitPath+"/myout_"+str(SubmitID)+"_"+str(j)+".txt",
+                                                SubmitPath+"/myerr_"+str(SubmitID)+"_"+str(j)+".txt",
+                                                TimeLimit, IfPublicNode, setup=PAX_ENV))
     
-    #submit
-    IfSubmitted=0
-    while IfSubmitted==0:
-        Partition = "sandyb" # public
-        if not IfPublicNode:
-            Partition = "xenon1t"
-        elif IfPublicNode==2:
-            Partition = "kicp"
-        p1 = Popen(["squeue","--partition="+Partition, "--user="+CurrentUser], stdout=PIPE)
-        p2 = Popen(["wc", "-l"], stdin=p1.stdout, stdout=PIPE)
-        p1.stdout.close()  # Allow p1 to receive a SIGPIPE if p2 exits.
-        output = p2.communicate()[0]
-        Status=subp.call("squeue --partition="+Partition+" --user=mcfate | wc -l", shell=True)
-        Output=int(output)
-        #print(Status)
-        print("Current job running number "+str(Output))            
-        if Status==0 and Output<MaxNumJob:
-            #sbatch it 
-            subp.call("cd "+SubmitPath+";sbatch "+SubmitFile+";cd -", shell=True)
-            IfSubmitted=1   
-            subp.call("rm "+SubmitFile, shell=True) 
-            time.sleep(1)
-        else:
-            time.sleep(30) 
-
-
-# delete the temporary path
-subp.call("rm -rf "+TmpPath, shell=True)
+    Submissions.append((SubmitFile, SubmitPath))
+    SubmittedIDs.append(ID_job)
+
+
+if IfJobArray==2:
+    # a few allocations drain all the merge tasks, each task removes its own temporary file
+    if ArrayTaskArgs:
+        Tasks = [" && ".join(unit_commands(args[6], *(args[:4] + [True]))) for args in ArrayTaskArgs]
+        if State is not None:
+            Tasks = ["( "+Task+" ); "+record_command(StateFile, "merge", args[6], [args[3]])
+                     for (Task, args) in zip(Tasks, ArrayTaskArgs)]
+        NumAllocations = int(math.ceil(len(Tasks)/float(FarmWorkers*FarmTasksPerWorker)))
+        FarmIDs = submit_farm("merge_"+str(SubmitID), Tasks, os.path.dirname(ArrayTaskArgs[0][4]),
+                              min(NumAllocations, MaxNumJob), FarmWorkers, "01:59:00", IfPublicNode, setup=PAX_ENV,
+                              warm_worker=True)
+        # any allocation of the farm may run a task
+        FarmIDs = [JobID for JobID in FarmIDs if JobID is not None]
+        if FarmIDs:
+            record_jobs([args[6] for args in ArrayTaskArgs], [":".join(FarmIDs)]*len(ArrayTaskArgs))
+        remove_tmp_path_after(FarmIDs, os.path.dirname(ArrayTaskArgs[0][4]))
+    else:
+        remove_path(TmpPath)
+elif IfJobArray:
+    # the tasks are still to run: each one removes its own temporary file
+    if ArrayTaskArgs:
+        ArrayIDs = submit_array("merge_"+str(SubmitID), job_commands("$7", "$1", "$2", "$3", "$4", True), ArrayTaskArgs,
+                                os.path.dirname(ArrayTaskArgs[0][4]), MaxNumJob, TimeLimit, IfPublicNode,
+                                log="$5/myout_"+str(SubmitID)+"_$6.txt", setup=PAX_ENV)
+        record_jobs([args[6] for args in ArrayTaskArgs], array_task_ids(ArrayIDs, len(ArrayTaskArgs)))
+        remove_tmp_path_after(ArrayIDs, os.path.dirname(ArrayTaskArgs[0][4]))
+    else:
+        remove_path(TmpPath)
+else:
+    # jobs are released by the throttler as slots free up in the partition
+    record_jobs(SubmittedIDs, QueueThrottler(partition_name(IfPublicNode), CurrentUser, MaxNumJob).submit_all(Submissions))
+    for (SubmitFile, SubmitPath) in Submissions:
+        remove_path(SubmitFile)
+    # delete the temporary path
+    remove_path(TmpPath)
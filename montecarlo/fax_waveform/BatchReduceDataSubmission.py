@@ -11,15 +11,21 @@ import math as math
 from subprocess import Popen, PIPE
 import glob
 
+from slurm_submit import render_submit_script, write_file, make_dir, remove_path, partition_name, submit_array, array_task_ids, PAX_ENV
+from queue_throttler import QueueThrottler
+from production_state import ProductionState, active_job_ids, recorded_commands
+from runtime_history import time_limit, timed_commands, params_key
+
 if len(sys.argv)<=1:
     print("======== Usage =========")
-    print("python BatchReduceDataSubmission.py <filelist> <data path> <output path> <absolute path for submission> <if use public node (1) optional (2 for use kicp nodes)> <Submit ID> <(opt) minitree type; 1: S1S2Properties, 2: PeakEfficiency>")
+    print("python BatchReduceDataSubmission.py <filelist> <data path> <output path> <absolute path for submission> <if use public node (1) optional (2 for use kicp nodes)> <Submit ID> <(opt) minitree type; 1: S1S2Properties, 2: PeakEfficiency> <(opt) submit one job array (1, default) or one job per file (0)> <(opt) production state db, to skip the files already reduced; none (default) to skip> <(opt) production manifest to record the reduced files in; none (default) to skip>")
     print("======== List file format: ==========")
     print("ex.:")
     print("FakeWaveform_XENON1T_000000_pax")
     print("FakeWaveform_XENON1T_000001_pax")
     print("FakeWaveform_XENON1T_000002_pax")
     print(".....")
+    print("(can be made from a production manifest: python manifest.py list <manifest> pax --names)")
     exit()
 
 EXE_Path = sys.argv[0].split("BatchReduceDataSubmission.py")[0]
@@ -38,6 +44,15 @@ if len(sys.argv)>6:
 minitree_type = '1'
 if len(sys.argv)>7:
     minitree_type = sys.argv[7]
+IfJobArray = 1
+if len(sys.argv)>8:
+    IfJobArray = int(sys.argv[8])
+StateFile = "none"
+if len(sys.argv)>9 and sys.argv[9]!='none':
+    StateFile = os.path.abspath(sys.argv[9])
+ManifestFile = "none"
+if len(sys.argv)>10 and sys.argv[10]!='none':
+    ManifestFile = os.path.abspath(sys.argv[10])
 
 
 ##########################
@@ -52,6 +67,15 @@ elif minitree_type == '2':
 MaxNumJob = 64
 if not IfPublicNode:
     MaxNumJob = 200
+OutputSuffix = {'1': "_S1S2Properties.root", '2': "_PeakEfficiency.root"}[minitree_type]
+# time limit from the recorded runtimes of the reduce jobs with the same parameters
+ReduceParams = params_key(IfPublicNode, minitree_type)
+TimeLimit = time_limit("reduce", ReduceParams, "04:59:00")
+# with a state db, files already reduced or still in the queue are skipped
+State = None
+if StateFile!="none":
+    State = ProductionState(StateFile)
+    ActiveJobs = active_job_ids(CurrentUser)
 
 ##########################
 ## Open/load list file
@@ -60,67 +84,71 @@ fin = open(ListFile)
 lines = fin.readlines()
 fin.close()
 
+def task_commands(filename, SubmitPath):
+    Commands = ["python "+EXE+" "+filename+" "+DataPath]
+    if minitree_type=='1':
+        Commands.append("mv "+SubmitPath+"/"+filename+"_S1S2Properties.root  "+OutputPath)
+    elif minitree_type=='2':
+        Commands.append("mv "+SubmitPath+"/"+filename+"_PeakEfficiency.root  "+OutputPath)
+    if ManifestFile!="none":
+        # subrun "-": taken from the file name by manifest.py
+        Commands.append("python "+CurrentPath+"/"+EXE_Path+"/manifest.py add "+ManifestFile+" - reduce reduced="+OutputPath+"/"+filename+OutputSuffix)
+    return Commands
+
+def job_commands(filename, SubmitPath):
+    if State is None:
+        return timed_commands(task_commands(filename, SubmitPath), "reduce", ReduceParams) + ["exit $EXIT_CODE"]
+    return recorded_commands(task_commands(filename, SubmitPath), StateFile, "reduce", filename,
+                             [OutputPath+"/"+filename+OutputSuffix], ReduceParams)
+
+def record_jobs(Filenames, JobIDs):
+    if State is None:
+        return
+    for (filename, JobID) in zip(Filenames, JobIDs):
+        if JobID is not None:
+            State.submitted("reduce", filename, JobID)
+
 ##########################
 ## Job submission
 ##########################
 
+ArrayTaskArgs = []
+Submissions = []
+SubmittedFiles = []
 for j, line in enumerate(lines):
+    filename = line[:-1]
+    if len(filename)<2:
+        continue
+    if State is not None and not State.to_submit("reduce", [filename], ActiveJobs):
+        print("Done or running -> "+filename)
+        continue
     # create submit directory
     SubmitPath = AbsoluteSubmitPath + "/" + str(j) + "_" + str(SubmitID)
-    if os.path.exists(SubmitPath):
-        subp.call("rm -r "+SubmitPath, shell=True)
-    subp.call("mkdir "+SubmitPath, shell=True)
+    make_dir(SubmitPath, clean=True)
     # create submit file
     SubmitFile = SubmitPath + "/submit"
-    if os.path.exists(SubmitFile):
-        subp.call("rm "+SubmitFile, shell=True)
     # start to fill in submit 
-    filename = line[:-1]
-    if len(filename)<2:
-        continue
     print("To process -> "+filename)
+    if IfJobArray:
+        ArrayTaskArgs.append([filename, SubmitPath, j])
+        continue
     # create the submit 
-    subp.call("echo '#!/bin/bash\n' >> "+SubmitFile, shell=True)
-    subp.call("echo '#SBATCH --output="+SubmitPath+"/myout_"+str(SubmitID)+"_"+str(j)+".txt \n' >> "+SubmitFile, shell=True)
-    subp.call("echo '#SBATCH --error="+SubmitPath+"/myerr_"+str(SubmitID)+"_"+str(j)+".txt\n' >> "+SubmitFile, shell=True)
-    subp.call("echo '#SBATCH --time=04:59:00\n' >> "+SubmitFile, shell=True)
-    if not IfPublicNode:
-        subp.call("echo '#SBATCH --account=pi-lgrandi\n' >> "+SubmitFile, shell=True)
-        subp.call("echo '#SBATCH --qos=xenon1t\n' >> "+SubmitFile, shell=True)
-        subp.call("echo '#SBATCH --partition=xenon1t\n' >> "+SubmitFile, shell=True)
-    elif IfPublicNode==2:
-        subp.call("echo '#SBATCH --account=pi-lgrandi\n' >> "+SubmitFile, shell=True)
-        subp.call("echo '#SBATCH --qos=xenon1t-kicp\n' >> "+SubmitFile, shell=True)
-        subp.call("echo '#SBATCH --partition=kicp\n' >> "+SubmitFile, shell=True)
-    subp.call("echo '. /home/mcfate/Env/GlobalPAXEnv.sh\n\n' >> "+SubmitFile, shell=True)
-    subp.call("echo 'python "+EXE+" "+filename+" "+DataPath+"' >> "+SubmitFile, shell=True)
-    if minitree_type=='1':
-        subp.call("echo 'mv "+SubmitPath+"/"+filename+"_S1S2Properties.root  "+OutputPath+"' >> "+SubmitFile, shell=True)
-    elif minitree_type=='2':
-        subp.call("echo 'mv "+SubmitPath+"/"+filename+"_PeakEfficiency.root  "+OutputPath+"' >> "+SubmitFile, shell=True)
+    write_file(SubmitFile, render_submit_script(job_commands(filename, SubmitPath),
+                                                SubmitPath+"/myout_"+str(SubmitID)+"_"+str(j)+".txt",
+                                                SubmitPath+"/myerr_"+str(SubmitID)+"_"+str(j)+".txt",
+                                                TimeLimit, IfPublicNode, setup=PAX_ENV))
     
-    #submit
-    IfSubmitted=0
-    while IfSubmitted==0:
-        Partition = "sandyb" # public
-        if not IfPublicNode:
-            Partition = "xenon1t"
-        elif IfPublicNode==2:
-            Partition = "kicp"
-        p1 = Popen(["squeue","--partition="+Partition,"--user="+CurrentUser], stdout=PIPE)
-        p2 = Popen(["wc", "-l"], stdin=p1.stdout, stdout=PIPE)
-        p1.stdout.close()  # Allow p1 to receive a SIGPIPE if p2 exits.
-        output = p2.communicate()[0]
-        Status=subp.call("squeue --partition="+Partition+" --user="+CurrentUser+" | wc -l", shell=True)
-        Output=int(output)
-        #print(Status)
-        print("Current job running number "+str(Output))            
-        if Status==0 and Output<MaxNumJob:
-            #sbatch it 
-            subp.call("cd "+SubmitPath+";sbatch "+SubmitFile+";cd -", shell=True)
-            IfSubmitted=1   
-            subp.call("rm "+SubmitFile, shell=True) 
-            time.sleep(1)
-        else:
-            time.sleep(30) 
+    Submissions.append((SubmitFile, SubmitPath))
+    SubmittedFiles.append(filename)
+
+# jobs are released by the throttler as slots free up in the partition
+record_jobs(SubmittedFiles, QueueThrottler(partition_name(IfPublicNode), CurrentUser, MaxNumJob).submit_all(Submissions))
+for (SubmitFile, SubmitPath) in Submissions:
+    remove_path(SubmitFile)
 
+if IfJobArray and ArrayTaskArgs:
+    # one array for all files, each task runs in its own submit directory
+    ArrayIDs = submit_array("reduce_"+str(SubmitID), ["cd $2"] + job_commands("$1", "$2"), ArrayTaskArgs,
+                            AbsoluteSubmitPath, MaxNumJob, TimeLimit, IfPublicNode,
+                            log="$2/myout_"+str(SubmitID)+"_$3.txt", setup=PAX_ENV)
+    record_jobs([args[0] for args in ArrayTaskArgs], array_task_ids(ArrayIDs, len(ArrayTaskArgs)))
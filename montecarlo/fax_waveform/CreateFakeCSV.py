@@ -4,7 +4,7 @@
 ## by Qing Lin
 ## @ 2016-09-12
 ##
-## HARDCODE WARNING: The FV dimensions below need to be modified
+## HARDCODE WARNING: The FV dimensions in fiducial_volume.py need to be modified
 ##                   according to the detector you wish to simulate
 ##
 ## Ref: http://xenon1t.github.io/pax/simulator.html#instruction-file-format
@@ -13,138 +13,129 @@
 #################################
 import sys
 import numpy as np
-import scipy as sp
-
-if len(sys.argv)<2:
-    print("========= Syntax ==========")
-    print("python CreateFakeCSV.py ..... ")
-    print("<detector: XENON100, XENON1T>")
-    print("<number of events>")
-    print("<photon number lower>")
-    print("<photon number upper>")
-    print("<electron number lower>")
-    print("<electron number upper>")
-    print("<recoil type: ER, NR>")
-    print("<output file (abs. path)>")
-    print("<If force S1-S2 correlation (0 for no; 1 for yes)>")
-    exit()
-
-Detector = sys.argv[1]
-NumEvents = int(sys.argv[2])
-PhotonNumLower = float(sys.argv[3])
-PhotonNumUpper = float(sys.argv[4])
-ElectronNumLower = float(sys.argv[5])
-ElectronNumUpper = float(sys.argv[6])
-DefaultType = sys.argv[7]
-OutputFilename = sys.argv[8]
-IfS1S2Correlation = True
-if int(sys.argv[9])==0:
-    IfS1S2Correlation = False
+
+from fiducial_volume import get_fiducial_volume
+from spectra import load_spectrum
 
 ####################################
 ## Some nuisance parameters (HARDCODE WARNING):
 ####################################
 MaxDriftTime = 650. # us
-
-
-####################################
-## Some functions (HARDCODE WARNING):
-####################################
-
-# Current FV cut for Xe1T
-scalecmtomm=1
-def radius2_cut(zpos):
-    return 1400*scalecmtomm**2+(zpos+100*scalecmtomm)*(2250-1900)*scalecmtomm/100
-
-def IfPassFV(x,y,z):
-
-    if Detector == "XENON100":
-        # check if the x,y,z passing X48kg0
-        I = np.power( (z+15.)/14.6, 4.)
-        I += np.power( (x**2+y**2)/20000., 4.)
-        if I<1:
-            return True
-    elif Detector == "XENON1T": # NEED TO UPDATE THIS
-        Zlower, Zupper = -90*scalecmtomm, -15*scalecmtomm
-        Zcut = ((z>=Zlower) & (z<=Zupper))
-        R2upper=radius2_cut(z)
-        Rcut = (x**2+y**2<R2upper)
-        if(Zcut & Rcut):
-            return True
-
-    return False
-
-
-def RandomizeFV():
-
-    # randomize the X, Y, Z according to X48kg FV
-    if Detector == "XENON100":
-        Zlower, Zupper = -14.6-15.0, -14.6+15.0
-        Rlower, Rupper = -np.sqrt(200.), np.sqrt(200.)
-
-    elif Detector == "XENON1T": # NEED TO UPDATE THIS
-        Zlower, Zupper = -90*scalecmtomm, -15*scalecmtomm
-        Rlower, Rupper = -46*scalecmtomm, 46*scalecmtomm
-
-    for i in range(100000):
-        x = np.random.uniform(Rlower,Rupper)
-        y = np.random.uniform(Rlower,Rupper)
-        z = np.random.uniform(Zlower,Zupper)
-        if IfPassFV(x,y,z):
-            return (x,y,z)
-    return (0,0,0)
-
-
-####################################
-## Starts to create
-####################################
 # Some default
 DefaultEventTime = MaxDriftTime*1000.
-##########
-fout = open(OutputFilename, 'w')
-# headers
-fout.write("instruction,recoil_type,x,y,depth,s1_photons,s2_electrons,t\n")
-if IfS1S2Correlation:
-    # events loop
-    for i in range(NumEvents):
-        fout.write(str(i)+",")
-        fout.write(DefaultType+",")
-        X, Y, Z = RandomizeFV()
-        fout.write(str(X)+",")
-        fout.write(str(Y)+",")
-        #fout.write("random,")
-        #fout.write("random,")
-        fout.write(str(-Z)+",")
-        NumPhoton = int( np.random.uniform(PhotonNumLower, PhotonNumUpper) )
-        fout.write(str(NumPhoton)+",")
-        NumElectron = int( np.random.uniform(ElectronNumLower, ElectronNumUpper) )
-        fout.write(str(NumElectron)+",")
-        fout.write(str(DefaultEventTime)+"\n")
-else:
-    # events loop S1-S2 no correlation
-    for i in range(NumEvents):
-        # first for S1
-        fout.write(str(i)+",")
-        fout.write(DefaultType+",")
-        X, Y, Z = RandomizeFV()
-        fout.write(str(X)+",")
-        fout.write(str(Y)+",")
-        fout.write(str(-Z)+",")
-        NumPhoton = int( np.random.uniform(PhotonNumLower, PhotonNumUpper) )
-        fout.write(str(NumPhoton)+",")
-        fout.write("0,")
-        fout.write(str(DefaultEventTime)+"\n")
-        # second for S2
-        fout.write(str(i)+",")
-        fout.write(DefaultType+",")
-        X, Y, Z = RandomizeFV()
-        fout.write(str(X)+",")
-        fout.write(str(Y)+",")
-        fout.write(str(-Z)+",")
-        fout.write("0,")
-        NumElectron = int( np.random.uniform(ElectronNumLower, ElectronNumUpper) )
-        fout.write(str(NumElectron)+",")
-        TimeOffset = np.random.uniform(-MaxDriftTime*1000., MaxDriftTime*1000.)
-        S2EventTime = DefaultEventTime+TimeOffset
-        fout.write(str(S2EventTime)+"\n")
-fout.close()
+
+
+def job_random_state(production_seed, subrun):
+    """Independent random stream of one job of a production
+
+    The stream is seeded with the (production seed, subrun) pair, so any subrun
+    can be regenerated on its own and no two subruns share a stream.
+
+    :param production_seed: seed of the whole production
+    :param subrun: subrun (job) number
+    :return: numpy RandomState
+    """
+    return np.random.RandomState([int(production_seed), int(subrun)])
+
+
+def create_instructions(Detector, NumEvents, PhotonNumLower, PhotonNumUpper,
+                        ElectronNumLower, ElectronNumUpper, IfS1S2Correlation,
+                        Spectrum=None, rng=None):
+    """Generate the fax instructions of NumEvents events in bulk
+
+    :param Detector: XENON100 or XENON1T, selects the fiducial volume
+    :param IfS1S2Correlation: if False, S1 and S2 are separate instructions at independent positions
+    :param Spectrum: spectra.InstructionSpectrum replacing the flat photon/electron ranges
+    :param rng: numpy RandomState (default: global numpy random state)
+    :return: dict of instruction columns (one row per instruction)
+    """
+    rng = np.random if rng is None else rng
+    if IfS1S2Correlation:
+        NumRows = NumEvents
+    else:
+        # S1 and S2 of an event are two instructions at independent positions
+        NumRows = 2*NumEvents
+    X, Y, Z = get_fiducial_volume(Detector).sample(NumRows, rng)
+    EventIDs = np.arange(NumEvents)
+    NumPhotons, NumElectrons = None, None
+    if Spectrum is not None:
+        NumPhotons, NumElectrons = Spectrum.sample(NumEvents, rng)
+    if NumPhotons is None:
+        NumPhotons = rng.uniform(PhotonNumLower, PhotonNumUpper, NumEvents)
+    if NumElectrons is None:
+        NumElectrons = rng.uniform(ElectronNumLower, ElectronNumUpper, NumEvents)
+    NumPhotons = NumPhotons.astype(int)
+    NumElectrons = NumElectrons.astype(int)
+    EventTimes = np.full(NumEvents, DefaultEventTime)
+    if not IfS1S2Correlation:
+        # rows alternate S1, S2 for each event
+        S2EventTimes = DefaultEventTime + rng.uniform(-MaxDriftTime*1000., MaxDriftTime*1000., NumEvents)
+        EventIDs = np.repeat(EventIDs, 2)
+        NumPhotons = np.column_stack((NumPhotons, np.zeros(NumEvents, dtype=int))).ravel()
+        NumElectrons = np.column_stack((np.zeros(NumEvents, dtype=int), NumElectrons)).ravel()
+        EventTimes = np.column_stack((EventTimes, S2EventTimes)).ravel()
+    return {'instruction': EventIDs, 'x': X, 'y': Y, 'depth': -Z,
+            's1_photons': NumPhotons, 's2_electrons': NumElectrons, 't': EventTimes}
+
+
+def leading_events(Instructions, NumEvents):
+    """Keep the first NumEvents events of instructions from create_instructions()"""
+    Keep = Instructions['instruction'] < NumEvents
+    return dict((key, column[Keep]) for (key, column) in Instructions.items())
+
+
+def write_instructions(OutputFilename, Instructions, DefaultType):
+    """Write instructions from create_instructions() into a fax csv file with one write"""
+    columns = [Instructions[key].tolist() for key in ['instruction', 'x', 'y', 'depth', 's1_photons', 's2_electrons', 't']]
+    fout = open(OutputFilename, 'w')
+    # headers
+    fout.write("instruction,recoil_type,x,y,depth,s1_photons,s2_electrons,t\n" + "".join(
+        "%d,%s,%r,%r,%r,%d,%d,%r\n" % (i, DefaultType, x, y, depth, nph, nel, t)
+        for (i, x, y, depth, nph, nel, t) in zip(*columns)
+    ))
+    fout.close()
+
+
+if __name__ == '__main__':
+    if len(sys.argv)<2:
+        print("========= Syntax ==========")
+        print("python CreateFakeCSV.py ..... ")
+        print("<detector: XENON100, XENON1T>")
+        print("<number of events>")
+        print("<photon number lower>")
+        print("<photon number upper>")
+        print("<electron number lower>")
+        print("<electron number upper>")
+        print("<recoil type: ER, NR>")
+        print("<output file (abs. path)>")
+        print("<If force S1-S2 correlation (0 for no; 1 for yes)>")
+        print("<(opt) spectrum file (.npz, see spectra.py), replaces the flat photon/electron ranges; none to skip>")
+        print("<(opt) production seed>")
+        print("<(opt) subrun number, selects the random stream of the job within the production>")
+        print("<(opt) number of events kept: the leading events of the <number of events> drawn (cost model productions)>")
+        exit()
+
+    Detector = sys.argv[1]
+    NumEvents = int(sys.argv[2])
+    PhotonNumLower = float(sys.argv[3])
+    PhotonNumUpper = float(sys.argv[4])
+    ElectronNumLower = float(sys.argv[5])
+    ElectronNumUpper = float(sys.argv[6])
+    DefaultType = sys.argv[7]
+    OutputFilename = sys.argv[8]
+    IfS1S2Correlation = True
+    if int(sys.argv[9])==0:
+        IfS1S2Correlation = False
+    Spectrum = None
+    if len(sys.argv)>10 and sys.argv[10]!='none':
+        Spectrum = load_spectrum(sys.argv[10])
+    rng = None
+    if len(sys.argv)>12:
+        rng = job_random_state(sys.argv[11], sys.argv[12])
+
+    Instructions = create_instructions(Detector, NumEvents, PhotonNumLower, PhotonNumUpper,
+                                       ElectronNumLower, ElectronNumUpper, IfS1S2Correlation,
+                                       Spectrum, rng)
+    if len(sys.argv)>13:
+        Instructions = leading_events(Instructions, int(sys.argv[13]))
+    write_instructions(OutputFilename, Instructions, DefaultType)
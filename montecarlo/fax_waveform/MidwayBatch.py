@@ -1,13 +1,23 @@
 ####################################
 ## batch code for WF simulation
 ####################################
-import sys, array, os, getpass
+import sys, array, os, getpass, glob
 from subprocess import call
 import subprocess as subp
 import time
 import math as math
 from subprocess import Popen, PIPE
 
+from CreateFakeCSV import create_instructions, write_instructions, job_random_state
+from spectra import load_spectrum
+from cost_model import CostModel, events_within_budget
+from slurm_submit import render_submit_script, write_file, make_dir, partition_name, submit_array, array_task_ids
+from subrun_runner import runner_groups, RUNNER_EXE
+from queue_throttler import QueueThrottler
+from production_state import ProductionState, state_path, active_job_ids, recorded_commands
+from runtime_history import time_limit, params_key
+from retry_policy import retry_plan, combine_args, RUN_FAX_CODES
+
 if len(sys.argv)<2:
     print("========= Syntax ========")
     print("python BatchSimulation.py ....")
@@ -22,6 +32,14 @@ if len(sys.argv)<2:
     print("<electron number upper>")
     print("<If enable S1-S2 correlation (0 for no, 1 for yes)>")
     print("<If use Public node (0 for no(xenon1t nodes); 1 for yes; 2 for kicp nodes)>")
+    print("<(opt) photon/electron spectrum file (.npz, see spectra.py); none to skip>")
+    print("<(opt) production seed (default/none: the seed of the restarted production, else from the current time; saved in production_seed.txt)>")
+    print("<(opt) cost model from cost_model.py (.json) to balance the predicted runtime of the jobs; none to skip>")
+    print("<(opt) submit one job array (1, default) or one job per subrun (0)>")
+    print("<(opt) maximum number of running jobs (default: 64 on public nodes, 200 otherwise)>")
+    print("<(opt) save raw waveforms (1), or simulate and process in one paxer run without them (0, default)>")
+    print("<(opt) run the stages in node-local scratch and copy the outputs back at the end (1, default), or in the output path (0)>")
+    print("<(opt) cores per job: run that many subruns at a time in multi-core jobs of several subruns (subrun_runner.py), default 1>")
     exit()
 
 OutputGeneralPath = sys.argv[1]
@@ -35,71 +53,202 @@ ElectronNumLower = int(sys.argv[8])
 ElectronNumUpper = int(sys.argv[9])
 IfEnableS1S2Correlation = int(sys.argv[10])
 IfUsePublicNodes = int(sys.argv[11])
+SpectrumFile = "none"
+if len(sys.argv)>12 and sys.argv[12]!='none':
+    SpectrumFile = os.path.abspath(sys.argv[12])
+ProductionSeed = None
+if len(sys.argv)>13 and sys.argv[13]!='none':
+    ProductionSeed = int(sys.argv[13])
+CostModelFile = "none"
+if len(sys.argv)>14:
+    CostModelFile = sys.argv[14]
+IfJobArray = 1
+if len(sys.argv)>15:
+    IfJobArray = int(sys.argv[15])
 
 MaxNumJob = 64
 if not IfUsePublicNodes:
     MaxNumJob=200
+if len(sys.argv)>16:
+    MaxNumJob = int(sys.argv[16])
+SaveRaw = 0
+if len(sys.argv)>17:
+    SaveRaw = int(sys.argv[17])
+UseScratch = 1
+if len(sys.argv)>18:
+    UseScratch = int(sys.argv[18])
+CoresPerJob = 1
+if len(sys.argv)>19:
+    CoresPerJob = int(sys.argv[19])
+
+# Must match run_fax.sh
+Detector = "XENON1T"
+RecoilType = "ER"
 
 
 ##### Start batching #########
 CurrentPath = os.getcwd()
 print (CurrentPath)
 CurrentUser = getpass.getuser()
-for i in range(NumJobs):
 
+# a restarted production keeps its seed and only resubmits the subruns
+# that are neither done nor still in the queue
+make_dir(OutputGeneralPath)
+StatePath = state_path(OutputGeneralPath)
+State = ProductionState(StatePath)
+if ProductionSeed is None:
+    ProductionSeed = int(State.get_meta("production_seed", int(time.time())))
+State.set_meta("production_seed", ProductionSeed)
+Subruns = [i for i in range(NumJobs) if "%06d" % i in State.to_submit("fax", ["%06d" % i for i in range(NumJobs)],
+                                                                     active_job_ids(CurrentUser))]
+print(str(NumJobs-len(Subruns))+" subruns done or running, "+str(len(Subruns))+" to submit")
+# failed subruns are resubmitted after a backoff, away from the nodes they failed on,
+# unless the retry policy gives up on them (from the exit code of run_fax.sh and its logs)
+RetryArgs = {}
+for i in list(Subruns):
     RunString = "%06d" % i
-    
+    Args = retry_plan(State, "fax", RunString, glob.glob(OutputGeneralPath+"/"+RunString+"/*.log"), RUN_FAX_CODES)
+    if Args is None:
+        Subruns.remove(i)
+    else:
+        RetryArgs[i] = Args
+
+# instructions of every subrun are generated here from its own random stream,
+# jobs only read them; regenerate one subrun with CreateFakeCSV.py <...> <seed> <subrun>
+# (with a cost model: <...> <seed> <subrun> <events kept>, from the _events.txt file of the subrun)
+print("Production seed "+str(ProductionSeed))
+with open(OutputGeneralPath+"/production_seed.txt", 'w') as fseed:
+    fseed.write(str(ProductionSeed)+"\n")
+Spectrum = None
+if SpectrumFile!="none":
+    Spectrum = load_spectrum(SpectrumFile)
+
+# with a cost model, every job gets the leading events of a stream of CandidateEvents
+# that fit in the same predicted runtime, i.e. NumEvents events of average predicted cost
+Model = None
+CandidateEvents = NumEvents
+if CostModelFile!="none":
+    Model = CostModel.load(CostModelFile)
+    CandidateEvents = 4*NumEvents
+    Pilot = create_instructions(Detector, 10000, PhotonNumLower, PhotonNumUpper,
+                                ElectronNumLower, ElectronNumUpper, 1,
+                                Spectrum, job_random_state(ProductionSeed, 2**32-1))
+    Budget = NumEvents*Model.event_cost(Pilot['s1_photons'], Pilot['s2_electrons'],
+                                        PMTAfterpulseFlag, S2AfterpulseFlag, SaveRaw).mean()
+    print("Predicted runtime per job "+str(int(Budget+Model.job_overhead(PMTAfterpulseFlag, S2AfterpulseFlag, SaveRaw)))+" s")
+    # kept with the seed in the production state, production_seed.txt only holds the seed
+    State.set_meta("cost_model", os.path.abspath(CostModelFile))
+    State.set_meta("cost_budget", repr(Budget))
+NumEventsPerJob = {}
+for i in Subruns:
+
+    RunString = "%06d" % i
+
     # create folder
     OutputPath = OutputGeneralPath + "/" + RunString
-    if os.path.exists(OutputPath):
-        subp.call("rm -r "+OutputPath, shell=True)
-    subp.call("mkdir -p "+OutputPath, shell=True)
+    make_dir(OutputPath, clean=True)
+
+    # fax instructions of this subrun
+    Instructions = create_instructions(Detector, CandidateEvents, PhotonNumLower, PhotonNumUpper,
+                                       ElectronNumLower, ElectronNumUpper, IfEnableS1S2Correlation,
+                                       Spectrum, job_random_state(ProductionSeed, i))
+    if Model is not None:
+        Instructions = events_within_budget(Model, Instructions, Budget, PMTAfterpulseFlag, S2AfterpulseFlag, SaveRaw)
+    NumEventsPerJob[i] = Instructions['instruction'].max()+1
+    write_instructions(OutputPath+"/FakeWaveform_"+Detector+"_"+RunString+".csv", Instructions, RecoilType)
+    # the instructions are drawn in blocks, so the kept events are only reproduced by drawing
+    # the same number of events, then keeping as many
+    with open(OutputPath+"/FakeWaveform_"+Detector+"_"+RunString+"_events.txt", 'w') as fevents:
+        fevents.write("%d %d\n" % (CandidateEvents, NumEventsPerJob[i]))
+
+# time limit from the recorded runtimes of the fax jobs with the same parameters
+FaxParams = params_key(IfUsePublicNodes, PMTAfterpulseFlag, S2AfterpulseFlag, PhotonNumLower, PhotonNumUpper,
+                       ElectronNumLower, ElectronNumUpper, NumEvents, os.path.basename(SpectrumFile),
+                       "none" if Model is None else "cost", SaveRaw)
+TimeLimit = time_limit("fax", FaxParams, "03:59:00")
+print("Time limit "+TimeLimit)
+
+def record_fax_jobs(JobIDs):
+    # job id of every submitted subrun (of its multi-core job), for restarts and the stage dependencies
+    # of begin_production.py
+    for (i, JobID) in zip(Subruns, JobIDs):
+        if JobID is not None:
+            State.submitted("fax", "%06d" % i, JobID)
+
+def fax_commands(NumEventsString, RunString):
+    # the subrun is done once run_fax.sh succeeded and left its processed file
+    return recorded_commands([fax_command(NumEventsString, RunString)], StatePath, "fax", RunString,
+                             [OutputGeneralPath+"/"+RunString+"/FakeWaveform_"+Detector+"_"+RunString+"_pax.root"],
+                             FaxParams)
+
+def fax_command(NumEventsString, RunString):
+    return CurrentPath+"/./run_fax.sh "+str(PhotonNumLower)+" "+str(PhotonNumUpper)+" "+str(ElectronNumLower)+" "+str(ElectronNumUpper)+" "+str(PMTAfterpulseFlag)+" "+str(S2AfterpulseFlag)+" "+NumEventsString+" "+OutputGeneralPath+" "+RunString+" "+str(IfEnableS1S2Correlation)+" "+SpectrumFile+" "+str(SaveRaw)+" "+str(UseScratch)
+
+if CoresPerJob>1:
+    # each job runs a range of subruns with subrun_runner.py, CoresPerJob at a time;
+    # a subrun still runs the commands and writes the log of a single-subrun job
+    Name = "fax_"+str(int(time.time()))
+    TaskScript = OutputGeneralPath+"/submit/"+Name+"_subrun.sh"
+    SubrunParams = OutputGeneralPath+"/submit/"+Name+"_subruns.txt"
+    make_dir(OutputGeneralPath+"/submit")
+    write_file(TaskScript, "\n".join(["exec > "+OutputGeneralPath+"/$2/submit_$2.log 2>&1"]
+                                     + fax_commands("$1", "$2"))+"\n")
+    write_file(SubrunParams, "".join(str(NumEventsPerJob[i])+" %06d\n" % i for i in Subruns))
+    Groups, GroupTimeLimit = runner_groups(len(Subruns), CoresPerJob, TimeLimit)
+    RunnerCommand = "python "+RUNNER_EXE+" "+TaskScript+" "+SubrunParams+" $1 $2 "+str(CoresPerJob)
+    print(str(len(Groups))+" jobs of "+str(CoresPerJob)+" cores, time limit "+GroupTimeLimit)
+    if IfJobArray:
+        GroupIDs = array_task_ids(submit_array(Name, [RunnerCommand], Groups, OutputGeneralPath+"/submit",
+                                               max(1, MaxNumJob//CoresPerJob), GroupTimeLimit, IfUsePublicNodes,
+                                               always_account=True, extra_args=combine_args(RetryArgs.values()),
+                                               cpus_per_task=CoresPerJob),
+                                  len(Groups))
+    else:
+        Submissions = []
+        for (First, Last) in Groups:
+            SubmitFile = OutputGeneralPath+"/submit/"+Name+"_%d_%d.sh" % (First, Last)
+            write_file(SubmitFile, render_submit_script([RunnerCommand.replace("$1 $2", "%d %d" % (First, Last))],
+                                                        SubmitFile[:-3]+".log", SubmitFile[:-3]+".log",
+                                                        GroupTimeLimit, IfUsePublicNodes, always_account=True,
+                                                        cpus_per_task=CoresPerJob))
+            Submissions.append((SubmitFile, OutputGeneralPath+"/submit",
+                                combine_args(RetryArgs[i] for i in Subruns[First:Last+1])))
+        GroupIDs = QueueThrottler(partition_name(IfUsePublicNodes), CurrentUser,
+                                  max(1, MaxNumJob//CoresPerJob)).submit_all(Submissions)
+    record_fax_jobs([JobID for ((First, Last), JobID) in zip(Groups, GroupIDs) for _ in range(First, Last+1)])
+
+elif IfJobArray:
+    # one array for the whole production, throttled by the array %N limit;
+    # the subrun log stays <subrun>/submit_<subrun>.log
+    # named after the submission time, so tasks still pending from a previous
+    # submission keep reading their own parameter file
+    ArrayIDs = submit_array("fax_"+str(int(time.time())), fax_commands("$1", "$2"),
+                            [[NumEventsPerJob[i], "%06d" % i] for i in Subruns],
+                            OutputGeneralPath+"/submit", MaxNumJob, TimeLimit, IfUsePublicNodes,
+                            log=OutputGeneralPath+"/$2/submit_$2.log", always_account=True,
+                            extra_args=combine_args(RetryArgs.values()))
+    record_fax_jobs(array_task_ids(ArrayIDs, len(Subruns)))
+
+else:
+    # jobs are released by the throttler as slots free up in the partition
+    Submissions = []
+    for i in Subruns:
+
+        RunString = "%06d" % i
+        OutputPath = OutputGeneralPath + "/" + RunString
     
-    # define filenames
-    SubmitFile = OutputPath+"/submit_"+ RunString + ".sh"
-    SubmitOutputFilename = OutputPath+"/submit_"+ RunString + ".log"
-    SubmitErrorFilename = OutputPath+"/submit_"+ RunString + ".log"
-
-    # create the basic submit 
-    subp.call("echo '#!/bin/bash\n' >> "+SubmitFile, shell=True)
-    subp.call("echo '#SBATCH --output="+SubmitOutputFilename+"' >> "+SubmitFile, shell=True)
-    subp.call("echo '#SBATCH --error="+SubmitErrorFilename+"' >> "+SubmitFile, shell=True)
-    subp.call("echo '#SBATCH --time=03:59:00' >> "+SubmitFile, shell=True)
-    subp.call("echo '#SBATCH --account=pi-lgrandi' >> "+SubmitFile, shell=True)
-    if IfUsePublicNodes==0:
-        subp.call("echo '#SBATCH --qos=xenon1t' >> "+SubmitFile, shell=True)
-        subp.call("echo '#SBATCH --partition=xenon1t\n' >> "+SubmitFile, shell=True)
-    elif IfUsePublicNodes==2:
-        subp.call("echo '#SBATCH --qos=xenon1t-kicp' >> "+SubmitFile, shell=True)
-        subp.call("echo '#SBATCH --partition=kicp\n' >> "+SubmitFile, shell=True)
-
-    Command = CurrentPath+"/./run_fax.sh "+str(PhotonNumLower)+" "+str(PhotonNumUpper)+" "+str(ElectronNumLower)+" "+str(ElectronNumUpper)+" "+str(PMTAfterpulseFlag)+" "+str(S2AfterpulseFlag)+" "+str(NumEvents)+" "+OutputGeneralPath+" "+RunString+" "+str(IfEnableS1S2Correlation)
-    subp.call("echo '"+Command+"\n' >> "+SubmitFile, shell=True)
-
-    SubmitPath = OutputPath
-
-    #submit
-    IfSubmitted=0
-    while IfSubmitted==0:
-        Partition = "sandyb" # public
-        if not IfUsePublicNodes:
-            Partition = "xenon1t"
-        elif IfUsePublicNodes==2:
-            Partition = "kicp"
-        p1 = Popen(["squeue","--partition="+Partition, "--user="+CurrentUser], stdout=PIPE)
-        p2 = Popen(["wc", "-l"], stdin=p1.stdout, stdout=PIPE)
-        p1.stdout.close()  # Allow p1 to receive a SIGPIPE if p2 exits.
-        output = p2.communicate()[0]
-        Status=subp.call("squeue --partition="+Partition+" --user="+CurrentUser +" | wc -l", shell=True)
-        Output=int(output)
-        #print(Status)
-        
-        print("Current job running number "+str(Output))            
-
-        if Status==0 and Output<MaxNumJob:
-            #sbatch it 
-            subp.call("cd "+SubmitPath+";sbatch "+SubmitFile+";cd -", shell=True)
-            IfSubmitted=1
-            time.sleep(2.0)
-        else:
-            time.sleep(30) 
+        # define filenames
+        SubmitFile = OutputPath+"/submit_"+ RunString + ".sh"
+        SubmitOutputFilename = OutputPath+"/submit_"+ RunString + ".log"
+        SubmitErrorFilename = OutputPath+"/submit_"+ RunString + ".log"
+
+        # create the basic submit 
+        Commands = fax_commands(str(NumEventsPerJob[i]), RunString)
+        write_file(SubmitFile, render_submit_script(Commands, SubmitOutputFilename, SubmitErrorFilename,
+                                                    TimeLimit, IfUsePublicNodes, always_account=True))
+
+        SubmitPath = OutputPath
+
+        Submissions.append((SubmitFile, SubmitPath, RetryArgs[i]))
+
+    record_fax_jobs(QueueThrottler(partition_name(IfUsePublicNodes), CurrentUser, MaxNumJob).submit_all(Submissions))
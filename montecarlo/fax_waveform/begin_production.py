@@ -1,68 +1,102 @@
 import subprocess as subp
 import sys, os
 import time
+import getpass
+import runpy
+import traceback
 
-squeue_dict = {'0': 'xenon1t', '1': 'sandyb', '2': 'kicp'}
-configs = {'0': 'basics_config', '1' : 's1s2_preserve_all', '2' : 'PeakEfficiency'}
+from production_dag import submit_production_dag
+from production_budget import partition_budgets, rebalance
+from production_state import ProductionState, state_path, active_job_ids
 
-def wait_for_squeue(username, nodetype):
-    while len(subp.check_output(['squeue', '-u', username, '--partition', squeue_dict[nodetype]]).splitlines())>1:
-        print('waiting for squeue to free up, time = %i' % int(time.time()))
-        time.sleep(60)
-
-def make_processed_list(head_dirname, datetime, batchlist = 'processed_dataset_list.dat'):
-    dir_header = os.path.join(head_dirname, datetime)
-    pax_dir = os.path.join(dir_header, 'pax_%s/' % datetime)
-    print(pax_dir)
-    reduced_dir = os.path.join(dir_header, 'reduced_minitrees_%s/' % datetime)
-    batchlist_file = open(batchlist, 'w')
-    for subdir, dirs, files in os.walk(pax_dir):
-        for filename in files:
-            if '_pax.root' in filename:
-                batchlist_file.write(filename.split('.')[0] + '\n')
-    batchlist_file.close()
+MIDWAY_BATCH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'MidwayBatch.py')
 
 def fax_produce(process, head_dirname, username):
     dir_header = os.path.join(head_dirname, process['process_name'])
-    truth_dirname = os.path.join(dir_header, 'truth_minitrees_%s' % process['process_name'])
-    basics_dirname = os.path.join(dir_header, 'basics_minitrees_%s' % process['process_name'])
-    merged_dirname = os.path.join(dir_header, 'merged_minitrees_%s' % process['process_name'])
-    reduced_dirname = os.path.join(dir_header, 'reduced_minitrees_%s' % process['process_name'])
-    pax_dirname = os.path.join(dir_header, 'pax_%s' % process['process_name'])
     production_commands = []
     production_commands.append('mkdir %s' % dir_header)
     production_commands.append('echo "%s\n" >> %s' % (process['process_description'], os.path.join(dir_header, 'description.txt')))
     production_commands.append('echo $PWD >> %s' %  os.path.join(dir_header, 'description.txt'))
     production_commands.append('echo "\n%s" >> %s' % (str(process), os.path.join(dir_header, 'description.txt')))
     production_commands.append('cp run_fax.sh %s' % dir_header)
-    midway_batch_options = '%s %s %s %s %s %s %s %s %s %s %s' % (dir_header, process['nb_jobs'],
-                                process['events_per_job'], process['pmt_afterpulse'], process['s2_afterpulse'],
-                                process['photon_nb_low'], process['photon_nb_high'], process['electron_nb_low'],
-                                process['electron_nb_high'], process['correlated'], process['nodetype'])
-    production_commands.append('python MidwayBatch.py %s >> %s' % (midway_batch_options, process['log_file']))
-    production_commands.append('./sort_processed_files.sh %s >> %s' % (process['process_name'], process['log_file']))
-    if process['minitree_type'] != '0':
-        batchlist = 'processed_dataset_list.dat'
-        production_commands.append('python BatchReduceDataSubmission.py %s %s %s %s %s 0 %s >> %s' % (batchlist, pax_dirname,
-                                        reduced_dirname, os.path.join(os.getcwd(), 'submission_reduce/'), process['nodetype'], process['minitree_type'], process['log_file']))
-        production_commands.append('python BatchMergeTruthAndProcessed.py Configs/%s %s %s %s submission_merge/ %s 0 %s %s %s' % (configs[process['minitree_type']], 
-                                            truth_dirname, reduced_dirname, merged_dirname, process['nodetype'], process['use_array_truth'], process['minitree_type'], process['save_ap_truth']))
-    else:
-        production_commands.append('python BatchMergeTruthAndProcessed.py Configs/%s %s %s %s submission_merge/ %s 0 %s %s %s' % (configs[process['minitree_type']], 
-                                            truth_dirname, basics_dirname, merged_dirname, process['nodetype'], process['use_array_truth'], process['minitree_type'], process['save_ap_truth']))
-    production_commands.append('python MergePickles.py %s' % (merged_dirname))
     for command in production_commands:
-        wait_for_squeue(username, process['nodetype'])
-        if process['minitree_type']!='0':
-            if 'BatchReduce' in command:
-                time.sleep(10)
-                make_processed_list(head_dirname, process['process_name'], batchlist=batchlist)
         print('submitting command')
         print(command)
         subp.call(command, shell=True)
+    submit_production(process, dir_header)
+
+def midway_batch(args, log_file):
+    # MidwayBatch.py runs in this process, so that with the local backend (FAX_BACKEND=local:N)
+    # the fax jobs of all productions and their stage chains share the N workers and the job
+    # dependencies, and no production waits for the fax jobs of the previous one
+    argv, stdout = sys.argv, sys.stdout
+    with open(log_file, 'a') as flog:
+        sys.argv, sys.stdout = [MIDWAY_BATCH] + args, flog
+        try:
+            runpy.run_path(MIDWAY_BATCH, run_name='__main__')
+        except (Exception, SystemExit):
+            traceback.print_exc(file=flog)
+        finally:
+            sys.argv, sys.stdout = argv, stdout
+
+def submit_production(process, dir_header):
+    # fax jobs of the subruns neither done nor running, then their stage chains
+    midway_batch_options = '%s %s %s %s %s %s %s %s %s %s %s' % (dir_header, process['nb_jobs'],
+                                process['events_per_job'], process['pmt_afterpulse'], process['s2_afterpulse'],
+                                process['photon_nb_low'], process['photon_nb_high'], process['electron_nb_low'],
+                                process['electron_nb_high'], process['correlated'], process['nodetype'])
+    # spectrum, seed, cost model, job array, share of the job budget, raw waveforms, scratch staging, cores per job
+    midway_batch_options += ' %s %s %s 1 %s %s %s %s' % (process.get('spectrum', 'none'), process.get('seed', 'none'),
+                                                         process.get('cost_model', 'none'), process['max_jobs'],
+                                                         process.get('save_raw', '0'), process.get('scratch', '1'),
+                                                         process.get('cores', '1'))
+    print('submitting MidwayBatch.py %s >> %s' % (midway_batch_options, process['log_file']))
+    midway_batch(midway_batch_options.split(), process['log_file'])
+    # sort/reduce/merge of every subrun are submitted now, each one waiting
+    # (Slurm dependency) only for the previous stage of the same subrun
+    print('submitting the stage chains of %s' % process['process_name'])
+    submit_production_dag(process, dir_header)
+
+def watch_productions(process_list, head_dirname, max_jobs, rebalance_interval, retry_interval):
+    # one poll cycle until no job is left in the queue: the budget of the productions without
+    # fax jobs goes to the others, and the productions with failed (or lost) units are submitted
+    # again with their current share, the retry policy resubmitting them or giving up on them
+    interval = min(value for value in (rebalance_interval, retry_interval) if value)
+    stages = ['fax', 'reduce', 'merge', 'merge_pickles']
+    while True:
+        active_jobs = active_job_ids(getpass.getuser())
+        running = False
+        failed = []
+        for process in process_list:
+            state = ProductionState(state_path(os.path.join(head_dirname, process['process_name'])))
+            submitted = [(stage, unit) for stage in stages for unit in state.units(stage, 'submitted')]
+            if any(state.is_running(stage, unit, active_jobs) for (stage, unit) in submitted):
+                running = True
+            if retry_interval and (any(state.units(stage, 'failed') for stage in stages) or
+                                   any(not state.is_running(stage, unit, active_jobs) for (stage, unit) in submitted)):
+                failed.append(process['process_name'])
+        if rebalance_interval:
+            shares = rebalance(process_list, head_dirname, active_jobs, max_jobs, failed)
+            for process in process_list:
+                process['max_jobs'] = shares.get(process['process_name'], process['max_jobs'])
+        for process in process_list:
+            if process['process_name'] in failed:
+                print('resubmitting the failed jobs of %s' % process['process_name'])
+                submit_production(process, os.path.join(head_dirname, process['process_name']))
+                running = True
+        if not running:
+            return
+        time.sleep(interval)
 
 import setup_production
 process_list = setup_production.process_list
+# all processes run at the same time, sharing the job budget of their partition by priority
+budgets = partition_budgets(process_list, setup_production.max_jobs)
 for process in process_list:
     process['log_file'] = os.path.join('logs', process['log_file'])
+    process['max_jobs'] = budgets[process['process_name']]
     fax_produce(process, setup_production.head_dirname, setup_production.username)
+if (len(process_list)>1 and setup_production.rebalance_interval) or setup_production.retry_interval:
+    watch_productions(process_list, setup_production.head_dirname, setup_production.max_jobs,
+                      setup_production.rebalance_interval if len(process_list)>1 else 0,
+                      setup_production.retry_interval)
@@ -0,0 +1,67 @@
+####################################
+## Minitrees in several formats from a single hax pass
+## haxer builds the minitrees of a pax file in one format only, so run_sim.sh
+## used to run it twice (ROOT, then pklz), reducing every pax file twice.
+## This script writes the ROOT minitrees of the first pass in the other
+## formats without reading the pax file again: the hax formats (pklz, hdf5)
+## through hax, metadata included, so hax/lax load them as their own
+## minitrees; parquet (columnar, data only, needs pyarrow) through pandas.
+## A missing or unreadable ROOT minitree fails the conversion.
+##
+## Usage:
+##   python convert_minitrees.py <minitree dir> <dataset> <formats, comma-separated> <treemaker> [<treemaker> ...]
+####################################
+from __future__ import print_function
+
+import os
+import sys
+
+import hax
+from hax.minitree_formats import get_format
+from hax.minitrees import get_treemaker_name_and_class
+
+SOURCE_FORMAT = 'root'
+PANDAS_FORMATS = {'parquet': lambda data, path: data.to_parquet(path)}
+
+
+def minitree_path(directory, dataset, treemaker_name, extension):
+    """File name used by hax for a minitree"""
+    return os.path.join(directory, '%s_%s.%s' % (dataset, treemaker_name, extension))
+
+
+def convert_minitree(directory, dataset, treemaker, formats):
+    """Write the ROOT minitree of a treemaker in the formats
+
+    :return: list of the files written
+    """
+    treemaker_name, treemaker_class = get_treemaker_name_and_class(treemaker)
+    source = get_format(minitree_path(directory, dataset, treemaker_name, SOURCE_FORMAT), treemaker_class)
+    metadata = source.load_metadata()
+    data = source.load_data()
+    written = []
+    for extension in formats:
+        path = minitree_path(directory, dataset, treemaker_name, extension)
+        if extension in PANDAS_FORMATS:
+            PANDAS_FORMATS[extension](data, path)
+        else:
+            get_format(path, treemaker_class).save_data(metadata, data)
+        written.append(path)
+    return written
+
+
+if __name__ == '__main__':
+    if len(sys.argv)<5:
+        print("========= Syntax ==========")
+        print("python convert_minitrees.py <minitree dir> <dataset> <formats, comma-separated> <treemaker> [<treemaker> ...]")
+        print("(formats: pklz, hdf5 or parquet)")
+        exit()
+
+    MinitreeDir = sys.argv[1]
+    Dataset = sys.argv[2]
+    Formats = [Format for Format in sys.argv[3].split(',') if Format and Format!=SOURCE_FORMAT]
+    Treemakers = sys.argv[4:]
+
+    hax.init(minitree_paths=[MinitreeDir], pax_version_policy='loose')
+    for Treemaker in Treemakers:
+        for Path in convert_minitree(MinitreeDir, Dataset, Treemaker, Formats):
+            print("Written "+Path)
@@ -0,0 +1,184 @@
+####################################
+## Runtime cost model for fax productions
+## Learns the fax+pax runtime of a subrun from previous productions:
+##   runtime = job + sum over events (event + photon*s1_photons + electron*s2_electrons)
+## with one set of coefficients per (PMT afterpulse, S2 afterpulse, save raw)
+## setting, the runs keeping the raw waveforms (two paxer runs) being slower.
+## The timings come from the bash `time` output in *_raw.log and *_pax.log
+## (only *_pax.log for the runs simulating and processing in one paxer run;
+## a two-pass run without a readable *_raw.log is skipped), the photon/electron
+## numbers from the instruction csv and the flags from the run_fax.sh line of
+## submit_<subrun>.sh (or of the job array script)
+##
+## Usage:
+##   python cost_model.py <output model (.json)> <production path> [<production path> ...]
+##   then pass the model to MidwayBatch.py to balance the jobs
+####################################
+import glob
+import json
+import os
+import re
+import sys
+
+import numpy as np
+
+from CreateFakeCSV import leading_events
+
+COEFFICIENTS = ['job', 'event', 'photon', 'electron']
+# below this many subruns a flag setting falls back to the model fitted on all settings
+MIN_SAMPLES = 4
+
+time_re = re.compile(r'^real\s+(\d+)m([\d.]+)s', re.MULTILINE)
+
+
+def parse_time_log(filename):
+    """Wall time in seconds from the bash `time` output at the end of a log, None if absent"""
+    if not os.path.exists(filename):
+        return None
+    with open(filename) as flog:
+        matches = time_re.findall(flog.read())
+    if not matches:
+        return None
+    minutes, seconds = matches[-1]
+    return 60.*int(minutes) + float(seconds)
+
+
+def parse_run_flags(submit_file):
+    """(PMT afterpulse, S2 afterpulse, save raw) flags from the run_fax.sh line of a submit file;
+    the jobs submitted without the save raw argument always ran fax and pax separately"""
+    with open(submit_file) as fsubmit:
+        for line in fsubmit:
+            if 'run_fax.sh' in line:
+                args = line.split('run_fax.sh')[1].split()
+                return int(args[4]), int(args[5]), int(args[11]) if len(args) > 11 else 1
+    return None
+
+
+def read_instruction_sums(csv_file):
+    """(number of events, total s1_photons, total s2_electrons) of an instruction csv"""
+    data = np.genfromtxt(csv_file, delimiter=',', skip_header=1, usecols=(0, 5, 6), ndmin=2)
+    if data.size == 0:
+        return 0, 0., 0.
+    return len(np.unique(data[:, 0])), data[:, 1].sum(), data[:, 2].sum()
+
+
+def collect_samples(production_paths):
+    """One sample per finished subrun of the given productions
+
+    :return: list of dicts with flags, n_events, photons, electrons and runtime
+    """
+    samples = []
+    for production_path in production_paths:
+        for subrun_path in sorted(glob.glob(os.path.join(production_path, '[0-9]*'))):
+            subrun = os.path.basename(subrun_path)
+            submit_file = os.path.join(subrun_path, 'submit_%s.sh' % subrun)
+            csv_files = glob.glob(os.path.join(subrun_path, 'FakeWaveform_*_%s.csv' % subrun))
+            if not os.path.exists(submit_file):
+                submit_file = (sorted(glob.glob(os.path.join(production_path, 'submit', 'fax*_array_*.sh')))
+                               or [submit_file])[0]
+            if not os.path.exists(submit_file) or not csv_files:
+                continue
+            runtime = parse_time_log(csv_files[0].replace('.csv', '_pax.log'))
+            flags = parse_run_flags(submit_file)
+            if runtime is None or flags is None:
+                continue
+            if flags[2]:
+                raw_time = parse_time_log(csv_files[0].replace('.csv', '_raw.log'))
+                if raw_time is None:
+                    continue
+                runtime += raw_time
+            n_events, photons, electrons = read_instruction_sums(csv_files[0])
+            samples.append({'flags': flags, 'n_events': n_events, 'photons': photons,
+                            'electrons': electrons, 'runtime': runtime})
+    return samples
+
+
+def fit_coefficients(samples):
+    """Least squares fit of the runtime, refitted without any negative coefficient"""
+    design = np.array([[1., s['n_events'], s['photons'], s['electrons']] for s in samples])
+    runtime = np.array([s['runtime'] for s in samples])
+    active = np.ones(len(COEFFICIENTS), dtype=bool)
+    coefficients = np.zeros(len(COEFFICIENTS))
+    while active.any():
+        coefficients[:] = 0.
+        coefficients[active] = np.linalg.lstsq(design[:, active], runtime, rcond=None)[0]
+        if (coefficients >= 0).all():
+            break
+        active &= coefficients > 0
+    return dict(zip(COEFFICIENTS, coefficients.tolist()))
+
+
+class CostModel(object):
+    """Predicted fax+pax runtime (seconds) of events and jobs"""
+
+    def __init__(self, models):
+        self.models = models
+
+    @classmethod
+    def fit(cls, samples):
+        if not samples:
+            raise ValueError("No finished subruns to fit the cost model")
+        models = {'all': fit_coefficients(samples)}
+        for save_raw in set(s['flags'][2] for s in samples):
+            selected = [s for s in samples if s['flags'][2] == save_raw]
+            if len(selected) >= MIN_SAMPLES:
+                models['all_%d' % save_raw] = fit_coefficients(selected)
+        for flags in set(s['flags'] for s in samples):
+            selected = [s for s in samples if s['flags'] == flags]
+            if len(selected) >= MIN_SAMPLES:
+                models['%d_%d_%d' % flags] = fit_coefficients(selected)
+        return cls(models)
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename) as fmodel:
+            return cls(json.load(fmodel))
+
+    def save(self, filename):
+        with open(filename, 'w') as fmodel:
+            json.dump(self.models, fmodel, indent=2, sort_keys=True)
+
+    def coefficients(self, pmt_afterpulse, s2_afterpulse, save_raw=0):
+        """Coefficients of a setting, else of its save raw mode, else of all settings"""
+        for key in ('%d_%d_%d' % (pmt_afterpulse, s2_afterpulse, save_raw), 'all_%d' % save_raw):
+            if key in self.models:
+                return self.models[key]
+        return self.models['all']
+
+    def event_cost(self, photons, electrons, pmt_afterpulse, s2_afterpulse, save_raw=0):
+        """Predicted runtime of each event"""
+        c = self.coefficients(pmt_afterpulse, s2_afterpulse, save_raw)
+        return c['event'] + c['photon']*np.asarray(photons) + c['electron']*np.asarray(electrons)
+
+    def job_overhead(self, pmt_afterpulse, s2_afterpulse, save_raw=0):
+        return self.coefficients(pmt_afterpulse, s2_afterpulse, save_raw)['job']
+
+
+def events_within_budget(model, instructions, budget, pmt_afterpulse, s2_afterpulse, save_raw=0):
+    """Keep the leading events of a set of instructions whose predicted runtime fits the budget
+
+    :param instructions: dict of columns from CreateFakeCSV.create_instructions
+    :param budget: predicted runtime (seconds) of one job, overhead excluded
+    :return: instructions cut at an event boundary (at least one event)
+    """
+    event_ids = instructions['instruction']
+    n_events = event_ids.max() + 1
+    photons = np.bincount(event_ids, weights=instructions['s1_photons'], minlength=n_events)
+    electrons = np.bincount(event_ids, weights=instructions['s2_electrons'], minlength=n_events)
+    cumulative = np.cumsum(model.event_cost(photons, electrons, pmt_afterpulse, s2_afterpulse, save_raw))
+    kept = max(1, int(np.searchsorted(cumulative, budget, side='right')))
+    return leading_events(instructions, kept)
+
+
+if __name__ == '__main__':
+    if len(sys.argv)<3:
+        print("========= Syntax ==========")
+        print("python cost_model.py <output model (.json)> <production path> [<production path> ...]")
+        exit()
+
+    samples = collect_samples(sys.argv[2:])
+    model = CostModel.fit(samples)
+    model.save(sys.argv[1])
+    print("Fitted on "+str(len(samples))+" subruns, written to "+sys.argv[1])
+    for key in sorted(model.models):
+        print(key+": "+", ".join("%s=%.4g" % (c, model.models[key][c]) for c in COEFFICIENTS))
@@ -0,0 +1,155 @@
+####################################
+## Fiducial volume definitions for WF simulation
+## Shared by the instruction generation (CreateFakeCSV.py)
+## and by analysis cuts, so both use the same geometry
+##
+## HARDCODE WARNING: The FV dimensions below need to be modified
+##                   according to the detector you wish to simulate
+##
+## Coordinates are in cm, z is negative below the gate
+## Every volume has contains(x, y, z) (scalars or arrays, returns a boolean
+## (array)), sample(n) drawing points uniformly inside it, and acceptance,
+## the fraction of proposals its sampler keeps (1 for exact samplers)
+##
+## Usage:
+##   fv = get_fiducial_volume('XENON1T')
+##   mask = fv.contains(df['x'], df['y'], df['z'])
+##   x, y, z = fv.sample(1000)
+####################################
+import numpy as np
+
+
+class LinearRadius2Cylinder(object):
+    """Volume with z_lower <= z <= z_upper and x^2+y^2 < r2_intercept + r2_slope*z
+
+    The area of the cross section is linear in z, so R^2(z) of a uniform point
+    has a density proportional to R^2 itself; it is drawn by inverse CDF and the
+    radius inside the slice follows, giving exact sampling (acceptance 1).
+    """
+    acceptance = 1.
+
+    def __init__(self, z_lower, z_upper, r2_intercept, r2_slope):
+        self.z_lower = z_lower
+        self.z_upper = z_upper
+        self.r2_intercept = r2_intercept
+        self.r2_slope = r2_slope
+
+    def radius2(self, z):
+        return self.r2_intercept + self.r2_slope*z
+
+    def contains(self, x, y, z):
+        x, y, z = np.asarray(x), np.asarray(y), np.asarray(z)
+        return (z >= self.z_lower) & (z <= self.z_upper) & (x**2 + y**2 < self.radius2(z))
+
+    def sample(self, n, rng=None):
+        """Draw n points uniformly inside the volume
+
+        :param n: number of points
+        :param rng: numpy RandomState (default: global numpy random state)
+        :return: (x, y, z) arrays
+        """
+        rng = np.random if rng is None else rng
+        u = rng.uniform(0., 1., n)
+        if self.r2_slope == 0:
+            z = self.z_lower + u*(self.z_upper - self.z_lower)
+            r2 = np.full(n, self.r2_intercept, dtype=float)
+        else:
+            w0, w1 = self.radius2(self.z_lower), self.radius2(self.z_upper)
+            r2 = np.sqrt(w0**2 + u*(w1**2 - w0**2))
+            z = (r2 - self.r2_intercept)/self.r2_slope
+        r = np.sqrt(rng.uniform(0., 1., n)*r2)
+        phi = rng.uniform(0., 2.*np.pi, n)
+        return r*np.cos(phi), r*np.sin(phi), z
+
+
+class BoxedSuperEllipsoid(object):
+    """Super-ellipsoid ((z-z_center)/z_half)^p + ((x^2+y^2)/r2_scale)^p < 1
+    clipped to the box |x|,|y| <= xy_half, z_lower <= z <= z_upper
+
+    Points are sampled exactly in z: (x, y) is accepted with probability
+    proportional to the height of the column above it, then z is drawn
+    uniformly in that column. The acceptance of the (x, y) step is
+    computed once by quadrature over the box.
+    """
+
+    def __init__(self, z_center, z_half, r2_scale, power, xy_half, z_lower, z_upper):
+        self.z_center = z_center
+        self.z_half = z_half
+        self.r2_scale = r2_scale
+        self.power = power
+        self.xy_half = xy_half
+        self.z_lower = z_lower
+        self.z_upper = z_upper
+        self.max_height = float(self._height(np.zeros(1))[0])
+        grid = (np.arange(512) + 0.5)/512.*2*xy_half - xy_half
+        gx, gy = np.meshgrid(grid, grid)
+        self.acceptance = float(np.mean(self._height(gx**2 + gy**2)))/self.max_height
+
+    def _column(self, r2):
+        # z interval of the super-ellipsoid above radius^2 = r2, clipped to the box
+        term = 1. - np.power(r2/self.r2_scale, self.power)
+        half = self.z_half*np.power(np.clip(term, 0., None), 1./self.power)
+        low = np.maximum(self.z_center - half, self.z_lower)
+        high = np.minimum(self.z_center + half, self.z_upper)
+        return low, np.maximum(high, low)
+
+    def _height(self, r2):
+        low, high = self._column(r2)
+        return high - low
+
+    def contains(self, x, y, z):
+        x, y, z = np.asarray(x), np.asarray(y), np.asarray(z)
+        I = np.power((z - self.z_center)/self.z_half, self.power)
+        I = I + np.power((x**2 + y**2)/self.r2_scale, self.power)
+        inbox = (np.abs(x) <= self.xy_half) & (np.abs(y) <= self.xy_half)
+        inbox = inbox & (z >= self.z_lower) & (z <= self.z_upper)
+        return (I < 1) & inbox
+
+    def sample(self, n, rng=None):
+        """Draw n points uniformly inside the volume
+
+        :param n: number of points
+        :param rng: numpy RandomState (default: global numpy random state)
+        :return: (x, y, z) arrays
+        """
+        rng = np.random if rng is None else rng
+        if n == 0:
+            return np.zeros(0), np.zeros(0), np.zeros(0)
+        xs, ys = [], []
+        missing = n
+        while missing > 0:
+            batch = int(missing/self.acceptance*1.1) + 16
+            x = rng.uniform(-self.xy_half, self.xy_half, batch)
+            y = rng.uniform(-self.xy_half, self.xy_half, batch)
+            keep = rng.uniform(0., self.max_height, batch) < self._height(x**2 + y**2)
+            xs.append(x[keep][:missing])
+            ys.append(y[keep][:missing])
+            missing -= len(xs[-1])
+        x, y = np.concatenate(xs), np.concatenate(ys)
+        low, high = self._column(x**2 + y**2)
+        z = low + rng.uniform(0., 1., n)*(high - low)
+        return x, y, z
+
+
+####################################
+## Detector definitions (HARDCODE WARNING):
+####################################
+FIDUCIAL_VOLUMES = {
+    # X48kg0, sampled inside the box used for the original fake instructions
+    'XENON100': BoxedSuperEllipsoid(z_center=-15., z_half=14.6, r2_scale=20000., power=4.,
+                                    xy_half=np.sqrt(200.), z_lower=-14.6-15.0, z_upper=-14.6+15.0),
+    # Current FV cut for Xe1T: R^2 < 1400 + (z+100)*(2250-1900)/100, NEED TO UPDATE THIS
+    'XENON1T': LinearRadius2Cylinder(z_lower=-90., z_upper=-15.,
+                                     r2_intercept=1400. + 100.*(2250-1900)/100., r2_slope=(2250-1900)/100.),
+}
+
+
+def get_fiducial_volume(detector):
+    """Return the fiducial volume of a detector
+
+    :param detector: XENON100 or XENON1T
+    :return: LinearRadius2Cylinder or BoxedSuperEllipsoid
+    """
+    if detector not in FIDUCIAL_VOLUMES:
+        raise ValueError("No fiducial volume defined for detector %s" % detector)
+    return FIDUCIAL_VOLUMES[detector]
@@ -0,0 +1,183 @@
+####################################
+## Content-addressed store of the Geant4-level outputs of the grid MC jobs
+## The Geant4, nSort and Patch outputs of a job only depend on the MC version,
+## flavor, configuration, macros, number of events and job id, not on the
+## fax/pax versions. They are kept once per key, so that a new fax/pax version
+## reprocesses them (mc_process.py --reprocess) instead of running Geant4 again.
+##   <store>/objects/<sha256[:2]>/<sha256>.tar.bz2   G4 tarballs, by content
+##   <store>/keys/<key>.json                         key -> object and parameters
+## mc_process.py --g4-store writes the keys of the jobs of a workflow to
+## g4_keys.json; `add` then stores the G4 tarballs of the finished jobs:
+## <job>_g4.tar.bz2 (--per-stage), or the G4 products of <job>_output.tar.bz2,
+## extracted with tar (which also reads the concatenated bz2 streams of older
+## output tarballs, unlike tarfile of Python 2).
+##
+## Usage:
+##   python g4_store.py add <store> <g4_keys.json> <workflow output directory>
+##   python g4_store.py list <store>
+####################################
+from __future__ import print_function
+
+import fnmatch
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from package_outputs import package, PROFILES
+
+KEYS_FILE = 'g4_keys.json'
+CHUNK_SIZE = 1024*1024
+
+
+def file_digest(path):
+    """sha256 of a file"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fdata:
+        for chunk in iter(lambda: fdata.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def g4_key(mc_version, mc_flavor, mc_config, events, job, macros):
+    """Store key of the Geant4 outputs of a job
+
+    :param macros: list of (macro name, sha256 of a local macro, None for a macro of the MC release)
+    :return: (key, parameters it is made of)
+    """
+    params = {'mc_version': mc_version, 'mc_flavor': mc_flavor, 'mc_config': mc_config, 'events': int(events),
+              'job': int(job), 'macros': [list(macro) for macro in macros]}
+    return hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest(), params
+
+
+class G4Store(object):
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+
+    def object_path(self, digest):
+        return os.path.join(self.path, 'objects', digest[:2], digest + '.tar.bz2')
+
+    def key_path(self, key):
+        return os.path.join(self.path, 'keys', key + '.json')
+
+    def lookup(self, key):
+        """Path of the G4 tarball of a key, None if not stored"""
+        if not os.path.isfile(self.key_path(key)):
+            return None
+        with open(self.key_path(key)) as fkey:
+            path = self.object_path(json.load(fkey)['object'])
+        return path if os.path.isfile(path) else None
+
+    def add(self, key, params, tarball):
+        """Store a G4 tarball (once per content) under a key
+
+        :return: sha256 of the tarball
+        """
+        digest = file_digest(tarball)
+        path = self.object_path(digest)
+        if not os.path.isfile(path):
+            def copy(fobject):
+                with open(tarball, 'rb') as ftarball:
+                    shutil.copyfileobj(ftarball, fobject)
+            write_atomic(path, copy)
+        entry = json.dumps({'object': digest, 'params': params, 'added': int(time.time())}, sort_keys=True)
+        write_atomic(self.key_path(key), lambda fkey: fkey.write(entry.encode()))
+        return digest
+
+    def entries(self):
+        """(key, entry) of the stored keys"""
+        keys_dir = os.path.join(self.path, 'keys')
+        for name in sorted(os.listdir(keys_dir)) if os.path.isdir(keys_dir) else []:
+            with open(os.path.join(keys_dir, name)) as fkey:
+                yield name[:-len('.json')], json.load(fkey)
+
+
+def write_atomic(path, write):
+    """Write a file under a temporary name, then rename it: readers never see a partial file"""
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp_')
+    try:
+        with os.fdopen(fd, 'wb') as fdata:
+            write(fdata)
+        os.rename(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def write_keys(path, keys):
+    """keys: job id -> (key, parameters)"""
+    with open(path, 'w') as fkeys:
+        json.dump(dict((str(job), {'key': key, 'params': params}) for (job, (key, params)) in keys.items()),
+                  fkeys, indent=1, sort_keys=True)
+
+
+def read_keys(path):
+    with open(path) as fkeys:
+        return dict((job, (entry['key'], entry['params'])) for (job, entry) in json.load(fkeys).items())
+
+
+def g4_tarball(output_dir, job, work_dir):
+    """G4 tarball of a finished job: <job>_g4.tar.bz2, else one made of the G4 products of
+    <job>_output.tar.bz2 (None if there is none)"""
+    path = os.path.join(output_dir, '%s_g4.tar.bz2' % job)
+    if os.path.isfile(path):
+        return path
+    path = os.path.join(output_dir, '%s_output.tar.bz2' % job)
+    if not os.path.isfile(path):
+        return None
+    members = [name for name in subprocess.check_output(['tar', 'tjf', path]).decode().splitlines()
+               if any(fnmatch.fnmatch(name, pattern) for pattern in PROFILES['g4'])]
+    if not members:
+        return None
+    products_dir = os.path.join(work_dir, job)
+    os.makedirs(products_dir)
+    members_file = os.path.join(work_dir, '%s_members.txt' % job)
+    with open(members_file, 'w') as fmembers:
+        fmembers.write(''.join(name + '\n' for name in members))
+    subprocess.check_call(['tar', 'xjf', path, '-C', products_dir, '--no-recursion', '-T', members_file])
+    path = os.path.join(work_dir, '%s_g4.tar.bz2' % job)
+    package(path, products_dir, 'g4')
+    return path
+
+
+if __name__ == '__main__':
+    if len(sys.argv)<3 or sys.argv[1] not in ('add', 'list') or (sys.argv[1]=='add' and len(sys.argv)<5):
+        print("========= Syntax ==========")
+        print("python g4_store.py add <store> <g4_keys.json> <workflow output directory>")
+        print("python g4_store.py list <store>")
+        exit()
+
+    Store = G4Store(sys.argv[2])
+    if sys.argv[1]=='list':
+        for (Key, Entry) in Store.entries():
+            Params = Entry['params']
+            print("%s  %s %s %s job %d (%d events) -> %s"
+                  % (Key[:12], Params['mc_version'], Params['mc_flavor'], Params['mc_config'], Params['job'],
+                     Params['events'], Entry['object'][:12]))
+        exit()
+
+    Keys = read_keys(sys.argv[3])
+    OutputDir = sys.argv[4]
+    WorkDir = tempfile.mkdtemp(prefix='g4_store_')
+    Missing = []
+    try:
+        for Job in sorted(Keys, key=int):
+            Key, Params = Keys[Job]
+            if Store.lookup(Key) is not None:
+                continue
+            Tarball = g4_tarball(OutputDir, Job, WorkDir)
+            if Tarball is None:
+                Missing.append(Job)
+                continue
+            print("Job %s: stored %s" % (Job, Store.add(Key, Params, Tarball)))
+    finally:
+        shutil.rmtree(WorkDir)
+    if Missing:
+        print("No Geant4 outputs for job(s) "+", ".join(Missing))
+        sys.exit(1)
@@ -0,0 +1,217 @@
+####################################
+## Local execution backend: runs the Slurm job scripts of the batch drivers
+## on this machine, with a pool of N workers, instead of submitting them.
+## Selected with the environment variable FAX_BACKEND:
+##   FAX_BACKEND=slurm (default)    sbatch/squeue
+##   FAX_BACKEND=local:<N>          N local workers (default: number of cpus)
+## The scripts run as they would under Slurm: #SBATCH --output/--error are
+## honored (%j, %A, %a), job arrays run task by task with their %N limit
+## and SLURM_ARRAY_TASK_ID, --cpus-per-task takes as many workers, and
+## --dependency=afterok/afterany/aftercorr between local jobs is respected
+## (a job whose afterok dependency failed is cancelled, as --kill-on-invalid-dep;
+## with aftercorr, each task waits for the task of the same id).
+## The submitting script waits for all its local jobs before exiting; jobs of
+## other processes are not seen, so begin_production.py runs MidwayBatch.py in
+## its own process to share one pool (and the dependencies) between them.
+##
+## ex.:
+##   FAX_BACKEND=local:16 python begin_production.py spec.json
+####################################
+import atexit
+import itertools
+import multiprocessing
+import os
+import re
+import subprocess
+import threading
+
+sbatch_re = re.compile(r'^#SBATCH\s+--([\w-]+)=(\S+)', re.MULTILINE)
+array_re = re.compile(r'^([\d,-]+)(?:%(\d+))?$')
+
+_backend = None
+
+
+def local_backend():
+    """The local backend if FAX_BACKEND selects it (one per process), else None"""
+    global _backend
+    setting = os.environ.get('FAX_BACKEND', 'slurm')
+    if not setting.startswith('local'):
+        return None
+    if _backend is None:
+        workers = setting.split(':')[1] if ':' in setting else ''
+        _backend = LocalBackend(int(workers) if workers else multiprocessing.cpu_count())
+        atexit.register(_backend.wait)
+    return _backend
+
+
+class LocalTask(object):
+    def __init__(self, job, index):
+        self.job = job
+        self.index = index
+        self.status = 'pending'
+        self.exit_code = None
+
+    @property
+    def name(self):
+        return self.job.job_id if self.index is None else '%s_%d' % (self.job.job_id, self.index)
+
+
+class LocalJob(object):
+    def __init__(self, job_id, submit_file, cwd, options, dependency):
+        self.job_id = job_id
+        self.submit_file = submit_file
+        self.cwd = cwd
+        self.options = options
+        self.dependency = dependency
+        match = array_re.match(options.get('array', ''))
+        if match:
+            ranges, max_running = match.groups()
+            self.tasks = []
+            for id_range in ranges.split(','):
+                first, _, last = id_range.partition('-')
+                self.tasks.extend(LocalTask(self, i) for i in range(int(first), int(last or first) + 1))
+            self.max_running = int(max_running) if max_running else len(self.tasks)
+        else:
+            self.tasks = [LocalTask(self, None)]
+            self.max_running = 1
+        self.cpus = int(options.get('cpus-per-task', 1))
+
+
+class LocalBackend(object):
+    """Pool of local workers running Slurm job scripts"""
+
+    def __init__(self, workers):
+        self.workers = max(1, workers)
+        self.free = self.workers
+        self.jobs = {}
+        self.condition = threading.Condition()
+        self.ids = itertools.count(1)
+        self.threads = [threading.Thread(target=self._worker) for _ in range(self.workers)]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def submit(self, submit_file, cwd=None, extra_args=()):
+        """Queue a job script, return its job id (like sbatch --parsable)"""
+        with open(submit_file) as fsubmit:
+            options = dict(sbatch_re.findall(fsubmit.read()))
+        dependency = None
+        for arg in extra_args:
+            if arg.startswith('--dependency='):
+                dependency = arg.split('=', 1)[1]
+        with self.condition:
+            # unique over the processes of a production (ids are kept in the state db)
+            job_id = '%d%04d' % (os.getpid(), next(self.ids))
+            self.jobs[job_id] = LocalJob(job_id, os.path.abspath(submit_file), cwd or os.getcwd(), options, dependency)
+            self.condition.notify_all()
+        return job_id
+
+    def active_job_ids(self):
+        """Jobs and array tasks (<job id>_<task>) not finished yet, as listed by squeue --array"""
+        with self.condition:
+            return set(task.name for job in self.jobs.values() for task in job.tasks
+                       if task.status in ('pending', 'running'))
+
+    def counts(self):
+        """(running, pending) tasks"""
+        with self.condition:
+            states = [task.status for job in self.jobs.values() for task in job.tasks]
+        return states.count('running'), states.count('pending')
+
+    def wait_for_change(self, timeout):
+        """Sleep until a task finishes or timeout (seconds) expires"""
+        with self.condition:
+            self.condition.wait(timeout)
+
+    def set_array_throttle(self, job_id, max_running):
+        """Change the %N limit of a local job array, as scontrol update ArrayTaskThrottle; 0 if done"""
+        with self.condition:
+            if job_id not in self.jobs:
+                return 1
+            self.jobs[job_id].max_running = max(1, max_running)
+            self.condition.notify_all()
+        return 0
+
+    def wait(self):
+        """Block until all jobs are over"""
+        with self.condition:
+            while any(task.status in ('pending', 'running') for job in self.jobs.values() for task in job.tasks):
+                self.condition.wait()
+
+    def _dependency_state(self, task):
+        """'ok' if the task can start, 'wait' if not yet, 'failed' if it never will"""
+        job = task.job
+        if not job.dependency:
+            return 'ok'
+        kind, ids = job.dependency.split(':', 1)
+        for name in ids.split(':'):
+            job_id, _, index = name.partition('_')
+            if job_id not in self.jobs:
+                # not a local job (e.g. from another process): assumed over
+                continue
+            if kind == 'aftercorr':
+                index = str(task.index)
+            tasks = [other for other in self.jobs[job_id].tasks if not index or str(other.index) == index]
+            if any(other.status in ('pending', 'running') for other in tasks):
+                return 'wait'
+            if kind in ('afterok', 'aftercorr') and any(other.exit_code != 0 for other in tasks):
+                return 'failed'
+        return 'ok'
+
+    def _next_task(self):
+        # called with the lock held: first task that can start, cancelling the ones that never will
+        for job in sorted(self.jobs.values(), key=lambda job: int(job.job_id)):
+            pending = [task for task in job.tasks if task.status == 'pending']
+            if not pending:
+                continue
+            ready = []
+            for task in pending:
+                state = self._dependency_state(task)
+                if state == 'failed':
+                    task.status, task.exit_code = 'cancelled', -1
+                    self.condition.notify_all()
+                elif state == 'ok':
+                    ready.append(task)
+            running = sum(1 for task in job.tasks if task.status == 'running')
+            if ready and running < job.max_running and self.free >= min(job.cpus, self.workers):
+                return ready[0]
+        return None
+
+    def _worker(self):
+        while True:
+            with self.condition:
+                task = self._next_task()
+                while task is None:
+                    self.condition.wait()
+                    task = self._next_task()
+                task.status = 'running'
+                cpus = min(task.job.cpus, self.workers)
+                self.free -= cpus
+            exit_code = self._run(task)
+            with self.condition:
+                task.status, task.exit_code = 'done', exit_code
+                self.free += cpus
+                self.condition.notify_all()
+
+    def _run(self, task):
+        job = task.job
+        index = '' if task.index is None else str(task.index)
+
+        def path(option, default):
+            value = job.options.get(option, default)
+            value = value.replace('%A', job.job_id).replace('%a', index).replace('%j', task.name)
+            return os.path.join(job.cwd, value)
+
+        env = dict(os.environ)
+        env.update({'SLURM_JOB_ID': task.name, 'SLURM_SUBMIT_DIR': job.cwd,
+                    'SLURM_CPUS_PER_TASK': str(job.cpus)})
+        if task.index is not None:
+            env.update({'SLURM_ARRAY_JOB_ID': job.job_id, 'SLURM_ARRAY_TASK_ID': index})
+        output = path('output', 'slurm-%j.out')
+        error = path('error', output)
+        with open(output, 'a') as fout:
+            if error == output:
+                return subprocess.call(['bash', job.submit_file], cwd=job.cwd, env=env, stdout=fout,
+                                       stderr=subprocess.STDOUT)
+            with open(error, 'a') as ferr:
+                return subprocess.call(['bash', job.submit_file], cwd=job.cwd, env=env, stdout=fout, stderr=ferr)
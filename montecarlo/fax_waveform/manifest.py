@@ -0,0 +1,138 @@
+####################################
+## Production manifest: append-only index of the files of a production
+## <production>/manifest.txt, one line per file:  <subrun> <stage> <kind> <path>
+## Jobs append their outputs when they finish (run_fax.sh, the reduce and
+## merge jobs), so routing the files to the stage directories, building the
+## file lists and pairing truth with processed files are lookups in the
+## index instead of directory scans. The last entry of a (subrun, kind) wins.
+##
+## kinds: truth_csv, truth_root, pax, basics, processed (other minitrees), reduced, merged
+##
+## Usage:
+##   python manifest.py add <manifest> <subrun> <stage> <kind>=<path> [<kind>=<path> ...]
+##        (subrun "-": the subrun number in the file names)
+##   python manifest.py route <production path> [<subrun> ...]  (default: all subruns)
+##   python manifest.py list <manifest> <kind> [--names]
+####################################
+import os
+import re
+import shutil
+import sys
+
+MANIFEST_FILE = 'manifest.txt'
+# kind -> stage directory (<stage>_<process name>) the file is routed to
+ROUTES = {'truth_csv': 'truth_minitrees', 'truth_root': 'truth_minitrees', 'pax': 'pax',
+          'basics': 'basics_minitrees', 'processed': 'processed_minitrees'}
+STAGE_DIRS = ['truth_minitrees', 'processed_minitrees', 'merged_minitrees', 'pax',
+              'reduced_minitrees', 'basics_minitrees']
+
+subrun_re = re.compile(r'_(\d{6})(_|\.|$)')
+
+
+def manifest_path(production_path):
+    return os.path.join(production_path, MANIFEST_FILE)
+
+
+def stage_dir(production_path, stage):
+    production_path = os.path.normpath(production_path)
+    return os.path.join(production_path, '%s_%s' % (stage, os.path.basename(production_path)))
+
+
+def subrun_of(filename):
+    """Subrun number (string) in a FakeWaveform_XENON1T_<subrun>... file name, None if absent"""
+    match = subrun_re.search(os.path.basename(filename))
+    return match.group(1) if match else None
+
+
+def append_entries(manifest, entries):
+    """Append (subrun, stage, kind, path) entries with a single write"""
+    text = ''.join('%s %s %s %s\n' % entry for entry in entries)
+    if not text:
+        return
+    fd = os.open(manifest, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, text.encode())
+    finally:
+        os.close(fd)
+
+
+def read_manifest(manifest):
+    """Current index: dict (subrun, kind) -> (stage, path), later entries replacing earlier ones"""
+    index = {}
+    if not os.path.exists(manifest):
+        return index
+    with open(manifest) as fmanifest:
+        for line in fmanifest:
+            fields = line.split(None, 3)
+            if len(fields) == 4:
+                index[(fields[0], fields[2])] = (fields[1], fields[3].rstrip('\n'))
+    return index
+
+
+def lookup(index, kind, subrun=None):
+    """Paths of a kind, as a dict subrun -> path (or the path of one subrun, None if absent)"""
+    if subrun is not None:
+        entry = index.get((subrun, kind))
+        return None if entry is None else entry[1]
+    return dict((key[0], entry[1]) for (key, entry) in index.items() if key[1] == kind)
+
+
+def route(production_path, subruns=None):
+    """Move the fax outputs of subruns to the stage directories, recording their new paths
+
+    :param subruns: list of subruns, default: all subruns of the manifest
+    :return: list of the new paths
+    """
+    manifest = manifest_path(production_path)
+    index = read_manifest(manifest)
+    for stage in STAGE_DIRS:
+        if not os.path.isdir(stage_dir(production_path, stage)):
+            os.makedirs(stage_dir(production_path, stage))
+    entries = []
+    for ((subrun, kind), (stage, path)) in sorted(index.items()):
+        if kind not in ROUTES or (subruns is not None and subrun not in subruns):
+            continue
+        destination = os.path.join(stage_dir(production_path, ROUTES[kind]), os.path.basename(path))
+        if path != destination and os.path.exists(path):
+            shutil.move(path, destination)
+            entries.append((subrun, 'sort', kind, destination))
+    append_entries(manifest, entries)
+    return [entry[3] for entry in entries]
+
+
+if __name__ == '__main__':
+    if len(sys.argv)<3 or sys.argv[1] not in ('add', 'route', 'list'):
+        print("========= Syntax ==========")
+        print("python manifest.py add <manifest> <subrun> <stage> <kind>=<path> [<kind>=<path> ...]")
+        print("python manifest.py route <production path> [<subrun> ...]")
+        print("python manifest.py list <manifest> <kind> [--names]")
+        exit()
+
+    if sys.argv[1]=='add':
+        # only the files that exist are recorded
+        Entries = []
+        for KindPath in sys.argv[5:]:
+            Kind, Path = KindPath.split('=', 1)
+            if os.path.exists(Path):
+                Subrun = subrun_of(Path) if sys.argv[3]=='-' else sys.argv[3]
+                Entries.append((Subrun, sys.argv[4], Kind, os.path.abspath(Path)))
+        append_entries(sys.argv[2], Entries)
+    elif sys.argv[1]=='route':
+        ProductionPath = sys.argv[2]
+        Subruns = sys.argv[3:] or None
+        for filename in route(ProductionPath, Subruns):
+            print("moved to "+filename)
+        # a subrun without processed file stops its stage chain
+        Index = read_manifest(manifest_path(ProductionPath))
+        for Subrun in Subruns or []:
+            if lookup(Index, 'pax', Subrun) is None and lookup(Index, 'basics', Subrun) is None:
+                print("No processed file for subrun "+Subrun)
+                sys.exit(1)
+    else:
+        # e.g. the file list of BatchReduceDataSubmission.py: list <manifest> pax --names
+        Paths = lookup(read_manifest(sys.argv[2]), sys.argv[3])
+        for Subrun in sorted(Paths):
+            if '--names' in sys.argv[4:]:
+                print(os.path.basename(Paths[Subrun]).split('.')[0])
+            else:
+                print(Paths[Subrun])
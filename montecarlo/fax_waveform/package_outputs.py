@@ -0,0 +1,276 @@
+####################################
+## Output packaging of the grid jobs (run_sim.sh)
+## Packs the products of an output directory selected by an output profile
+## into one tarball, with a SHA256SUMS member (`sha256sum -c` format) holding
+## the checksum of every file packed.
+## The archive is a single bz2/gzip/xz stream (readable by tar, bzip2/gzip/xz
+## and tarfile, also in stream mode and under Python 2). With more than one
+## cpu for the job (OMP_NUM_THREADS, set by HTCondor from request_cpus, or
+## SLURM_CPUS_PER_TASK), the tar stream is piped through a parallel compressor
+## of the PATH writing such a stream (PARALLEL_COMPRESSORS: lbzip2, pigz,
+## xz -T; not pbzip2, whose output is several concatenated streams). Otherwise
+## it is compressed in a thread of its own while the products are read and
+## hashed: the reading and checksums no longer wait for the compression.
+##
+## Output profiles (PROFILES): shell patterns of the products to keep
+##   all        : everything (default, as the former `tar cvjf *`)
+##   processed  : pax output, minitrees, truth, lax, logs and metrics (no G4/nSort/Patch, no raw data)
+##   minitrees  : as processed, without the pax output
+##   g4         : Geant4, nSort and Patch outputs and logs (see g4_store.py)
+##
+## Usage:
+##   python package_outputs.py <archive> <directory> [<profile> [<codec>[:<level>]]]
+##   (codecs: bz2 (default, level 9), gz, xz, none)
+####################################
+from __future__ import print_function
+
+import bz2
+import fnmatch
+import hashlib
+import io
+import os
+import subprocess
+import sys
+import tarfile
+import threading
+import zlib
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+CHECKSUM_FILE = 'SHA256SUMS'
+BLOCK_SIZE = 1024*1024
+QUEUE_BLOCKS = 8
+
+MINITREES = ['*_pax_*.root', '*_pax_*.pklz', '*_pax_*.hdf5', '*_pax_*.parquet', '*_faxtruth_sort*', '*_lax*',
+             '*.log', '*_metrics.jsonl']
+PROFILES = {'all': ['*'],
+            'processed': MINITREES + ['*_pax.root'],
+            'minitrees': MINITREES,
+            # the products of fax and later stages are named after their input (..._g4mc_<flavor>_Sort_pax...)
+            'g4': ['*_g4mc_G4.*', '*_g4mc_G4p10.*', '*_g4mc_NEST.*', '*_g4mc_*_Sort.*', '*_g4mc_*_Patch.*']}
+
+
+class NoCompression(object):
+
+    def compress(self, data):
+        return data
+
+    def flush(self):
+        return b''
+
+
+# codec -> (incremental compressor of a level, default level)
+CODECS = {'bz2': (lambda level: bz2.BZ2Compressor(level), 9),
+          'gz': (lambda level: zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS), 6),
+          'none': (lambda level: NoCompression(), 0)}
+if lzma is not None:
+    CODECS['xz'] = (lambda level: lzma.LZMACompressor(preset=level), 6)
+
+# codec -> command of a parallel compressor (stdin to stdout) with a number of threads
+PARALLEL_COMPRESSORS = {'bz2': lambda threads: ['lbzip2', '-n', str(threads)],
+                        'gz': lambda threads: ['pigz', '-p', str(threads)],
+                        'xz': lambda threads: ['xz', '-T', str(threads)]}
+
+
+def parse_codec(spec):
+    """'bz2', 'gz:1', ... -> (codec, level)"""
+    codec, _, level = spec.partition(':')
+    if codec not in CODECS:
+        raise ValueError("Unknown codec %s (%s)" % (codec, ', '.join(sorted(CODECS))))
+    return codec, int(level) if level else CODECS[codec][1]
+
+
+class StreamCompressor(object):
+    """Write-only file compressing its input as one stream in a thread of its own
+    (bz2, zlib and lzma release the GIL), with at most QUEUE_BLOCKS blocks waiting in memory"""
+
+    def __init__(self, path, codec, level, block_size=BLOCK_SIZE):
+        self.output = open(path, 'wb')
+        self.compressor = CODECS[codec][0](level)
+        self.block_size = block_size
+        self.blocks = queue.Queue(QUEUE_BLOCKS)
+        self.error = None
+        self.buffer = []
+        self.buffered = 0
+        self.thread = threading.Thread(target=self.compress)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def compress(self):
+        while True:
+            block = self.blocks.get()
+            if block is None:
+                break
+            if self.error is None:
+                try:
+                    self.output.write(self.compressor.compress(block))
+                except Exception as error:
+                    # e.g. disk full: raised in the writing thread, the blocks left are dropped
+                    self.error = error
+        if self.error is None:
+            try:
+                self.output.write(self.compressor.flush())
+            except Exception as error:
+                self.error = error
+
+    def write(self, data):
+        if self.error is not None:
+            raise self.error
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.buffered >= self.block_size:
+            self.submit()
+
+    def submit(self):
+        self.blocks.put(b''.join(self.buffer))
+        self.buffer = []
+        self.buffered = 0
+
+    def close(self):
+        if self.buffered:
+            self.submit()
+        self.blocks.put(None)
+        self.thread.join()
+        self.output.close()
+        if self.error is not None:
+            raise self.error
+
+
+class ExternalCompressor(object):
+    """Write-only file piping its input to a compressor command writing the archive"""
+
+    def __init__(self, path, command):
+        self.command = command
+        with open(path, 'wb') as output:
+            self.process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=output)
+
+    def write(self, data):
+        self.process.stdin.write(data)
+
+    def close(self):
+        try:
+            self.process.stdin.close()
+        except IOError:
+            # the compressor died, its exit code tells
+            pass
+        if self.process.wait() != 0:
+            raise IOError("%s exited with %d" % (self.command[0], self.process.returncode))
+
+
+def find_executable(name):
+    for directory in os.environ.get('PATH', '').split(os.pathsep):
+        path = os.path.join(directory, name)
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            return path
+    return None
+
+
+def compression_threads():
+    """Cpus of the job, 1 if not known (the node may be shared)"""
+    for name in ('OMP_NUM_THREADS', 'SLURM_CPUS_PER_TASK'):
+        if os.environ.get(name, '').isdigit():
+            return max(1, int(os.environ[name]))
+    return 1
+
+
+def open_archive(path, codec, level, threads=None):
+    """Parallel compressor of the codec if there are threads for it and it is installed, else the
+    compression thread"""
+    threads = compression_threads() if threads is None else threads
+    if threads > 1 and codec in PARALLEL_COMPRESSORS:
+        command = PARALLEL_COMPRESSORS[codec](threads)
+        executable = find_executable(command[0])
+        if executable is not None:
+            return ExternalCompressor(path, [executable] + command[1:] + ['-c', '-%d' % level])
+    return StreamCompressor(path, codec, level)
+
+
+class HashingReader(object):
+    """File read by tarfile, computing its checksum on the way"""
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.hash = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.hash.update(data)
+        return data
+
+
+def select_files(directory, profile, exclude=()):
+    """Names (relative to the directory) of the products of a profile, with the content of the
+    selected directories (e.g. raw data)"""
+    patterns = PROFILES[profile]
+    names = []
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        if os.path.abspath(path) in exclude or not any(fnmatch.fnmatch(name, pattern) for pattern in patterns):
+            continue
+        names.append(name)
+        if os.path.isdir(path) and not os.path.islink(path):
+            for (dirpath, dirnames, filenames) in os.walk(path):
+                dirnames.sort()
+                for entry in dirnames + sorted(filenames):
+                    names.append(os.path.relpath(os.path.join(dirpath, entry), directory))
+    return names
+
+
+def package(archive, directory, profile='all', codec='bz2', level=None, threads=None):
+    """Pack the products of a profile with their checksums
+
+    :param threads: threads of the compression (default: cpus of the job)
+
+    :return: list of (name, sha256) of the files packed
+    """
+    level = CODECS[codec][1] if level is None else level
+    names = select_files(directory, profile, exclude=[os.path.abspath(archive)])
+    output = open_archive(archive, codec, level, threads)
+    checksums = []
+    try:
+        tar = tarfile.open(fileobj=output, mode='w|')
+        for name in names:
+            print(name)
+            info = tar.gettarinfo(os.path.join(directory, name), arcname=name)
+            if not info.isfile():
+                tar.addfile(info)
+                continue
+            with open(os.path.join(directory, name), 'rb') as fproduct:
+                reader = HashingReader(fproduct)
+                tar.addfile(info, reader)
+            checksums.append((name, reader.hash.hexdigest()))
+        manifest = ''.join('%s  %s\n' % (checksum, name) for (name, checksum) in checksums).encode()
+        info = tarfile.TarInfo(CHECKSUM_FILE)
+        info.size = len(manifest)
+        tar.addfile(info, io.BytesIO(manifest))
+        tar.close()
+    finally:
+        output.close()
+    return checksums
+
+
+if __name__ == '__main__':
+    if len(sys.argv)<3:
+        print("========= Syntax ==========")
+        print("python package_outputs.py <archive> <directory> [<profile> [<codec>[:<level>]]]")
+        print("(profiles: %s; codecs: %s)" % (', '.join(sorted(PROFILES)), ', '.join(sorted(CODECS))))
+        exit()
+
+    Archive = sys.argv[1]
+    Directory = sys.argv[2]
+    Profile = sys.argv[3] if len(sys.argv)>3 else 'all'
+    Codec, Level = parse_codec(sys.argv[4] if len(sys.argv)>4 else 'bz2')
+    if Profile not in PROFILES:
+        print("Unknown profile "+Profile)
+        sys.exit(1)
+
+    Checksums = package(Archive, Directory, Profile, Codec, Level)
+    print("Packed %d files (profile %s, %s level %d) into %s" % (len(Checksums), Profile, Codec, Level, Archive))
@@ -0,0 +1,96 @@
+####################################
+## One MaxNumJob budget shared by concurrent productions (begin_production.py)
+## The budget of a partition (64 jobs on public nodes, 200 otherwise, as in
+## the batch scripts) is split between the productions running on it in
+## proportion to their priority. Every production submits its fax jobs with
+## its share as the job array %N limit; while they run, the shares are
+## recomputed over the productions that still have fax jobs left (or
+## failed ones to resubmit) at every poll of begin_production.py and
+## applied with `scontrol update ArrayTaskThrottle`, so the budget of a
+## finished production goes to the others.
+####################################
+import os
+import subprocess
+
+from production_state import ProductionState, state_path
+from local_backend import local_backend
+
+MAX_JOBS = {'0': 200, '1': 64, '2': 200}
+
+
+def share_budget(priorities, max_jobs):
+    """Split max_jobs between names in proportion to their priority (largest remainder)
+
+    :param priorities: dict name -> priority (> 0)
+    :return: dict name -> number of jobs, at least 1 each, max_jobs in total (unless there are more names)
+    """
+    if not priorities:
+        return {}
+    total = float(sum(priorities.values()))
+    exact = dict((name, max_jobs*priority/total) for (name, priority) in priorities.items())
+    shares = dict((name, int(value)) for (name, value) in exact.items())
+    left = max_jobs - sum(shares.values())
+    for name in sorted(exact, key=lambda name: shares[name] - exact[name])[:max(0, left)]:
+        shares[name] += 1
+    shares = dict((name, max(1, share)) for (name, share) in shares.items())
+    # the jobs given to the shares raised to 1 are taken from the largest ones
+    for _ in range(sum(shares.values()) - max_jobs):
+        name = max(sorted(shares), key=lambda name: shares[name])
+        if shares[name] == 1:
+            break
+        shares[name] -= 1
+    return shares
+
+
+def partition_budgets(process_list, max_jobs=None):
+    """Share of every process (by process_name) of the budget of its partition"""
+    max_jobs = max_jobs or MAX_JOBS
+    shares = {}
+    for nodetype in set(process['nodetype'] for process in process_list):
+        priorities = dict((process['process_name'], float(process.get('priority', 1)))
+                          for process in process_list if process['nodetype'] == nodetype)
+        shares.update(share_budget(priorities, int(max_jobs[nodetype])))
+    return shares
+
+
+def fax_arrays_left(production_path, active_jobs):
+    """Ids of the fax job arrays of a production that still have subruns in the queue"""
+    state = ProductionState(state_path(production_path))
+    return sorted(set(state.get('fax', unit)['job_id'].split('_')[0] for unit in state.units('fax', 'submitted')
+                      if state.is_running('fax', unit, active_jobs)))
+
+
+def set_array_throttle(array_id, max_running):
+    backend = local_backend()
+    if backend is not None:
+        return backend.set_array_throttle(array_id, max_running)
+    return subprocess.call(['scontrol', 'update', 'JobId=%s' % array_id, 'ArrayTaskThrottle=%d' % max_running])
+
+
+def rebalance(process_list, head_dirname, active_jobs, max_jobs=None, resubmitted=()):
+    """One rebalancing of the budget over the productions that still have fax jobs in the queue
+    (or that are about to resubmit some), applied to their fax arrays
+
+    :param resubmitted: names of the processes about to resubmit failed units
+    :return: dict process name -> current share of those productions
+    """
+    max_jobs = max_jobs or MAX_JOBS
+    arrays = {}
+    running = []
+    for process in process_list:
+        name = process['process_name']
+        arrays[name] = fax_arrays_left(os.path.join(head_dirname, name), active_jobs)
+        if arrays[name] or name in resubmitted:
+            running.append(process)
+    shares = partition_budgets(running, max_jobs)
+    for process in running:
+        name = process['process_name']
+        if not arrays[name]:
+            continue
+        # a production split into several arrays shares its budget between them;
+        # multi-core fax jobs count for their number of cores
+        share = max(1, shares[name] // len(arrays[name]) // int(process.get('cores', 1)))
+        for array_id in arrays[name]:
+            set_array_throttle(array_id, share)
+        print('%s: %d fax array(s) left, %d running jobs allowed each' % (name, len(arrays[name]), share))
+    return shares
@@ -0,0 +1,281 @@
+####################################
+## Per-subrun stage chains for begin_production.py
+## Every subrun of a production is a chain  fax -> sort -> reduce -> merge,
+## each stage of a subrun depending only on the previous stage of the same
+## subrun, so the stages of different subruns overlap instead of waiting for
+## the slowest fax job of the production. A stage is submitted as job arrays
+## whose %N limit is the job budget of the production (64 jobs on public
+## nodes, 200 otherwise): the subruns waiting for tasks of one array of the
+## previous stage keep their task ids (--dependency=aftercorr), the subruns
+## waiting for another job are grouped by that job. A multi-core fax job runs
+## several subruns and fails if any of them does: the subruns waiting for it
+## start once it is over (afterany), each task first checking that the fax
+## stage of its own subrun is done in the state database.
+## The sort step routes the outputs of the subrun to the stage directories
+## (manifest.py route, from the outputs run_fax.sh recorded in the production
+## manifest) and is the first command of the job after fax; it fails when fax
+## left no processed file, which cancels the rest of the chain. The reduce and
+## merge jobs record their outputs in the manifest as well.
+## MergePickles.py runs once all merge jobs are over.
+##
+## The fax job ids are read from the production state database (MidwayBatch.py);
+## stages already done or still in the queue are not submitted again, and
+## every stage job records its result in the result file of its unit,
+## folded into the database on the next submission (production_state.py)
+####################################
+import collections
+import getpass
+import os
+import time
+
+from slurm_submit import render_submit_script, render_array_script, write_file, make_dir, sbatch, PAX_ENV, \
+    MAX_ARRAY_SIZE
+from production_state import ProductionState, state_path, active_job_ids, recorded_commands, done_check_command
+from production_budget import MAX_JOBS
+from manifest import manifest_path, stage_dir
+from runtime_history import time_limit, params_key
+from retry_policy import retry_plan, combine_args
+from stage_worker import python_stage, worker_session
+
+EXE_PATH = os.path.dirname(os.path.abspath(__file__))
+CONFIGS = {'0': 'basics_config', '1': 's1s2_preserve_all', '2': 'PeakEfficiency'}
+REDUCE_EXE = {'1': ('ReduceDataNormal.py', 'S1S2Properties'), '2': ('reduce_peak_level.py', 'PeakEfficiency')}
+
+
+def reduced_file(production_path, subrun, minitree_type):
+    return os.path.join(stage_dir(production_path, 'reduced_minitrees'),
+                        'FakeWaveform_XENON1T_%s_pax_%s.root' % (subrun, REDUCE_EXE[minitree_type][1]))
+
+
+def merged_file(production_path, subrun):
+    return os.path.join(stage_dir(production_path, 'merged_minitrees'), 'FakeWaveform_XENON1T_%s_merged.pkl' % subrun)
+
+
+def basics_file(production_path, subrun):
+    return os.path.join(stage_dir(production_path, 'basics_minitrees'), 'FakeWaveform_XENON1T_%s_pax_Basics.root' % subrun)
+
+
+def manifest_command(production_path, subrun, stage, kind, path):
+    return 'python %s add %s %s %s %s=%s' % (os.path.join(EXE_PATH, 'manifest.py'), manifest_path(production_path),
+                                             subrun, stage, kind, path)
+
+
+def reduce_commands(production_path, subrun, minitree_type, work_path):
+    exe, suffix = REDUCE_EXE[minitree_type]
+    dataset = 'FakeWaveform_XENON1T_%s_pax' % subrun
+    return ['cd ' + work_path,
+            'python %s %s %s' % (os.path.join(EXE_PATH, exe), dataset, stage_dir(production_path, 'pax')),
+            'mv %s/%s_%s.root %s' % (work_path, dataset, suffix, stage_dir(production_path, 'reduced_minitrees')),
+            manifest_command(production_path, subrun, 'reduce', 'reduced',
+                             reduced_file(production_path, subrun, minitree_type))]
+
+
+def merge_commands(production_path, subrun, process, work_path):
+    """TruthSorting + MergeTruthAndProcessed of one subrun, as in BatchMergeTruthAndProcessed.py"""
+    if process['minitree_type'] == '0':
+        processed_root = basics_file(production_path, subrun)
+    else:
+        processed_root = reduced_file(production_path, subrun, process['minitree_type'])
+    truth_csv = os.path.join(stage_dir(production_path, 'truth_minitrees'),
+                             'FakeWaveform_XENON1T_%s_truth.csv' % subrun)
+    tmp_pkl = os.path.join(work_path, 'FakeWaveform_XENON1T_%s_tmp.pkl' % subrun)
+    merged_pkl = merged_file(production_path, subrun)
+    config = os.path.join(EXE_PATH, 'Configs', CONFIGS[process['minitree_type']])
+    if process['use_array_truth'] == '1':
+        commands = [python_stage(os.path.join(EXE_PATH, 'TruthSorting_arrays.py'),
+                                 '%s %s 0 %s' % (truth_csv, tmp_pkl, process.get('save_ap_truth', '0')))]
+    else:
+        commands = [python_stage(os.path.join(EXE_PATH, 'TruthSorting.py'), '%s %s' % (truth_csv, tmp_pkl))]
+    merge_exe = 'MergeTruthAndProcessed_peaks.py' if process['minitree_type'] == '2' else 'MergeTruthAndProcessed.py'
+    commands.append(python_stage(os.path.join(EXE_PATH, merge_exe),
+                                 '%s %s %s %s' % (config, tmp_pkl, processed_root, merged_pkl)))
+    commands.append('rm -f ' + tmp_pkl)
+    commands.append(manifest_command(production_path, subrun, 'merge', 'merged', merged_pkl))
+    return commands
+
+
+def submit_stage(state, stage, unit, commands, outputs, submit_path, limit, node_type, dependency, params=None):
+    """Submit one stage job recording its result (and its runtime under params) in the state database;
+    it is cancelled by Slurm if its dependency fails. A failed unit is resubmitted by the retry policy
+
+    :return: job id (None if sbatch failed or the unit is given up)
+    """
+    name = '%s_%s' % (stage, unit)
+    submit_file = os.path.join(submit_path, name + '.sh')
+    output = os.path.join(submit_path, name + '.log')
+    retry_args = retry_plan(state, stage, unit, [output])
+    if retry_args is None:
+        return None
+    commands = recorded_commands(commands, state_path(os.path.dirname(submit_path)), stage, unit, outputs, params)
+    write_file(submit_file, render_submit_script(commands, output, output, limit, node_type, setup=PAX_ENV))
+    extra_args = ['--kill-on-invalid-dep=yes'] + retry_args
+    if dependency:
+        extra_args.append('--dependency=' + dependency)
+    job_id = sbatch(submit_file, cwd=submit_path, extra_args=extra_args)
+    if job_id is not None:
+        state.submitted(stage, unit, job_id)
+    return job_id
+
+
+def stage_arrays(tasks):
+    """Job arrays of a stage
+
+    :param tasks: list of (subrun, job id of the previous stage of the subrun, '' if done)
+    :return: list of (dependency, dict task id -> subrun)
+    """
+    shared = collections.Counter(job for (_, job) in tasks if job)
+    groups = collections.OrderedDict()
+    for (subrun, job) in tasks:
+        array_id, _, task_id = job.partition('_')
+        if task_id and shared[job] == 1:
+            # one subrun per task of the previous array: the task of the same id waits for it
+            groups.setdefault('aftercorr:' + array_id, []).append((int(task_id), subrun))
+        elif shared[job] > 1:
+            # a job running several subruns: its exit code is not the one of each subrun
+            groups.setdefault('afterany:' + job, []).append((None, subrun))
+        else:
+            groups.setdefault('afterok:' + job if job else '', []).append((None, subrun))
+    arrays = []
+    for (dependency, entries) in groups.items():
+        if entries[0][0] is not None:
+            arrays.append((dependency, dict(entries)))
+            continue
+        for offset in range(0, len(entries), MAX_ARRAY_SIZE):
+            arrays.append((dependency, dict(enumerate(subrun for (_, subrun) in entries[offset:offset+MAX_ARRAY_SIZE]))))
+    return arrays
+
+
+def submit_stage_arrays(state, stage, previous_stage, tasks, commands, outputs, submit_path, limit, node_type,
+                        max_running, params=None):
+    """Submit one stage of several subruns as job arrays, every task recording the result of its subrun
+    (and its runtime under params) in the state database; a task is cancelled by Slurm if the stage it
+    waits for fails. Failed subruns are resubmitted by the retry policy
+
+    :param previous_stage: stage the subruns wait for
+    :param tasks: list of (subrun, job id of the previous stage of the subrun, '' if done)
+    :param commands: command lines, $1 being the subrun
+    :param outputs: outputs of a subrun, $1 being the subrun
+    :param max_running: maximum number of running tasks over all the arrays of the stage
+    :return: dict subrun -> job id of its task (<array id>_<task id>), without the subruns given up or
+             whose array failed to submit
+    """
+    retry_args = {}
+    for (subrun, _) in tasks:
+        args = retry_plan(state, stage, subrun, [os.path.join(submit_path, '%s_%s.log' % (stage, subrun))])
+        if args is not None:
+            retry_args[subrun] = args
+    arrays = stage_arrays([(subrun, job) for (subrun, job) in tasks if subrun in retry_args])
+    path = state_path(os.path.dirname(submit_path))
+    commands = recorded_commands(commands, path, stage, '$1', outputs, params)
+    # parameter files are read when the tasks start: a resubmission does not overwrite them
+    name = '%s_%d' % (stage, int(time.time()))
+    job_ids = {}
+    for (i, (dependency, subruns)) in enumerate(arrays):
+        param_file = os.path.join(submit_path, '%s_%d_params.txt' % (name, i))
+        write_file(param_file, ''.join('%s\n' % subruns.get(task_id, '-') for task_id in range(max(subruns) + 1)))
+        submit_file = os.path.join(submit_path, '%s_%d.sh' % (name, i))
+        output = os.path.join(submit_path, '%s_%%A_%%a.txt' % name)
+        # after a multi-core job, a subrun whose previous stage failed ends without recording
+        # a failure, as if cancelled with its dependency
+        check = [done_check_command(path, previous_stage, '$1')] if dependency.startswith('afterany:') else []
+        write_file(submit_file, render_array_script(check + commands, param_file, 0, len(subruns),
+                                                    max(1, max_running // len(arrays)), output, output, limit,
+                                                    node_type, log=os.path.join(submit_path, stage + '_$1.log'),
+                                                    setup=PAX_ENV, task_ids=sorted(subruns)))
+        extra_args = ['--kill-on-invalid-dep=yes'] + combine_args(retry_args[subrun] for subrun in subruns.values())
+        if dependency:
+            extra_args.append('--dependency=' + dependency)
+        array_id = sbatch(submit_file, cwd=submit_path, extra_args=extra_args)
+        print("Submitted %s (%d subrun(s)%s): %s" % (submit_file, len(subruns),
+                                                   ', ' + dependency if dependency else '', array_id))
+        if array_id is None:
+            continue
+        for (task_id, subrun) in subruns.items():
+            job_ids[subrun] = '%s_%d' % (array_id, task_id)
+            state.submitted(stage, subrun, job_ids[subrun])
+    return job_ids
+
+
+def previous_job(state, stage, unit, active_jobs):
+    """Job a later stage of a unit waits for: '' if the stage is done, its job id if in the queue,
+    None if it has to run again"""
+    if state.is_done(stage, unit):
+        return ''
+    if state.is_running(stage, unit, active_jobs):
+        return state.get(stage, unit)['job_id']
+    return None
+
+
+def give_up_chain(state, subrun):
+    """The stages after a given up stage of a subrun will never run: give up on them too"""
+    given_up = False
+    for stage in ('fax', 'reduce', 'merge'):
+        given_up = given_up or state.is_given_up(stage, subrun)
+        if given_up and state.get(stage, subrun) is not None and not state.is_given_up(stage, subrun):
+            state.give_up(stage, subrun)
+
+
+def submit_stage_chains(state, process, production_path, submit_path, active_jobs):
+    """Submit the stages after fax of every subrun that are neither done nor in the queue
+
+    :return: dict subrun -> job id of its merge ('' if done), without the subruns whose chain is broken
+    """
+    budget = int(process.get('max_jobs') or MAX_JOBS[str(process['nodetype'])])
+    previous = {}
+    for subrun in state.units('fax'):
+        job = previous_job(state, 'fax', subrun, active_jobs)
+        if job is not None:
+            previous[subrun] = job
+    sort = 'python %s route %s $1' % (os.path.join(EXE_PATH, 'manifest.py'), production_path)
+    work_path = os.path.join(submit_path, '$1')
+    stages = []
+    previous_stage = 'fax'
+    if process['minitree_type'] != '0':
+        # same parameter sets as BatchReduceDataSubmission.py/BatchMergeTruthAndProcessed.py
+        params = params_key(process['nodetype'], process['minitree_type'])
+        stages.append(('reduce', [sort] + reduce_commands(production_path, '$1', process['minitree_type'], work_path),
+                       [reduced_file(production_path, '$1', process['minitree_type'])],
+                       time_limit('reduce', params, '04:59:00'), params))
+        sort = None
+    params = params_key(process['nodetype'], process['minitree_type'], process['use_array_truth'])
+    stages.append(('merge', ([sort] if sort else []) + worker_session() + merge_commands(production_path, '$1', process,
+                                                                                          work_path),
+                   [merged_file(production_path, '$1')], time_limit('merge', params, '00:05:00'), params))
+    for (stage, commands, outputs, limit, params) in stages:
+        done = {}
+        tasks = []
+        for (subrun, job) in sorted(previous.items()):
+            done[subrun] = previous_job(state, stage, subrun, active_jobs)
+            if done[subrun] is None:
+                make_dir(os.path.join(submit_path, subrun))
+                tasks.append((subrun, job))
+        done = dict((subrun, job) for (subrun, job) in done.items() if job is not None)
+        done.update(submit_stage_arrays(state, stage, previous_stage, tasks, commands, outputs, submit_path, limit,
+                                        process['nodetype'], budget, params))
+        previous, previous_stage = done, stage
+    return previous
+
+
+def submit_production_dag(process, production_path):
+    """Submit the stage chains of all the fax subruns of a production, then MergePickles.py
+
+    :return: job id of the MergePickles.py job (None if nothing was left to do)
+    """
+    submit_path = os.path.join(production_path, 'submit')
+    make_dir(submit_path)
+    state = ProductionState(state_path(production_path))
+    active_jobs = active_job_ids(getpass.getuser())
+    merged = submit_stage_chains(state, process, production_path, submit_path, active_jobs)
+    for subrun in state.units('fax'):
+        give_up_chain(state, subrun)
+        print("Subrun %s: %s" % (subrun, 'not submitted (a stage to redo or given up)' if subrun not in merged
+                                 else merged[subrun] or 'done'))
+    merge_arrays = sorted(set(job.split('_')[0] for job in merged.values() if job))
+    if not merge_arrays and (state.is_done('merge_pickles', 'all') or
+                             state.is_running('merge_pickles', 'all', active_jobs)):
+        return None
+    # the merged pickle of the production, over the subruns that went through
+    merged_path = stage_dir(production_path, 'merged_minitrees')
+    command = 'python %s %s' % (os.path.join(EXE_PATH, 'MergePickles.py'), merged_path)
+    return submit_stage(state, 'merge_pickles', 'all', [command], [], submit_path, '00:59:00', process['nodetype'],
+                        'afterany:' + ':'.join(merge_arrays) if merge_arrays else None)
@@ -0,0 +1,266 @@
+####################################
+## Production state database (SQLite, <production>/production_state.db)
+## One row per (stage, unit), e.g. (fax, 000012) or (reduce, FakeWaveform_XENON1T_000012_pax),
+## with the job id, status (submitted, done, failed), exit code and outputs.
+## The batch drivers only submit the units that are neither done nor still
+## in the queue, so a production can be restarted after any failure.
+## Jobs record their own result with the `record` command below: the unit is
+## done if the commands exited with 0 and all the given outputs exist.
+## The jobs never open the database (SQLite locking is not reliable on the
+## network filesystem of the productions): they append their result to the
+## file of their unit, <production>/results/<stage>_<unit>.jsonl, with
+## O_APPEND as the manifest (manifest.py), and the drivers opening the state
+## (MidwayBatch.py, begin_production.py, ...) fold the new lines into it.
+## Every failure is also kept with its exit code and host, for the retry
+## policy (retry_policy.py), which may set a unit to given_up.
+##
+## Usage:
+##   python production_state.py record <state db> <stage> <unit> <exit code> [<output> ...]
+##   python production_state.py done <state db> <stage> <unit>   (exits with 1 unless done, from the result file)
+##   python production_state.py show <state db>
+####################################
+import json
+import os
+import socket
+import sqlite3
+import subprocess
+import sys
+import time
+
+from local_backend import local_backend
+from runtime_history import timed_commands
+
+STATE_EXE = os.path.abspath(__file__)
+STATE_FILE = 'production_state.db'
+RESULTS_DIR = 'results'
+
+
+def state_path(production_path):
+    return os.path.join(production_path, STATE_FILE)
+
+
+def results_dir(path):
+    """Directory of the result files of the units of a state db"""
+    return os.path.join(os.path.dirname(os.path.abspath(path)), RESULTS_DIR)
+
+
+def result_file(path, stage, unit):
+    return os.path.join(results_dir(path), '%s_%s.jsonl' % (stage, unit))
+
+
+def write_result(path, stage, unit, exit_code, outputs=()):
+    """Append the result of a unit (run by a job) to its result file with a single write
+
+    :return: the status, done if exit_code is 0 and all outputs exist
+    """
+    status = 'done' if exit_code == 0 and all(os.path.exists(o) for o in outputs) else 'failed'
+    # recorded on the node the job ran on
+    result = {'stage': stage, 'unit': unit, 'status': status, 'exit_code': exit_code, 'outputs': list(outputs),
+              'host': socket.gethostname().split('.')[0], 'updated': time.time()}
+    fd = os.open(result_file(path, stage, unit), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, (json.dumps(result, sort_keys=True) + '\n').encode())
+    finally:
+        os.close(fd)
+    return status
+
+
+def read_results(filename, offset=0):
+    """Results of a result file from a byte offset, only complete lines
+
+    :return: (list of results, offset after the last complete line)
+    """
+    with open(filename, 'rb') as fresults:
+        fresults.seek(offset)
+        data = fresults.read()
+    data = data[:data.rfind(b'\n') + 1]
+    return [json.loads(line) for line in data.decode().splitlines() if line], offset + len(data)
+
+
+def last_status(path, stage, unit):
+    """Status of the last result of a unit from its result file, None if it has none"""
+    filename = result_file(path, stage, unit)
+    results = read_results(filename)[0] if os.path.exists(filename) else []
+    return results[-1]['status'] if results else None
+
+
+def active_job_ids(user):
+    """Ids of the jobs (and array tasks, <array id>_<task>) of a user still in the queue, None if squeue failed"""
+    backend = local_backend()
+    if backend is not None:
+        return backend.active_job_ids()
+    try:
+        output = subprocess.check_output(['squeue', '--noheader', '--array', '--user=' + user, '--format=%i'])
+    except (subprocess.CalledProcessError, OSError):
+        return None
+    return set(output.decode().split())
+
+
+class ProductionState(object):
+    """SQLite store of the stage status of every unit of a production"""
+
+    def __init__(self, path):
+        # the database may be opened by several drivers at once: wait for the lock
+        self.path = path
+        self.connection = sqlite3.connect(path, timeout=600)
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS units (stage TEXT, unit TEXT, job_id TEXT, '
+                                    'status TEXT, exit_code INTEGER, outputs TEXT, updated REAL, '
+                                    'PRIMARY KEY (stage, unit))')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS failures (stage TEXT, unit TEXT, exit_code INTEGER, '
+                                    'host TEXT, updated REAL)')
+            # bytes of every result file already folded into the units
+            self.connection.execute('CREATE TABLE IF NOT EXISTS folded (name TEXT PRIMARY KEY, offset INTEGER)')
+        if not os.path.isdir(results_dir(path)):
+            os.makedirs(results_dir(path))
+        self.fold_results()
+
+    def fold_results(self):
+        """Fold the results appended by the jobs since the last call"""
+        folded = dict(self.connection.execute('SELECT name, offset FROM folded'))
+        directory = results_dir(self.path)
+        names = [name for name in sorted(os.listdir(directory))
+                 if os.path.getsize(os.path.join(directory, name)) > folded.get(name, 0)]
+        if not names:
+            return
+        with self.connection:
+            for name in names:
+                # the write starts the transaction: another driver folding at the same time waits for it,
+                # then sees the new offset
+                self.connection.execute('INSERT OR IGNORE INTO folded VALUES (?, 0)', (name,))
+                offset = self.connection.execute('SELECT offset FROM folded WHERE name=?', (name,)).fetchone()[0]
+                results, offset = read_results(os.path.join(directory, name), offset)
+                for result in results:
+                    self.apply_result(result)
+                self.connection.execute('UPDATE folded SET offset=? WHERE name=?', (offset, name))
+
+    def get_meta(self, key, default=None):
+        row = self.connection.execute('SELECT value FROM meta WHERE key=?', (key,)).fetchone()
+        return default if row is None else row[0]
+
+    def set_meta(self, key, value):
+        with self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', (key, str(value)))
+
+    def submitted(self, stage, unit, job_id):
+        with self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO units VALUES (?, ?, ?, ?, NULL, NULL, ?)',
+                                    (stage, unit, job_id, 'submitted', time.time()))
+
+    def apply_result(self, result):
+        """Set a unit to the result of a job (from write_result), inside a transaction"""
+        stage, unit = result['stage'], result['unit']
+        row = self.connection.execute('SELECT job_id FROM units WHERE stage=? AND unit=?', (stage, unit)).fetchone()
+        self.connection.execute('INSERT OR REPLACE INTO units VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                (stage, unit, row[0] if row else None, result['status'], result['exit_code'],
+                                 json.dumps(result['outputs']), result['updated']))
+        if result['status'] == 'failed':
+            self.connection.execute('INSERT INTO failures VALUES (?, ?, ?, ?, ?)',
+                                    (stage, unit, result['exit_code'], result['host'], result['updated']))
+
+    def failures(self, stage, unit):
+        """List of (exit code, host, time) of the failed runs of a unit, oldest first"""
+        return self.connection.execute('SELECT exit_code, host, updated FROM failures WHERE stage=? AND unit=? '
+                                       'ORDER BY updated', (stage, unit)).fetchall()
+
+    def give_up(self, stage, unit):
+        """Never submit the unit again (deterministic failure or too many attempts)"""
+        with self.connection:
+            self.connection.execute('UPDATE units SET status=?, updated=? WHERE stage=? AND unit=?',
+                                    ('given_up', time.time(), stage, unit))
+
+    def get(self, stage, unit):
+        """Row of a unit as a dict, None if it never was submitted"""
+        row = self.connection.execute('SELECT job_id, status, exit_code, outputs FROM units WHERE stage=? AND unit=?',
+                                      (stage, unit)).fetchone()
+        if row is None:
+            return None
+        return {'job_id': row[0], 'status': row[1], 'exit_code': row[2],
+                'outputs': json.loads(row[3]) if row[3] else []}
+
+    def units(self, stage, status=None):
+        if status is None:
+            rows = self.connection.execute('SELECT unit FROM units WHERE stage=? ORDER BY unit', (stage,))
+        else:
+            rows = self.connection.execute('SELECT unit FROM units WHERE stage=? AND status=? ORDER BY unit',
+                                           (stage, status))
+        return [row[0] for row in rows]
+
+    def is_running(self, stage, unit, active_jobs):
+        """Submitted and still in the queue (assumed so if the queue is unknown);
+        a unit run by any of several jobs (task farm) has their ids joined by ':'"""
+        entry = self.get(stage, unit)
+        if entry is None or entry['status'] != 'submitted':
+            return False
+        return active_jobs is None or any(job_id in active_jobs for job_id in entry['job_id'].split(':'))
+
+    def to_submit(self, stage, units, active_jobs):
+        """Units of a stage that are neither done, running nor given up"""
+        return [unit for unit in units if not self.is_done(stage, unit) and not self.is_given_up(stage, unit)
+                and not self.is_running(stage, unit, active_jobs)]
+
+    def is_given_up(self, stage, unit):
+        entry = self.get(stage, unit)
+        return entry is not None and entry['status'] == 'given_up'
+
+    def is_done(self, stage, unit):
+        entry = self.get(stage, unit)
+        return entry is not None and entry['status'] == 'done'
+
+    def summary(self):
+        """{stage: {status: count}}"""
+        summary = {}
+        for (stage, status, count) in self.connection.execute('SELECT stage, status, COUNT(*) FROM units '
+                                                               'GROUP BY stage, status'):
+            summary.setdefault(stage, {})[status] = count
+        return summary
+
+
+def record_command(path, stage, unit, outputs=(), exit_code='$?'):
+    """Command line recording the exit code (default: of the previous command) for a unit"""
+    return ' '.join(['python', STATE_EXE, 'record', path, stage, unit, exit_code] + list(outputs))
+
+
+def done_check_command(path, stage, unit):
+    """Command line ending the job (exit code 1) unless a unit is done"""
+    return ' '.join(['python', STATE_EXE, 'done', path, stage, unit, '|| exit 1'])
+
+
+def recorded_commands(commands, path, stage, unit, outputs=(), params=None):
+    """Run the commands in a subshell stopping at the first failure, then record the result;
+    the job exits with a non-zero code unless the unit is done
+
+    :param params: parameter set under which the runtime is recorded (runtime_history.py), None to skip
+    """
+    commands = ['(', 'set -e'] + list(commands) + [')']
+    if params is None:
+        return commands + [record_command(path, stage, unit, outputs)]
+    return timed_commands(commands, stage, params) + [record_command(path, stage, unit, outputs, '$EXIT_CODE')]
+
+
+if __name__ == '__main__':
+    if len(sys.argv)<3 or sys.argv[1] not in ('record', 'done', 'show') or \
+       (sys.argv[1]=='record' and len(sys.argv)<6) or (sys.argv[1]=='done' and len(sys.argv)<5):
+        print("========= Syntax ==========")
+        print("python production_state.py record <state db> <stage> <unit> <exit code> [<output> ...]")
+        print("python production_state.py done <state db> <stage> <unit>")
+        print("python production_state.py show <state db>")
+        exit()
+
+    # the jobs (record, done) only use the result files
+    if sys.argv[1]=='record':
+        ExitCode = int(sys.argv[5])
+        Status = write_result(sys.argv[2], sys.argv[3], sys.argv[4], ExitCode, sys.argv[6:])
+        print(sys.argv[3]+" "+sys.argv[4]+": "+Status)
+        sys.exit(0 if Status=='done' else (ExitCode or 1))
+    elif sys.argv[1]=='done':
+        sys.exit(0 if last_status(sys.argv[2], sys.argv[3], sys.argv[4])=='done' else 1)
+    else:
+        State = ProductionState(sys.argv[2])
+        for (Stage, Counts) in sorted(State.summary().items()):
+            print(Stage+": "+", ".join("%s %d" % (Status, Count) for (Status, Count) in sorted(Counts.items())))
+        for Stage in sorted(State.summary()):
+            for Status in ('failed', 'given_up'):
+                for Unit in State.units(Stage, Status):
+                    print(Status+": "+Stage+" "+Unit+" ("+str(len(State.failures(Stage, Unit)))+" failures)")
@@ -0,0 +1,125 @@
+####################################
+## Throttled submission to Slurm for the batch scripts
+## The queue is polled with one squeue call per interval for all pending
+## submissions; the cached number of running+pending jobs is updated on
+## every sbatch, and submissions are released as soon as slots free up.
+## When the queue stays full the poll interval grows (adaptive backoff);
+## after max_failed_polls failed squeue calls in a row the throttler gives up
+##
+## squeue/sbatch commands and the sleep function can be replaced,
+## e.g. by stand-in scripts, to test the throttling without Slurm
+## With the local backend (FAX_BACKEND=local:<N>) the counts are its own
+## running/pending tasks, and the wait ends as soon as one of them finishes
+####################################
+import subprocess
+import time
+
+from slurm_submit import sbatch
+from local_backend import local_backend
+
+
+class QueueThrottler(object):
+    """Keep at most max_jobs jobs of a user in a partition"""
+
+    def __init__(self, partition, user, max_jobs, interval=30., max_interval=300., backoff=1.5,
+                 squeue_command='squeue', sbatch_command='sbatch', sleep=time.sleep, max_failed_polls=10):
+        self.partition = partition
+        self.user = user
+        self.max_jobs = max_jobs
+        self.interval = interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.squeue_command = squeue_command
+        self.sbatch_command = sbatch_command
+        self.max_failed_polls = max_failed_polls
+        self.backend = local_backend()
+        self.sleep = self.backend.wait_for_change if self.backend is not None and sleep is time.sleep else sleep
+        self.running = 0
+        self.pending = 0
+
+    def refresh(self):
+        """Poll the queue once; array tasks are counted one by one
+
+        :return: False if squeue failed (the cached counts are kept)
+        """
+        if self.backend is not None:
+            self.running, self.pending = self.backend.counts()
+            return True
+        try:
+            output = subprocess.check_output([self.squeue_command, '--noheader', '--array',
+                                              '--partition=' + self.partition, '--user=' + self.user,
+                                              '--format=%T'])
+        except (subprocess.CalledProcessError, OSError):
+            return False
+        states = output.decode().split()
+        self.running = sum(1 for state in states if state in ('RUNNING', 'COMPLETING'))
+        self.pending = len(states) - self.running
+        return True
+
+    @property
+    def queued(self):
+        return self.running + self.pending
+
+    def free_slots(self):
+        return max(0, self.max_jobs - self.queued)
+
+    def submit(self, submit_file, cwd=None, extra_args=()):
+        """Submit one script as soon as a slot is free, return its job id"""
+        return self.submit_all([(submit_file, cwd, extra_args)])[0]
+
+    def submit_all(self, submissions):
+        """Submit scripts in order, releasing them as slots free up
+
+        :param submissions: list of (submit file, cwd) or (submit file, cwd, extra sbatch args)
+        :return: list of job ids (None for a failed sbatch, and for the submissions left
+                 when squeue failed max_failed_polls times in a row)
+        """
+        job_ids = []
+        interval = self.interval
+        failed_polls = 0
+        while len(job_ids) < len(submissions):
+            released = 0
+            if not self.refresh():
+                failed_polls += 1
+                if failed_polls >= self.max_failed_polls:
+                    print("squeue failed %d times in a row, %d jobs not submitted"
+                          % (failed_polls, len(submissions) - len(job_ids)))
+                    return job_ids + [None]*(len(submissions) - len(job_ids))
+            else:
+                failed_polls = 0
+                print("Current jobs running %d, pending %d" % (self.running, self.pending))
+                for _ in range(min(self.free_slots(), len(submissions) - len(job_ids))):
+                    submission = submissions[len(job_ids)]
+                    extra_args = submission[2] if len(submission) > 2 else ()
+                    job_ids.append(sbatch(submission[0], cwd=submission[1], extra_args=extra_args,
+                                          command=self.sbatch_command))
+                    if job_ids[-1] is not None:
+                        self.pending += 1
+                    released += 1
+            if len(job_ids) == len(submissions):
+                break
+            # poll again quickly while slots free up, back off while the queue stays full
+            interval = self.interval if released else min(interval*self.backoff, self.max_interval)
+            self.sleep(interval)
+        return job_ids
+
+    def wait_until_empty(self):
+        """Block until the user has no job left in the partition
+
+        :return: False if squeue failed max_failed_polls times in a row
+        """
+        interval = self.interval
+        failed_polls = 0
+        while True:
+            if self.refresh():
+                failed_polls = 0
+                if self.queued == 0:
+                    return True
+            else:
+                failed_polls += 1
+                if failed_polls >= self.max_failed_polls:
+                    print("squeue failed %d times in a row, giving up" % failed_polls)
+                    return False
+            print('waiting for squeue to free up, time = %i' % int(time.time()))
+            self.sleep(interval)
+            interval = min(interval*self.backoff, self.max_interval)
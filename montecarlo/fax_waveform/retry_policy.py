@@ -0,0 +1,196 @@
+####################################
+## Retry policy of the simulation jobs
+## The exit code of a job (the stage it failed at, see terminate in run_sim.sh
+## and run_fax.sh) and the signatures found in its logs give one action:
+##   retry             transient failure (staging, storage), after a backoff
+##   retry_other_host  node problem (memory, crash, software setup, Geant4
+##                     stage), after a backoff and on another node
+##   give_up           deterministic failure (bad macro, software error),
+##                     or MAX_RETRIES retries already failed
+## Applied
+##   - on the grid: run_sim.sh turns its exit code into the one the HTCondor
+##     policy of mc_process.py acts on (`classify`: 100+code to give up,
+##     200+code to retry a stage otherwise given up); retried jobs are held and
+##     released after the backoff, on a machine they did not run on yet (site
+##     catalog requirements, osg-sites.xml)
+##   - on Slurm: the failed units of a production state are resubmitted with
+##     --begin (backoff) and --exclude (hosts they failed on), or set to given_up
+##     (MidwayBatch.py, production_dag.py, begin_production.py)
+##
+## Usage:
+##   python retry_policy.py classify <run_sim|run_fax|python> <exit code> [<log> ...]
+####################################
+from __future__ import print_function
+
+import os
+import re
+import sys
+import time
+
+RETRY = 'retry'
+RETRY_OTHER_HOST = 'retry_other_host'
+GIVE_UP = 'give_up'
+
+# exit code -> (stage, action)
+RUN_SIM_CODES = {1: ('software setup', RETRY_OTHER_HOST), 2: ('MC setup', RETRY_OTHER_HOST),
+                 3: ('release setup', RETRY_OTHER_HOST), 4: ('output directory', RETRY_OTHER_HOST),
+                 5: ('stage input', RETRY),
+                 10: ('Geant4', RETRY_OTHER_HOST), 11: ('patch', GIVE_UP), 12: ('nSort', GIVE_UP),
+                 13: ('fax+pax', RETRY), 14: ('fax', RETRY), 15: ('pax', RETRY), 16: ('truth sorting', GIVE_UP),
+                 17: ('hax ROOT', RETRY), 18: ('minitree formats', RETRY), 19: ('lax', GIVE_UP)}
+RUN_FAX_CODES = {10: ('fake instructions', GIVE_UP), 11: ('fax', RETRY), 12: ('truth conversion', GIVE_UP),
+                 13: ('pax', RETRY), 14: ('hax', RETRY), 15: ('fax+pax', RETRY), 16: ('stage out', RETRY)}
+CODES = {'run_sim': RUN_SIM_CODES, 'run_fax': RUN_FAX_CODES, 'python': {}}
+
+# log signatures, first match wins over the action of the exit code
+SIGNATURES = [
+    (re.compile(r'MemoryError|std::bad_alloc|Cannot allocate memory|oom-kill|Out Of Memory'),
+     RETRY_OTHER_HOST, 'out of memory'),
+    (re.compile(r'Segmentation (fault|violation)|Bus error|Illegal instruction'), RETRY_OTHER_HOST, 'crash'),
+    (re.compile(r'Stale file handle|Input/output error|Transport endpoint is not connected|'
+                r'No space left on device|Disk quota exceeded|Connection (timed out|refused|reset)|'
+                r'Failed to initialize CVMFS|cvmfs.*(not available|failed)'),
+     RETRY, 'storage or network problem'),
+    (re.compile(r': command not found'), RETRY_OTHER_HOST, 'software not set up'),
+    (re.compile(r'[Mm]acro file .*(not found|could not be opened)|'
+                r'\*\*\*\*\* COMMAND NOT FOUND|Invalid (command|parameter)'),
+     GIVE_UP, 'bad macro or command'),
+    (re.compile(r'SyntaxError|ImportError|ModuleNotFoundError|NameError|No module named'),
+     GIVE_UP, 'software error'),
+]
+
+MAX_RETRIES = 3
+# backoff before retry n: BACKOFF*BACKOFF_FACTOR**(n-1) seconds, at most MAX_BACKOFF
+BACKOFF = 60
+BACKOFF_FACTOR = 4
+MAX_BACKOFF = 3600
+# only the end of the logs is searched
+MAX_LOG_BYTES = 200000
+
+
+def backoff(attempt):
+    return min(MAX_BACKOFF, BACKOFF*BACKOFF_FACTOR**(attempt - 1))
+
+
+def read_logs(paths):
+    text = ''
+    for path in paths:
+        if os.path.isfile(path):
+            with open(path, 'rb') as flog:
+                flog.seek(max(0, os.path.getsize(path) - MAX_LOG_BYTES))
+                text += flog.read().decode('utf-8', 'replace')
+    return text
+
+
+def decide(exit_code, log_text='', attempt=1, codes=RUN_SIM_CODES):
+    """Action after the attempt-th failure of a job
+
+    :param codes: exit code -> (stage, action) of the job script
+    :return: (action, backoff in seconds, reason)
+    """
+    if exit_code == 0:
+        stage, action = 'missing outputs', RETRY
+    else:
+        stage, action = codes.get(exit_code, ('exit code %d' % exit_code, RETRY))
+    reason = stage
+    for (pattern, signature_action, signature) in SIGNATURES:
+        if pattern.search(log_text):
+            action, reason = signature_action, '%s: %s' % (stage, signature)
+            break
+    if action != GIVE_UP and attempt > MAX_RETRIES:
+        return GIVE_UP, 0, '%s, %d failures' % (reason, attempt)
+    return action, 0 if action == GIVE_UP else backoff(attempt), reason
+
+
+def classify(script, exit_code, log_text):
+    """Exit code of a failed grid job for the HTCondor policy (condor_profiles)"""
+    codes = CODES[script]
+    default = codes.get(exit_code, ('', RETRY))[1]
+    action = decide(exit_code, log_text, 1, codes)[0]
+    if action == GIVE_UP and default != GIVE_UP:
+        return 100 + exit_code
+    if action != GIVE_UP and default == GIVE_UP:
+        return 200 + exit_code
+    return exit_code
+
+
+def condor_profiles(codes=RUN_SIM_CODES):
+    """HTCondor submit commands retrying the jobs by the policy (see classify)
+
+    Jobs exiting with a retried code are held, then released after the backoff;
+    the other failures leave the queue. Jobs held by failed file transfers (hold
+    codes 12, 13) are released the same way. The machines a job ran on are recorded
+    (job_machine_attrs) and avoided by the requirements of the site catalog
+    (osg-sites.xml), which the per-job profiles would replace.
+
+    :return: list of (key, value)
+    """
+    retried = sorted(code for (code, (_, action)) in codes.items() if action != GIVE_UP)
+    retried += [200 + code for (code, (_, action)) in sorted(codes.items()) if action == GIVE_UP]
+    retriable = ' || '.join('ExitCode == %d' % code for code in retried)
+    wait = str(backoff(MAX_RETRIES))
+    for attempt in range(MAX_RETRIES - 1, 0, -1):
+        wait = 'ifThenElse(NumJobStarts <= %d, %d, %s)' % (attempt, backoff(attempt), wait)
+    return [('on_exit_hold', '(ExitBySignal == False) && (%s) && (NumJobStarts <= %d)' % (retriable, MAX_RETRIES)),
+            ('on_exit_hold_reason', '"retry_policy: transient failure"'),
+            ('periodic_release', '((HoldReasonCode == 3) || (HoldReasonCode == 12) || (HoldReasonCode == 13)) && '
+                                 '(NumJobStarts <= %d) && '
+                                 '((time() - EnteredCurrentStatus) > %s)' % (MAX_RETRIES, wait))]
+
+
+def retry_plan(state, stage, unit, logs=(), codes=None, now=None):
+    """Whether and how to resubmit a failed unit of a production state (production_state.py)
+
+    :param logs: log files of the failed job
+    :param codes: exit codes of the job script, default: none (python jobs)
+    :return: list of extra sbatch arguments (--begin after the backoff, --exclude of the
+             hosts it failed on), None if the unit is given up (its status is then given_up)
+    """
+    if state.is_given_up(stage, unit):
+        return None
+    failures = state.failures(stage, unit)
+    if not failures:
+        # never failed, e.g. cancelled with its dependency: resubmitted as is
+        return []
+    exit_code, _, failed_at = failures[-1]
+    action, delay, reason = decide(exit_code, read_logs(logs), len(failures), codes or {})
+    if action == GIVE_UP:
+        state.give_up(stage, unit)
+        print('%s %s: given up (%s)' % (stage, unit, reason))
+        return None
+    args = []
+    wait = int(failed_at + delay - (now or time.time()))
+    if wait > 0:
+        args.append('--begin=now+%d' % wait)
+    if action == RETRY_OTHER_HOST:
+        hosts = sorted(set(host for (_, host, _) in failures if host))
+        if hosts:
+            args.append('--exclude=' + ','.join(hosts))
+    print('%s %s: retry %d (%s) %s' % (stage, unit, len(failures), reason, ' '.join(args)))
+    return args
+
+
+def combine_args(args_lists):
+    """sbatch arguments of one submission (e.g. a job array) for units with their own retry_plan:
+    the latest --begin and all the excluded hosts"""
+    begin = 0
+    hosts = set()
+    for args in args_lists:
+        for arg in args:
+            if arg.startswith('--begin=now+'):
+                begin = max(begin, int(arg.split('+')[1]))
+            elif arg.startswith('--exclude='):
+                hosts.update(arg.split('=')[1].split(','))
+    args = ['--begin=now+%d' % begin] if begin else []
+    return args + (['--exclude=' + ','.join(sorted(hosts))] if hosts else [])
+
+
+if __name__ == '__main__':
+    if len(sys.argv)<4 or sys.argv[1]!='classify' or sys.argv[2] not in CODES:
+        print("========= Syntax ==========")
+        print("python retry_policy.py classify <run_sim|run_fax|python> <exit code> [<log> ...]")
+        exit()
+
+    # prints the exit code the job should end with
+    ExitCode = int(sys.argv[3])
+    print(classify(sys.argv[2], ExitCode, read_logs(sys.argv[4:])) if ExitCode else 0)
@@ -6,6 +6,49 @@
 #
 ############################################
 
+# exit codes: the stage that failed (see RUN_FAX_CODES in retry_policy.py)
+#  10 fake instructions, 11 fax, 12 truth conversion, 13 pax, 14 hax, 15 fax+pax (without raw data),
+#  16 copy of the outputs from the node-local scratch
+function terminate {
+
+    # Cleanup
+    rm -f pax*
+
+    # scratch staging: the logs of a failed job are copied back too
+    if [[ ${WORKDIR} != ${OUTDIR} ]]; then
+        if [ $1 -ne 0 ]; then
+            stage_out "*.log"
+            stage_out "*_metrics.jsonl"
+        fi
+        cd ${OUTDIR}
+        rm -rf ${WORKDIR}
+    fi
+
+    exit $1
+}
+
+function stage_out {
+    # copy the files of the work directory matching $1 to the output directory, each one
+    # under a temporary name first, then renamed: partial files never appear there
+    for file in ${WORKDIR}/$1; do
+        name=${file##*/}
+        if [[ ${name} == ${FILEROOT}.csv && -f ${OUTDIR}/${name} ]]; then
+            continue
+        fi
+        cp -r ${file} ${OUTDIR}/.${name}.part || return 1
+        if [ -d ${OUTDIR}/${name} ]; then
+            rm -rf ${OUTDIR}/${name}
+        fi
+        mv -f -T ${OUTDIR}/.${name}.part ${OUTDIR}/${name} || return 1
+    done
+}
+
+# run_stage <stage> <command> [<arg> ...]: run a stage, appending its wall/cpu time,
+# memory and I/O to ${METRICS_FILE} (see stage_metrics.py)
+function run_stage {
+    python ${RELEASEDIR}/stage_metrics.py run ${METRICS_FILE} $1 ${SUBRUN} "${@:2}"
+}
+
 echo "Start time: " `/bin/date`
 echo "Job is running on node: " `/bin/hostname`
 echo "Job running as user: " `/usr/bin/id`
@@ -23,6 +66,20 @@ ElectronNumUpper=$4
 RecoilType=ER
 IfS1S2Correlation=${10}
 
+# (optional) spectrum file replacing the flat photon/electron ranges
+SpectrumFile=${11:-none}
+
+# (optional) 1 to save the raw waveforms (fax and pax in two paxer runs),
+# 0 (default) to simulate and process in a single paxer run
+SaveRaw=${12:-0}
+
+# (optional) 1 (default) to run the stages in node-local scratch and copy the outputs
+# back at the end, 0 to run them in the output directory
+UseScratch=${13:-1}
+# scratch space needed per event (kB), with and without raw waveforms
+ScratchKBPerEvent=300
+ScratchKBPerEventRaw=3000
+
 echo 'IfS1S2Correlation = ${IfS1S2Correlation}'
 # enable s2 after pulse depending on the argument
 # 1 for enable
@@ -53,79 +110,162 @@ MY_PATH=$(cd `dirname $0`; pwd)
 echo $MY_PATH
 RELEASEDIR=`( cd "$MY_PATH" && pwd )`
 
+# warm Python worker for the Python stages (see stage_worker.py), importing while fax+pax run;
+# several subruns of one node may share the worker given in the environment
+# (its socket is in a directory of this job, removed on exit)
+STAGE_WORKER_DIR=
+if [ -z "${STAGE_WORKER_SOCKET}" ]; then
+    STAGE_WORKER_DIR=`mktemp -d /tmp/stage_worker_XXXXXX`
+    trap "rm -rf ${STAGE_WORKER_DIR}" EXIT
+    export STAGE_WORKER_SOCKET=${STAGE_WORKER_DIR}/socket
+    python ${RELEASEDIR}/stage_worker.py serve ${STAGE_WORKER_SOCKET} &> /dev/null &
+fi
+PYTHON_STAGE="python ${RELEASEDIR}/stage_worker.py run"
+
 # Setting up directories
 #start_dir=$PWD
 
 
 OUTDIR=$8/${SUBRUN}
 mkdir -p ${OUTDIR}
-cd ${OUTDIR}
 
-#if [ "$OSG_WN_TMP" == "" ];
-#then
-#    OSG_WN_TMP=$PWD
-#fi
-#cd $OSG_WN_TMP
-#
-#work_dir=`mktemp -d --tmpdir=$OSG_WN_TMP`
-#cd $work_dir
+# Work directory: node-local scratch (/dev/shm if the job needs less than a
+# quarter of it, shared with the subruns running next to it (FAX_CONCURRENT_SUBRUNS,
+# set by subrun_runner.py), else $TMPDIR or /tmp) with enough free space, else ${OUTDIR}
+WORKDIR=${OUTDIR}
+if [[ ${UseScratch} != 0 ]]; then
+    if [[ ${SaveRaw} != 0 ]]; then
+        ScratchKB=$((NumEvents*ScratchKBPerEventRaw))
+    else
+        ScratchKB=$((NumEvents*ScratchKBPerEvent))
+    fi
+    for dir in /dev/shm ${TMPDIR} /tmp; do
+        if [ ! -d ${dir} ] || [ ! -w ${dir} ]; then
+            continue
+        fi
+        FreeKB=`df -Pk ${dir} | awk 'NR==2 {print $4}'`
+        if [[ ${dir} == /dev/shm ]]; then
+            ShareKB=$((`df -Pk ${dir} | awk 'NR==2 {print $2}'`/4/${FAX_CONCURRENT_SUBRUNS:-1}))
+            FreeKB=$((FreeKB < ShareKB ? FreeKB : ShareKB))
+        fi
+        if ((FreeKB > ScratchKB)); then
+            WORKDIR=`mktemp -d --tmpdir=${dir} fax_${SUBRUN}_XXXXXX` && break
+            WORKDIR=${OUTDIR}
+        fi
+    done
+fi
+if [[ ${WORKDIR} != ${OUTDIR} ]]; then
+    # the scratch is removed however the job ends (terminate, errors, Slurm time limit)
+    trap "cd ${OUTDIR}; rm -rf ${WORKDIR} ${STAGE_WORKER_DIR}" EXIT
+    trap 'exit 143' TERM
+fi
+echo "Work directory: ${WORKDIR}"
+cd ${WORKDIR}
 
 # Filenaming
 FILEROOT=FakeWaveform_${Detector}_${SUBRUN}
-FILENAME=${OUTDIR}/${FILEROOT}
+FILENAME=${WORKDIR}/${FILEROOT}
+OUT_FILENAME=${OUTDIR}/${FILEROOT}
 CSV_FILENAME=${FILENAME}.csv       # Fake input data
 FAX_FILENAME=${FILENAME}_truth # fax truth info
 PKL_FILENAME=${FILENAME}_truth.pkl # converted fax truth info
 RAW_FILENAME=${FILENAME}_raw       # fax simulated raw data
 PAX_FILENAME=${FILENAME}_pax       # pax processed data
 HAX_FILENAME=${FILENAME}_hax       # hax reduced data
+METRICS_FILE=${FILENAME}_metrics.jsonl # resource usage of the stages
 CustomIniFilename=${RELEASEDIR}/NoS2Afterpulses.ini
 NoPMTAfterpulseIniFilename=${RELEASEDIR}/NoPMTAfterpulses.ini
 echo ${CustomIniFilename}
 
 
-# Create the fake input data
-python ${RELEASEDIR}/CreateFakeCSV.py ${Detector} ${NumEvents} ${PhotonNumLower} ${PhotonNumUpper} ${ElectronNumLower} ${ElectronNumUpper} ${RecoilType} ${CSV_FILENAME} ${IfS1S2Correlation}
+# Create the fake input data (unless MidwayBatch.py already generated it)
+if [ -f ${OUT_FILENAME}.csv ] && [[ ${WORKDIR} != ${OUTDIR} ]]; then
+	cp ${OUT_FILENAME}.csv ${CSV_FILENAME}
+fi
+if [ ! -f ${CSV_FILENAME} ]; then
+	run_stage instructions python ${RELEASEDIR}/CreateFakeCSV.py ${Detector} ${NumEvents} ${PhotonNumLower} ${PhotonNumUpper} ${ElectronNumLower} ${ElectronNumUpper} ${RecoilType} ${CSV_FILENAME} ${IfS1S2Correlation} ${SpectrumFile}
+	if [ $? -ne 0 ];
+	then
+	    terminate 10
+	fi
+fi
 
 # Start of simulations #
 
-# fax stage
+# fax stage options
 if (($S2AfterpulseEnableFlag==0)); then
 	if (($PMTAfterpulseEnableFlag==0)); then
 		echo 'Both S2 and PMT afterpulse disabled'
-		(time paxer --input ${CSV_FILENAME} --config ${Detector} reduce_raw_data Simulation --config_path ${NoPMTAfterpulseIniFilename} ${CustomIniFilename} --config_string "[WaveformSimulator]truth_file_name=\"${FAX_FILENAME}\"" --output ${RAW_FILENAME};) &> ${RAW_FILENAME}.log
+		FaxConfigPath="--config_path ${NoPMTAfterpulseIniFilename} ${CustomIniFilename}"
 	else
 		echo 'Only S2 afterpulse disabled'
-		(time paxer --input ${CSV_FILENAME} --config ${Detector} reduce_raw_data Simulation --config_path ${CustomIniFilename} --config_string "[WaveformSimulator]truth_file_name=\"${FAX_FILENAME}\"" --output ${RAW_FILENAME};) &> ${RAW_FILENAME}.log
+		FaxConfigPath="--config_path ${CustomIniFilename}"
 	fi
 else
 	if (($PMTAfterpulseEnableFlag==0)); then
 		echo 'Only PMT afterpulse disabled'
-		(time paxer --input ${CSV_FILENAME} --config ${Detector} reduce_raw_data Simulation --config_path ${NoPMTAfterpulseIniFilename} --config_string "[WaveformSimulator]truth_file_name=\"${FAX_FILENAME}\"" --output ${RAW_FILENAME};) &> ${RAW_FILENAME}.log
+		FaxConfigPath="--config_path ${NoPMTAfterpulseIniFilename}"
 	else
 		echo 'Both S2 and PMT afterpulse enabled'
-		(time paxer --input ${CSV_FILENAME} --config ${Detector} reduce_raw_data Simulation  --config_string "[WaveformSimulator]truth_file_name=\"${FAX_FILENAME}\"" --output ${RAW_FILENAME};) &> ${RAW_FILENAME}.log
+		FaxConfigPath=""
 	fi
 fi
 
-#	(time paxer --input ${CSV_FILENAME} --config ${Detector} reduce_raw_data Simulation --config_string "[WaveformSimulator]truth_file_name=\"${FAX_FILENAME}\"" --output ${RAW_FILENAME};) &> ${RAW_FILENAME}.log
+# Do not save raw waveforms: fax+pax stages in one paxer run (as in run_sim.sh)
+if [[ ${SaveRaw} == 0 ]]; then
+	run_stage fax_pax paxer --input ${CSV_FILENAME} --config ${Detector} Simulation ${FaxConfigPath} --config_string "[WaveformSimulator]truth_file_name=\"${FAX_FILENAME}\"" --output ${PAX_FILENAME} &> ${PAX_FILENAME}.log
+	if [ $? -ne 0 ];
+	then
+	    terminate 15
+	fi
+fi
 
+# Save raw waveforms: fax stage
+if [[ ${SaveRaw} != 0 ]]; then
+	run_stage fax paxer --input ${CSV_FILENAME} --config ${Detector} reduce_raw_data Simulation ${FaxConfigPath} --config_string "[WaveformSimulator]truth_file_name=\"${FAX_FILENAME}\"" --output ${RAW_FILENAME} &> ${RAW_FILENAME}.log
+	if [ $? -ne 0 ];
+	then
+	    terminate 11
+	fi
+fi
 
 # convert fax truth to pickle
-python ${RELEASEDIR}/ConvertFaxTruthToPickle.py ${FAX_FILENAME} ${PKL_FILENAME}
+run_stage truth_conversion ${PYTHON_STAGE} ${RELEASEDIR}/ConvertFaxTruthToPickle.py ${FAX_FILENAME} ${PKL_FILENAME}
+if [ $? -ne 0 ];
+then
+    terminate 12
+fi
 
-# pax stage
-(time paxer --ignore_rundb --input ${RAW_FILENAME} --config ${Detector} --output ${PAX_FILENAME};) &> ${PAX_FILENAME}.log
+# Save raw waveforms: pax stage
+if [[ ${SaveRaw} != 0 ]]; then
+	run_stage pax paxer --ignore_rundb --input ${RAW_FILENAME} --config ${Detector} --output ${PAX_FILENAME} &> ${PAX_FILENAME}.log
+	if [ $? -ne 0 ];
+	then
+	    terminate 13
+	fi
+fi
 
 # hax stage
 HAXPYTHON="import hax; "
-HAXPYTHON+="hax.init(main_data_paths=['${OUTDIR}'], minitree_paths=['${OUTDIR}'], pax_version_policy = 'loose'); "
+HAXPYTHON+="hax.init(main_data_paths=['${WORKDIR}'], minitree_paths=['${WORKDIR}'], pax_version_policy = 'loose'); "
 HAXPYTHON+="hax.minitrees.load('${PAX_FILENAME##*/}', ['Basics', 'Fundamentals']);"
 
-(time python -c "${HAXPYTHON}";)  &> ${HAX_FILENAME}.log
+run_stage hax ${PYTHON_STAGE} -c "${HAXPYTHON}" &> ${HAX_FILENAME}.log
+if [ $? -ne 0 ];
+then
+    terminate 14
+fi
 
-# Cleanup
+# Cleanup, then copy the outputs back from the scratch
 rm -f pax*
+if [[ ${WORKDIR} != ${OUTDIR} ]]; then
+    stage_out "*" || terminate 16
+fi
+
+# record the outputs in the production manifest (see manifest.py)
+python ${RELEASEDIR}/manifest.py add $8/manifest.txt ${SUBRUN} fax truth_csv=${OUT_FILENAME}_truth.csv truth_root=${OUT_FILENAME}_truth.root pax=${OUT_FILENAME}_pax.root basics=${OUT_FILENAME}_pax_Basics.root processed=${OUT_FILENAME}_pax_Fundamentals.root
+
+terminate 0
 
 
 #cd $start_dir
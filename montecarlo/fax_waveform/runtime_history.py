@@ -0,0 +1,189 @@
+####################################
+## Runtime history of the batch jobs, for right-sized Slurm time limits
+## Every fax/reduce/merge job records its wall time under its stage and
+## parameter set (node type, photon/electron ranges, events per job, ...).
+## The job only writes one line `<stage> <params> <seconds> <exit code>` to a
+## file of its own in the spool directory (<db>.d) from the shell; the
+## submitting scripts fold the spool into a SQLite database shared by all
+## productions ($FAX_RUNTIME_DB, default ~/.fax_runtimes.db), so that no job
+## waits on its lock. Later submissions of the same stage and parameter
+## set ask for a percentile of the recorded runtimes with some headroom
+## instead of the hardcoded limit, which stays the default until enough
+## runs are recorded. Jobs killed at their time limit (SIGTERM) are recorded
+## too (a shell echo within the kill grace time) and push the next limit
+## above the one they were killed at.
+##
+## Usage:
+##   python runtime_history.py add <db> <stage> <params> <seconds> <exit code|timeout>
+##   python runtime_history.py show [<db>]   (folds the spool first)
+####################################
+import math
+import os
+import sqlite3
+import sys
+import time
+
+RUNTIME_DB = os.environ.get('FAX_RUNTIME_DB', os.path.expanduser('~/.fax_runtimes.db'))
+RUNTIME_SPOOL = RUNTIME_DB + '.d'
+PERCENTILE = 95
+HEADROOM = 1.3
+MIN_SAMPLES = 10
+# most recent runs used, so that the limits follow changes of the software/nodes
+MAX_SAMPLES = 200
+MIN_TIME_LIMIT = 5*60
+MAX_TIME_LIMIT = 36*3600
+
+
+def params_key(*values):
+    """Parameter set of a job, e.g. params_key(node_type, minitree_type) -> '1_2'"""
+    return '_'.join(str(value) for value in values)
+
+
+def format_time_limit(seconds):
+    """Seconds -> Slurm HH:MM:SS, rounded up to the minute"""
+    minutes = int(math.ceil(seconds/60.))
+    return '%02d:%02d:00' % (minutes // 60, minutes % 60)
+
+
+def parse_time_limit(time_limit):
+    """Slurm [D-]HH:MM:SS -> seconds"""
+    days, _, clock = time_limit.rpartition('-')
+    seconds = 0
+    for field in clock.split(':'):
+        seconds = 60*seconds + int(field)
+    return seconds + 86400*int(days or 0)
+
+
+def percentile(values, q):
+    """Nearest-rank percentile of a non-empty list"""
+    values = sorted(values)
+    return values[max(0, int(math.ceil(q/100.*len(values))) - 1)]
+
+
+class RuntimeHistory(object):
+    """SQLite store of the runtimes of the jobs, per stage and parameter set"""
+
+    def __init__(self, path=RUNTIME_DB):
+        # shared by the submitting scripts of all productions: wait for the lock
+        self.connection = sqlite3.connect(path, timeout=600)
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS runtimes (stage TEXT, params TEXT, seconds REAL, '
+                                    'exit_code TEXT, updated REAL)')
+
+    def add(self, stage, params, seconds, exit_code):
+        """Record one run; exit_code is 'timeout' for a job killed at its time limit"""
+        with self.connection:
+            self.connection.execute('INSERT INTO runtimes VALUES (?, ?, ?, ?, ?)',
+                                    (stage, params, float(seconds), str(exit_code), time.time()))
+
+    def fold_spool(self, spool=RUNTIME_SPOOL):
+        """Add the runtimes the jobs left in the spool directory, each file being taken (renamed)
+        by one script only
+
+        :return: number of runtimes added
+        """
+        if not os.path.isdir(spool):
+            os.makedirs(spool)
+            return 0
+        taken = []
+        for name in sorted(os.listdir(spool)):
+            path = os.path.join(spool, name)
+            if not name.endswith('.txt'):
+                continue
+            with open(path) as fspool:
+                text = fspool.read()
+            if not text.endswith('\n'):
+                # job still running, or killed before writing (removed once older than any job)
+                if not text and time.time() - os.path.getmtime(path) > MAX_TIME_LIMIT:
+                    os.remove(path)
+                continue
+            try:
+                os.rename(path, '%s.%d' % (path, os.getpid()))
+            except OSError:
+                continue
+            taken.append((path, '%s.%d' % (path, os.getpid())))
+        rows = []
+        for (path, taken_path) in taken:
+            with open(taken_path) as fspool:
+                for line in fspool:
+                    fields = line.split()
+                    if len(fields) >= 4:
+                        rows.append((fields[0], ' '.join(fields[1:-2]), float(fields[-2]), fields[-1],
+                                     os.path.getmtime(taken_path)))
+        try:
+            with self.connection:
+                self.connection.executemany('INSERT INTO runtimes VALUES (?, ?, ?, ?, ?)', rows)
+        except sqlite3.Error:
+            # left for the next script
+            for (path, taken_path) in taken:
+                os.rename(taken_path, path)
+            raise
+        for (path, taken_path) in taken:
+            os.remove(taken_path)
+        return len(rows)
+
+    def runtimes(self, stage, params, exit_code='0'):
+        rows = self.connection.execute('SELECT seconds FROM runtimes WHERE stage=? AND params=? AND exit_code=? '
+                                       'ORDER BY updated DESC LIMIT ?', (stage, params, exit_code, MAX_SAMPLES))
+        return [row[0] for row in rows]
+
+    def time_limit(self, stage, params, default):
+        """Slurm time limit of a job: the PERCENTILE of the successful runtimes with HEADROOM,
+        at least HEADROOM times the longest run killed at its limit; default with too few runs"""
+        runtimes = self.runtimes(stage, params)
+        if len(runtimes) < MIN_SAMPLES:
+            return default
+        seconds = HEADROOM*percentile(runtimes, PERCENTILE)
+        timeouts = self.runtimes(stage, params, 'timeout')
+        if timeouts:
+            seconds = max(seconds, HEADROOM*max(timeouts))
+        return format_time_limit(min(MAX_TIME_LIMIT, max(MIN_TIME_LIMIT, seconds)))
+
+    def parameter_sets(self):
+        return self.connection.execute('SELECT DISTINCT stage, params FROM runtimes ORDER BY stage, params').fetchall()
+
+
+def time_limit(stage, params, default):
+    """Right-sized time limit from the shared history, after folding the runtimes of the finished jobs
+    (the default if it can't be read)"""
+    try:
+        history = RuntimeHistory()
+        history.fold_spool()
+        return history.time_limit(stage, params, default)
+    except (sqlite3.Error, OSError):
+        return default
+
+
+def timed_commands(commands, stage, params):
+    """Record the runtime of the commands in a spool file of the job; their exit code is left in $EXIT_CODE"""
+    add = 'echo "%s %s $(( $(date +%%s) - RUNTIME_START ))' % (stage, params)
+    return (['RUNTIME_START=$(date +%s)',
+             'RUNTIME_FILE=%s/%s_$(hostname -s)_$$_${RANDOM}.txt' % (RUNTIME_SPOOL, stage),
+             # Slurm sends SIGTERM at the time limit
+             "trap '%s timeout\" >> ${RUNTIME_FILE}; exit 143' TERM" % add]
+            + list(commands)
+            + ['EXIT_CODE=$?', 'trap - TERM', add + ' ${EXIT_CODE}" >> ${RUNTIME_FILE}'])
+
+
+if __name__ == '__main__':
+    if len(sys.argv)<2 or sys.argv[1] not in ('add', 'show') or (sys.argv[1]=='add' and len(sys.argv)<7):
+        print("========= Syntax ==========")
+        print("python runtime_history.py add <db> <stage> <params> <seconds> <exit code|timeout>")
+        print("python runtime_history.py show [<db>]")
+        exit()
+
+    if sys.argv[1]=='add':
+        RuntimeHistory(sys.argv[2]).add(sys.argv[3], sys.argv[4], sys.argv[5], sys.argv[6])
+    else:
+        History = RuntimeHistory(sys.argv[2] if len(sys.argv)>2 else RUNTIME_DB)
+        History.fold_spool((sys.argv[2] if len(sys.argv)>2 else RUNTIME_DB) + '.d')
+        for (Stage, Params) in History.parameter_sets():
+            Runtimes = History.runtimes(Stage, Params)
+            Timeouts = History.runtimes(Stage, Params, 'timeout')
+            if Runtimes:
+                print("%s %s: %d runs, median %d s, p%d %d s, %d timeouts -> %s"
+                      % (Stage, Params, len(Runtimes), percentile(Runtimes, 50), PERCENTILE,
+                         percentile(Runtimes, PERCENTILE), len(Timeouts),
+                         History.time_limit(Stage, Params, 'default')))
+            else:
+                print("%s %s: no successful run, %d timeouts" % (Stage, Params, len(Timeouts)))
@@ -1,10 +1,21 @@
 import sys
+import json
 ### Edit these three lines ###
 with open('sort_processed_files.sh') as bashfile:
     lines = bashfile.readlines()
 head_dirname = lines[1].split('=')[1].split()[0] # all data will go under here (under subdir)
 username = lines[2].split('=')[1].split()[0] # midway username
 interactive = 1 # 1 for terminal prompt options, 0 for hardcoded options below
+# or non-interactive from a spec file: python begin_production.py <spec file (.json)>
+spec_file = None
+if len(sys.argv)>1:
+    spec_file = sys.argv[1]
+    interactive = 0
+# seconds between two rebalancings of the job budget between the processes (0 to disable)
+rebalance_interval = 300
+max_jobs = None # per nodetype, default: 64 on public nodes, 200 otherwise
+# seconds between two resubmissions of the failed jobs by the retry policy (0 to disable)
+retry_interval = 300
 
 process_list = []
 
@@ -33,9 +44,35 @@ process['nodetype'] = '0'
 process['minitree_type'] = '0'
 process['use_array_truth'] = '1'
 process['save_ap_truth'] = '1'
-if interactive == 0:
+if interactive == 0 and spec_file is None:
     process_list.append(process)
 
+def load_spec(filename):
+    """Process list from a json spec file:
+    {"defaults": {<field>: <value>, ...},
+     "processes": [{"process_name": ..., "priority": 2, <field>: <value>, ...}, ...],
+     "rebalance_interval": 300, "max_jobs": {"0": 200, "1": 64, "2": 200}, "retry_interval": 300}
+    every process takes the defaults for the fields it does not set;
+    optional fields: priority (share of the job budget, default 1), save_ap_truth,
+    spectrum, seed, cost_model (MidwayBatch.py options, default none), save_raw (default 0), scratch (default 1),
+    cores (default 1)
+    """
+    with open(filename) as fspec:
+        spec = json.load(fspec)
+    processes = []
+    for entry in spec['processes']:
+        process = dict((key, str(value)) for (key, value) in spec.get('defaults', {}).items())
+        process.update((key, str(value)) for (key, value) in entry.items())
+        missing = [field for field in fields if field not in process]
+        if missing:
+            raise ValueError('process %s misses %s' % (process.get('process_name'), ', '.join(missing)))
+        processes.append(process)
+    return (processes, spec.get('rebalance_interval', rebalance_interval), spec.get('max_jobs', max_jobs),
+            spec.get('retry_interval', retry_interval))
+
+if spec_file is not None:
+    process_list, rebalance_interval, max_jobs, retry_interval = load_spec(spec_file)
+
 def setup_process(fields, process_nb):
     process = {}
     for field in fields:
@@ -0,0 +1,200 @@
+####################################
+## Shared Slurm submission helpers for the batch scripts
+## (MidwayBatch.py, BatchReduceDataSubmission.py, BatchMergeTruthAndProcessed.py)
+## Submit scripts are rendered in memory and written with a single write,
+## directories are handled natively instead of through the shell
+## A stage can also be submitted as one job array: the arguments of each
+## task are one line of a parameter file, read back with SLURM_ARRAY_TASK_ID
+## With FAX_BACKEND=local:<N> the scripts run on this machine instead
+## (local_backend.py)
+####################################
+import os
+import shutil
+import subprocess
+
+from local_backend import local_backend
+
+# node type (0: xenon1t, 1: public, 2: kicp) -> partition / qos
+PARTITIONS = {0: 'xenon1t', 1: 'sandyb', 2: 'kicp'}
+QOS = {0: 'xenon1t', 2: 'xenon1t-kicp'}
+ACCOUNT = 'pi-lgrandi'
+# environment sourced by the reduce/merge jobs (can be overridden, e.g. to run them locally)
+PAX_ENV = os.environ.get('PAX_ENV', '/home/mcfate/Env/GlobalPAXEnv.sh')
+# Slurm MaxArraySize is 1001 by default, larger stages are split into several arrays
+MAX_ARRAY_SIZE = 1000
+
+
+def partition_name(node_type):
+    return PARTITIONS[int(node_type)]
+
+
+def render_submit_script(commands, output, error, time_limit, node_type, always_account=False, setup=None,
+                         cpus_per_task=None):
+    """Render a Slurm submit script
+
+    :param commands: list of shell command lines to run
+    :param output: path of the job stdout
+    :param error: path of the job stderr
+    :param time_limit: Slurm time limit, e.g. 03:59:00
+    :param node_type: 0 for xenon1t, 1 for public, 2 for kicp nodes
+    :param always_account: charge pi-lgrandi on public nodes too
+    :param setup: script sourced before the commands
+    :param cpus_per_task: number of cpus of the allocation (default: one)
+    :return: the script as a string
+    """
+    lines = _header(output, error, time_limit, node_type, always_account)
+    if cpus_per_task:
+        lines.append('#SBATCH --cpus-per-task=%d' % cpus_per_task)
+    lines.append('')
+    if setup:
+        lines.append('. ' + setup)
+        lines.append('')
+    lines.extend(commands)
+    return '\n'.join(lines) + '\n'
+
+
+def render_array_script(commands, param_file, offset, num_tasks, max_running, output, error,
+                        time_limit, node_type, log=None, always_account=False, setup=None, cpus_per_task=None,
+                        task_ids=None):
+    """Render a Slurm job array script over lines offset..offset+num_tasks-1 of param_file
+
+    The arguments of the task are set as $1, $2, ... before the commands run.
+
+    :param commands: list of shell command lines, using $1, $2, ... for the task arguments
+    :param param_file: file with the space separated arguments of one task per line
+    :param offset: line (0-based) of the first task of this array
+    :param num_tasks: number of tasks in this array
+    :param max_running: maximum number of tasks running at the same time (%N)
+    :param log: per-task log path (may use $1, $2, ...), default: Slurm output/error
+    :param cpus_per_task: number of cpus of each task (default: one)
+    :param task_ids: task ids of the array, reading line offset+<task id> (default: 0..num_tasks-1)
+    :return: the script as a string
+    """
+    lines = _header(output, error, time_limit, node_type, always_account)
+    if task_ids is None:
+        task_ids = range(num_tasks)
+    lines.append('#SBATCH --array=%s%%%d' % (id_ranges(task_ids), max_running))
+    if cpus_per_task:
+        lines.append('#SBATCH --cpus-per-task=%d' % cpus_per_task)
+    lines.append('')
+    lines.append('set -- $(sed -n "$((SLURM_ARRAY_TASK_ID+%d))p" %s)' % (offset + 1, param_file))
+    if log:
+        lines.append('exec > %s 2>&1' % log)
+    if setup:
+        lines.append('. ' + setup)
+    lines.append('')
+    lines.extend(commands)
+    return '\n'.join(lines) + '\n'
+
+
+def id_ranges(task_ids):
+    """Slurm --array list of task ids: [0, 1, 2, 5, 7, 8] -> 0-2,5,7-8"""
+    ranges = []
+    for task_id in sorted(task_ids):
+        if ranges and task_id == ranges[-1][1] + 1:
+            ranges[-1][1] = task_id
+        else:
+            ranges.append([task_id, task_id])
+    return ','.join(str(first) if first == last else '%d-%d' % (first, last) for (first, last) in ranges)
+
+
+def _header(output, error, time_limit, node_type, always_account):
+    node_type = int(node_type)
+    lines = ['#!/bin/bash',
+             '#SBATCH --output=' + output,
+             '#SBATCH --error=' + error,
+             '#SBATCH --time=' + time_limit]
+    if always_account or node_type in QOS:
+        lines.append('#SBATCH --account=' + ACCOUNT)
+    if node_type in QOS:
+        lines.append('#SBATCH --qos=' + QOS[node_type])
+        lines.append('#SBATCH --partition=' + PARTITIONS[node_type])
+    return lines
+
+
+def sbatch(submit_file, cwd=None, extra_args=(), command='sbatch'):
+    """Submit a script, return its job id or None if sbatch failed"""
+    backend = local_backend()
+    if backend is not None:
+        return backend.submit(submit_file, cwd=cwd, extra_args=extra_args)
+    try:
+        output = subprocess.check_output([command, '--parsable'] + list(extra_args) + [submit_file], cwd=cwd)
+    except (subprocess.CalledProcessError, OSError):
+        return None
+    return output.decode().strip().split(';')[0]
+
+
+def submit_array(name, commands, task_args, submit_dir, max_running, time_limit, node_type,
+                 log=None, always_account=False, setup=None, extra_args=(), cpus_per_task=None):
+    """Submit a stage as job array(s), one task per entry of task_args
+
+    :param name: stage name, used for the parameter/submit/output files in submit_dir
+    :param commands: command lines, using $1, $2, ... for the task arguments
+    :param task_args: list of argument lists, one per task
+    :param max_running: maximum number of running tasks over all arrays of the stage
+    :param extra_args: extra sbatch arguments of the arrays
+    :param cpus_per_task: number of cpus of each task (default: one)
+    :return: list of job ids (one per array, None for a failed submission)
+    """
+    make_dir(submit_dir)
+    param_file = os.path.join(submit_dir, name + '_params.txt')
+    write_file(param_file, ''.join(' '.join(str(a) for a in args) + '\n' for args in task_args))
+    offsets = list(range(0, len(task_args), MAX_ARRAY_SIZE))
+    max_running = max(1, int(max_running) // max(1, len(offsets)))
+    job_ids = []
+    for (i, offset) in enumerate(offsets):
+        num_tasks = min(MAX_ARRAY_SIZE, len(task_args) - offset)
+        submit_file = os.path.join(submit_dir, '%s_array_%d.sh' % (name, i))
+        output = os.path.join(submit_dir, '%s_%%A_%%a.txt' % name)
+        write_file(submit_file, render_array_script(commands, param_file, offset, num_tasks, max_running,
+                                                    output, output, time_limit, node_type,
+                                                    log, always_account, setup, cpus_per_task))
+        job_id = sbatch(submit_file, cwd=submit_dir, extra_args=extra_args)
+        print("Submitted array %s (%d tasks): %s" % (submit_file, num_tasks, job_id))
+        job_ids.append(job_id)
+    return job_ids
+
+
+def submit_after(name, commands, submit_dir, job_ids, node_type, time_limit='00:05:00'):
+    """Submit a job starting once the jobs of job_ids are over, whatever their exit code (e.g. a cleanup)
+
+    :return: job id, None if sbatch failed
+    """
+    make_dir(submit_dir)
+    submit_file = os.path.join(submit_dir, name + '.sh')
+    output = os.path.join(submit_dir, name + '_%j.txt')
+    write_file(submit_file, render_submit_script(commands, output, output, time_limit, node_type))
+    job_id = sbatch(submit_file, cwd=submit_dir, extra_args=['--dependency=afterany:' + ':'.join(job_ids)])
+    print("Submitted %s after %s: %s" % (submit_file, ', '.join(job_ids), job_id))
+    return job_id
+
+
+def array_task_ids(job_ids, num_tasks):
+    """Job id (<array job id>_<task id>) of every task submitted by submit_array, None if its array failed"""
+    task_ids = []
+    for index in range(num_tasks):
+        job_id = job_ids[index // MAX_ARRAY_SIZE]
+        task_ids.append(None if job_id is None else '%s_%d' % (job_id, index % MAX_ARRAY_SIZE))
+    return task_ids
+
+
+def write_file(path, text):
+    """Write (replace) a file with a single write"""
+    with open(path, 'w') as fout:
+        fout.write(text)
+
+
+def make_dir(path, clean=False):
+    """mkdir -p, removing the existing directory first if clean"""
+    if clean and os.path.exists(path):
+        shutil.rmtree(path)
+    if not os.path.isdir(path):
+        os.makedirs(path)
+
+
+def remove_path(path):
+    """rm -rf"""
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
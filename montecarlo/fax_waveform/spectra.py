@@ -0,0 +1,139 @@
+####################################
+## Spectrum-driven sampling of s1_photons / s2_electrons
+## for the fake instructions of WF simulation (CreateFakeCSV.py)
+##
+## Spectra are read from a numpy .npz file holding any of:
+##   photon_edges, electron_edges, counts   : 2D (photons, electrons) histogram,
+##                                            e.g. from np.histogram2d
+##   photon_edges, photon_counts            : 1D photon histogram
+##   electron_edges, electron_counts        : 1D electron histogram
+##   photons, photon_pdf                    : tabulated photon spectrum
+##   electrons, electron_pdf                : tabulated electron spectrum
+## An axis that is not in the file is left to the flat ranges.
+##
+## ex.:
+##   counts, pe, ee = np.histogram2d(s1_photons, s2_electrons, bins=100)
+##   np.savez('Kr83m.npz', photon_edges=pe, electron_edges=ee, counts=counts)
+####################################
+import numpy as np
+
+
+class InverseCDFTable(object):
+    """Sampler for a tabulated spectrum pdf(values)
+
+    The CDF is integrated once with the trapezoid rule and inverted by
+    linear interpolation for each batch of uniform numbers.
+    """
+
+    def __init__(self, values, pdf):
+        values = np.asarray(values, dtype=float)
+        pdf = np.asarray(pdf, dtype=float)
+        if len(values) < 2 or len(values) != len(pdf):
+            raise ValueError("Tabulated spectrum needs at least two (value, pdf) points")
+        if np.any(pdf < 0) or np.any(np.diff(values) <= 0):
+            raise ValueError("Tabulated spectrum needs increasing values and non-negative pdf")
+        cdf = np.concatenate(([0.], np.cumsum(0.5*(pdf[1:] + pdf[:-1])*np.diff(values))))
+        if cdf[-1] <= 0:
+            raise ValueError("Tabulated spectrum has zero integral")
+        self.values = values
+        self.cdf = cdf/cdf[-1]
+
+    def sample(self, n, rng=None):
+        rng = np.random if rng is None else rng
+        return np.interp(rng.uniform(0., 1., n), self.cdf, self.values)
+
+
+class AliasTable(object):
+    """Walker/Vose alias table: O(1) sampling of an index with probability ~ weights"""
+
+    def __init__(self, weights):
+        weights = np.asarray(weights, dtype=float).ravel()
+        if np.any(weights < 0) or weights.sum() <= 0:
+            raise ValueError("Alias table needs non-negative weights with a positive sum")
+        size = len(weights)
+        scaled = weights*size/weights.sum()
+        self.prob = np.ones(size)
+        self.alias = np.arange(size)
+        small = [i for i in range(size) if scaled[i] < 1.]
+        large = [i for i in range(size) if scaled[i] >= 1.]
+        while small and large:
+            s, l = small.pop(), large.pop()
+            self.prob[s] = scaled[s]
+            self.alias[s] = l
+            scaled[l] -= 1. - scaled[s]
+            if scaled[l] < 1.:
+                small.append(l)
+            else:
+                large.append(l)
+
+    def sample(self, n, rng=None):
+        rng = np.random if rng is None else rng
+        index = rng.randint(0, len(self.prob), n)
+        use_alias = rng.uniform(0., 1., n) >= self.prob[index]
+        return np.where(use_alias, self.alias[index], index)
+
+
+class HistogramSampler(object):
+    """Sampler for a 1D or ND histogram; bins picked by alias table, uniform within the bin"""
+
+    def __init__(self, edges, counts):
+        self.edges = [np.asarray(e, dtype=float) for e in edges]
+        counts = np.asarray(counts, dtype=float)
+        if counts.shape != tuple(len(e) - 1 for e in self.edges):
+            raise ValueError("Histogram counts do not match its edges")
+        self.shape = counts.shape
+        self.table = AliasTable(counts)
+
+    def sample(self, n, rng=None):
+        """Return one array per histogram axis"""
+        rng = np.random if rng is None else rng
+        bins = np.unravel_index(self.table.sample(n, rng), self.shape)
+        return [e[b] + rng.uniform(0., 1., n)*(e[b + 1] - e[b]) for (e, b) in zip(self.edges, bins)]
+
+
+class InstructionSpectrum(object):
+    """(s1_photons, s2_electrons) sampler built from a spectrum file"""
+
+    def __init__(self, joint=None, photons=None, electrons=None):
+        self.joint = joint
+        self.photons = photons
+        self.electrons = electrons
+
+    def sample(self, n, rng=None):
+        """Return (photons, electrons), None for an axis not given by the spectrum"""
+        if self.joint is not None:
+            photons, electrons = self.joint.sample(n, rng)
+            return photons, electrons
+        photons = electrons = None
+        if self.photons is not None:
+            photons = self._sample_axis(self.photons, n, rng)
+        if self.electrons is not None:
+            electrons = self._sample_axis(self.electrons, n, rng)
+        return photons, electrons
+
+    @staticmethod
+    def _sample_axis(sampler, n, rng):
+        values = sampler.sample(n, rng)
+        return values[0] if isinstance(values, list) else values
+
+
+def load_spectrum(filename):
+    """Read an .npz spectrum file (see header for the keys)
+
+    :param filename: path to the .npz file
+    :return: InstructionSpectrum
+    """
+    data = np.load(filename)
+    keys = set(data.files)
+    if set(['photon_edges', 'electron_edges', 'counts']) <= keys:
+        return InstructionSpectrum(joint=HistogramSampler([data['photon_edges'], data['electron_edges']],
+                                                          data['counts']))
+    axes = {}
+    for axis, plural in (('photon', 'photons'), ('electron', 'electrons')):
+        if set([axis+'_edges', axis+'_counts']) <= keys:
+            axes[plural] = HistogramSampler([data[axis+'_edges']], data[axis+'_counts'])
+        elif set([plural, axis+'_pdf']) <= keys:
+            axes[plural] = InverseCDFTable(data[plural], data[axis+'_pdf'])
+    if not axes:
+        raise ValueError("No photon/electron spectrum found in %s" % filename)
+    return InstructionSpectrum(**axes)
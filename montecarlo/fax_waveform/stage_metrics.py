@@ -0,0 +1,234 @@
+####################################
+## Resource usage of the job stages
+## `run` executes one stage of a job script (run_fax.sh, run_sim.sh,
+## reconstruction/run_pax.sh) in place of `(time ...)`: it samples the memory
+## of the process tree from /proc while the stage runs and appends one JSON
+## record per stage to a metrics file:
+##   {"stage", "subrun", "exit_code", "wall", "user", "sys" (seconds),
+##    "max_rss_mb" (largest process), "tree_rss_mb" (peak of the whole tree),
+##    "read_bytes", "write_bytes" (storage), "rchar", "wchar" (all reads/writes),
+##    "host", "job", "start"}
+## and prints the times as `time` did in the stage log. The exit code of the
+## stage is passed on (128+signal if it was killed).
+## A stage run through the warm worker (stage_worker.py run) is measured in
+## the fork of the worker running it, which writes its usage to the file of
+## $STAGE_METRICS_FILE, since the `run` client itself does next to nothing.
+## `summary` aggregates the records of a production (metrics files,
+## directories searched for *metrics.jsonl, or the output tarballs of the
+## grid jobs) per stage.
+##
+## Usage:
+##   python stage_metrics.py run <metrics file> <stage> <subrun> <command> [<arg> ...]
+##   python stage_metrics.py summary <metrics file|directory|tarball> [...]
+####################################
+from __future__ import print_function
+
+import errno
+import json
+import os
+import resource
+import signal
+import socket
+import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+
+from subrun_runner import process_children, tree_rss
+from runtime_history import percentile
+
+SAMPLE_INTERVAL = 1.
+# file where the stage worker writes the usage of a stage it ran (see StageUsage)
+METRICS_ENV = 'STAGE_METRICS_FILE'
+METRICS_SUFFIX = 'metrics.jsonl'
+TAR_SUFFIXES = ('.tar', '.tar.bz2', '.tbz2', '.tar.gz', '.tgz')
+
+
+def read_io():
+    """I/O counters of this process, including its finished children (/proc/self/io), None if unavailable"""
+    try:
+        with open('/proc/self/io') as fio:
+            return dict((key, int(value)) for (key, value) in (line.split(':') for line in fio))
+    except (IOError, OSError, ValueError):
+        return None
+
+
+class TreeSampler(object):
+    """Peak memory of a process tree, sampled from a thread so that the stage end is seen at once"""
+
+    def __init__(self, pid, sample_interval=SAMPLE_INTERVAL):
+        self.pid = pid
+        self.sample_interval = sample_interval
+        self.peak = 0.
+        self.done = threading.Event()
+        self.thread = threading.Thread(target=self.sample)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def sample(self):
+        interval = 0.01
+        while not self.done.is_set():
+            self.peak = max(self.peak, tree_rss(self.pid, process_children()))
+            self.done.wait(interval)
+            interval = min(self.sample_interval, 2*interval)
+
+    def stop(self):
+        self.done.set()
+        self.thread.join()
+        return self.peak
+
+
+def make_record(exit_code, start, wall, user, sys_time, max_rss_kb, tree_peak_mb, io_before, io_after):
+    record = {'exit_code': exit_code, 'wall': round(wall, 3), 'user': round(user, 3), 'sys': round(sys_time, 3),
+              'max_rss_mb': round(max_rss_kb/1024., 1), 'tree_rss_mb': round(max(tree_peak_mb, max_rss_kb/1024.), 1),
+              'host': socket.gethostname().split('.')[0], 'job': os.environ.get('SLURM_JOB_ID', ''),
+              'start': int(start)}
+    for key in ('read_bytes', 'write_bytes', 'rchar', 'wchar'):
+        record[key] = io_after[key] - io_before[key] if io_before and io_after else None
+    return record
+
+
+class StageUsage(object):
+    """Usage of a stage run in this process (and its children) from now on, e.g. in a fork of the
+    stage worker"""
+
+    def __init__(self, sample_interval=SAMPLE_INTERVAL):
+        self.io_before = read_io()
+        self.start = time.time()
+        self.before = [resource.getrusage(who) for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)]
+        self.sampler = TreeSampler(os.getpid(), sample_interval)
+
+    def record(self, exit_code):
+        wall = time.time() - self.start
+        tree_peak = self.sampler.stop()
+        after = [resource.getrusage(who) for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)]
+        user = sum(usage.ru_utime for usage in after) - sum(usage.ru_utime for usage in self.before)
+        sys_time = sum(usage.ru_stime for usage in after) - sum(usage.ru_stime for usage in self.before)
+        return make_record(exit_code, self.start, wall, user, sys_time, max(usage.ru_maxrss for usage in after),
+                           tree_peak, self.io_before, read_io())
+
+
+def run_stage(command, sample_interval=SAMPLE_INTERVAL):
+    """Run a command, sampling the memory of its process tree; the usage of a stage run by the
+    stage worker is the one the worker measured
+
+    :return: (exit code, resource record without stage/subrun)
+    """
+    fd, worker_metrics = tempfile.mkstemp(prefix='stage_metrics_')
+    os.close(fd)
+    io_before = read_io()
+    start = time.time()
+    process = subprocess.Popen(command, env=dict(os.environ, **{METRICS_ENV: worker_metrics}))
+    # Slurm/HTCondor stop the job with SIGTERM: passed to the stage, which is still recorded
+    signal.signal(signal.SIGTERM, lambda signum, frame: process.send_signal(signum))
+    sampler = TreeSampler(process.pid, sample_interval)
+    while True:
+        try:
+            pid, status, usage = os.wait4(process.pid, 0)
+            break
+        except OSError as error:
+            # interrupted by the SIGTERM handler (python 2)
+            if error.errno != errno.EINTR:
+                raise
+    wall = time.time() - start
+    tree_peak = sampler.stop()
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    exit_code = 128 + os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+    record = make_record(exit_code, start, wall, usage.ru_utime, usage.ru_stime, usage.ru_maxrss, tree_peak,
+                         io_before, read_io())
+    with open(worker_metrics) as fworker:
+        worker_record = fworker.read()
+    os.remove(worker_metrics)
+    if worker_record:
+        # wall time and exit code as seen by the job
+        record.update((key, value) for (key, value) in json.loads(worker_record).items()
+                      if key not in ('exit_code', 'wall', 'start'))
+    return exit_code, record
+
+
+def append_record(path, record):
+    """One line per stage, written at once (O_APPEND)"""
+    with open(path, 'a') as fmetrics:
+        fmetrics.write(json.dumps(record, sort_keys=True) + '\n')
+
+
+def read_records(paths):
+    """Records of metrics files, of the *metrics.jsonl files under directories and in tarballs"""
+    for path in paths:
+        if os.path.isdir(path):
+            for (dirpath, _, filenames) in os.walk(path):
+                for filename in sorted(filenames):
+                    if filename.endswith(METRICS_SUFFIX):
+                        for record in read_records([os.path.join(dirpath, filename)]):
+                            yield record
+        elif path.endswith(TAR_SUFFIXES):
+            with tarfile.open(path) as tar:
+                for member in tar.getmembers():
+                    if member.isfile() and member.name.endswith(METRICS_SUFFIX):
+                        for line in tar.extractfile(member).read().decode().splitlines():
+                            if line.strip():
+                                yield json.loads(line)
+        else:
+            with open(path) as fmetrics:
+                for line in fmetrics:
+                    if line.strip():
+                        yield json.loads(line)
+
+
+def summarize(records):
+    """Per stage: number of runs and failures, wall time, cpu efficiency, memory and I/O
+
+    :return: list of (stage, dict of the aggregated values)
+    """
+    stages = {}
+    for record in records:
+        stages.setdefault(record['stage'], []).append(record)
+    summary = []
+    for stage in sorted(stages):
+        runs = stages[stage]
+        walls = [run['wall'] for run in runs]
+        rss = [run['tree_rss_mb'] for run in runs]
+        cpu = sum(run['user'] + run['sys'] for run in runs)
+        read = [run['read_bytes'] for run in runs if run.get('read_bytes') is not None]
+        written = [run['write_bytes'] for run in runs if run.get('write_bytes') is not None]
+        summary.append((stage, {'runs': len(runs), 'failed': sum(1 for run in runs if run['exit_code'] != 0),
+                                'wall_median': percentile(walls, 50), 'wall_p95': percentile(walls, 95),
+                                'wall_max': max(walls), 'wall_total': sum(walls),
+                                'cpu_efficiency': cpu/sum(walls) if sum(walls) else 0.,
+                                'rss_median_mb': percentile(rss, 50), 'rss_p95_mb': percentile(rss, 95),
+                                'rss_max_mb': max(rss),
+                                'read_mb_mean': sum(read)/1e6/len(read) if read else 0.,
+                                'write_mb_mean': sum(written)/1e6/len(written) if written else 0.}))
+    return summary
+
+
+if __name__ == '__main__':
+    if len(sys.argv)<2 or sys.argv[1] not in ('run', 'summary') or (sys.argv[1]=='run' and len(sys.argv)<6) \
+            or (sys.argv[1]=='summary' and len(sys.argv)<3):
+        print("========= Syntax ==========")
+        print("python stage_metrics.py run <metrics file> <stage> <subrun> <command> [<arg> ...]")
+        print("python stage_metrics.py summary <metrics file|directory|tarball> [...]")
+        exit()
+
+    if sys.argv[1]=='run':
+        ExitCode, Record = run_stage(sys.argv[5:])
+        Record['stage'] = sys.argv[3]
+        Record['subrun'] = sys.argv[4]
+        append_record(sys.argv[2], Record)
+        # as bash `time` in the stage log (parsed by cost_model.py)
+        for Key in ('real', 'user', 'sys'):
+            Seconds = Record['wall' if Key=='real' else Key]
+            print("%s%s\t%dm%.3fs" % ('\n' if Key=='real' else '', Key, Seconds // 60, Seconds % 60), file=sys.stderr)
+        print("max RSS\t%.1f MB (process tree %.1f MB)" % (Record['max_rss_mb'], Record['tree_rss_mb']), file=sys.stderr)
+        sys.exit(ExitCode)
+
+    print("%-18s %6s %6s %9s %9s %9s %7s %9s %9s %9s %9s" % ("stage", "runs", "failed", "wall p50", "wall p95",
+                                                             "wall max", "cpu/wall", "RSS p50", "RSS max",
+                                                             "read/run", "write/run"))
+    for (Stage, Values) in summarize(read_records(sys.argv[2:])):
+        print("%-18s %6d %6d %8.1fs %8.1fs %8.1fs %7.2f %7dMB %7dMB %7dMB %7dMB"
+              % (Stage, Values['runs'], Values['failed'], Values['wall_median'], Values['wall_p95'],
+                 Values['wall_max'], Values['cpu_efficiency'], Values['rss_median_mb'], Values['rss_max_mb'],
+                 Values['read_mb_mean'], Values['write_mb_mean']))
@@ -0,0 +1,240 @@
+####################################
+## Warm Python worker for the Python stages of the job scripts
+## Truth sorting, merging, truth conversion and minitree creation (hax,
+## haxer, laxer) each start a new Python and import numpy/pandas/ROOT/hax
+## again, for several seconds apiece. `serve` starts one worker per job (or
+## per node) on a local socket, imports these modules once, and runs every
+## stage sent to it in a fork of itself, i.e. with the imports already done
+## and without state left over from the previous stages.
+## `run` sends a stage (a script, a command of the PATH written in Python
+## such as haxer, or -c <code>) to the worker of $STAGE_WORKER_SOCKET: the
+## stage runs in the current directory and environment, with the stdin,
+## stdout and stderr of `run` (passed over the socket), and `run` exits with
+## its exit code. Without a worker (no $STAGE_WORKER_SOCKET, Python 2), `run`
+## runs the stage itself, so job commands can always use it.
+## The socket is created in a directory only the job writes to (mktemp -d,
+## removed with the job); the worker fails rather than replace a path that
+## exists already. The worker exits when the job script that started it is
+## over, or after IDLE_TIMEOUT seconds without a stage. A stage run under
+## stage_metrics.py is measured in its fork ($STAGE_METRICS_FILE), not in the
+## `run` client.
+##
+## Usage:
+##   python stage_worker.py serve <socket> [<module> ...]   (default modules: PRELOAD)
+##   python stage_worker.py run <script|command|-c code> [<arg> ...]
+####################################
+from __future__ import print_function
+
+import array
+import importlib
+import json
+import os
+import runpy
+import signal
+import socket
+import subprocess
+import sys
+import time
+import traceback
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+from stage_metrics import StageUsage, METRICS_ENV
+
+WORKER_EXE = os.path.abspath(__file__)
+SOCKET_ENV = 'STAGE_WORKER_SOCKET'
+PRELOAD = ['numpy', 'pandas', 'ROOT', 'root_numpy', 'hax']
+IDLE_TIMEOUT = 600
+POLL_INTERVAL = 5
+# time for a worker started in the background to create its socket
+CONNECT_TIMEOUT = 30
+
+
+def python_stage(script, args=''):
+    """Job command line running a Python stage through the worker of the job, if any"""
+    return 'python %s run %s %s' % (WORKER_EXE, script, args)
+
+
+def worker_session():
+    """Job command lines starting a worker for the stages of the job (it exits with the job)"""
+    return ['STAGE_WORKER_DIR=$(mktemp -d /tmp/stage_worker_XXXXXX)',
+            "trap 'rm -rf ${STAGE_WORKER_DIR}' EXIT",
+            'export %s=${STAGE_WORKER_DIR}/socket' % SOCKET_ENV,
+            'python %s serve $%s > /dev/null 2>&1 &' % (WORKER_EXE, SOCKET_ENV)]
+
+
+def resolve(argv):
+    """(path of the Python script, argv of the stage) or (None, argv) for code given with -c"""
+    if argv[0] == '-c':
+        return None, argv
+    if os.path.sep not in argv[0]:
+        for directory in os.environ.get('PATH', '').split(os.pathsep):
+            path = os.path.join(directory, argv[0])
+            if os.path.isfile(path) and os.access(path, os.X_OK):
+                return path, [path] + argv[1:]
+    return argv[0], argv
+
+
+def is_python(path):
+    if not os.path.isfile(path):
+        return path.endswith('.py')
+    with open(path, 'rb') as fscript:
+        first_line = fscript.readline()
+    return path.endswith('.py') or (first_line.startswith(b'#!') and b'python' in first_line)
+
+
+def run_here(argv):
+    """Run a stage in this process, return its exit code"""
+    path, sys.argv = resolve(argv)
+    if path is not None and not is_python(path):
+        return subprocess.call(sys.argv)
+    try:
+        # as python does for a script or -c
+        if path is None:
+            sys.argv = ['-c'] + argv[2:]
+            sys.path[0] = ''
+            exec(compile(argv[1], '<string>', 'exec'), {'__name__': '__main__'})
+        else:
+            sys.path[0] = os.path.dirname(os.path.abspath(path))
+            runpy.run_path(path, run_name='__main__')
+        exit_code = 0
+    except SystemExit as exit:
+        if exit.code is None or isinstance(exit.code, int):
+            exit_code = exit.code or 0
+        else:
+            print(exit.code, file=sys.stderr)
+            exit_code = 1
+    except BaseException:
+        traceback.print_exc()
+        exit_code = 1
+    sys.stdout.flush()
+    sys.stderr.flush()
+    return exit_code
+
+
+def run_direct(argv):
+    """Without a worker: exec the stage"""
+    path, argv = resolve(argv)
+    if path is None or is_python(path):
+        os.execv(sys.executable, [sys.executable] + argv)
+    os.execv(path, argv)
+
+
+class StageHandler(socketserver.BaseRequestHandler):
+    """Runs one stage, in the fork of the worker made for this connection"""
+
+    def handle(self):
+        # header: length of the request, with the stdin/stdout/stderr of the client
+        fds = array.array('i')
+        header, ancdata, _, _ = self.request.recvmsg(64, socket.CMSG_LEN(3*fds.itemsize))
+        for (level, kind, data) in ancdata:
+            if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+                fds.frombytes(data[:len(data) - len(data) % fds.itemsize])
+        length, _, body = header.partition(b'\n')
+        while len(body) < int(length):
+            body += self.request.recv(int(length) - len(body))
+        request = json.loads(body.decode())
+        for (target, fd) in enumerate(fds):
+            os.dup2(fd, target)
+            os.close(fd)
+        os.chdir(request['cwd'])
+        os.environ.clear()
+        os.environ.update(request['env'])
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        self.request.sendall(('%d\n' % os.getpid()).encode())
+        metrics_file = os.environ.get(METRICS_ENV)
+        usage = StageUsage() if metrics_file else None
+        exit_code = run_here(request['argv'])
+        if usage is not None:
+            with open(metrics_file, 'w') as fmetrics:
+                fmetrics.write(json.dumps(usage.record(exit_code)))
+        self.request.sendall(('exit %d\n' % exit_code).encode())
+
+
+class StageServer(socketserver.ForkingMixIn, socketserver.UnixStreamServer):
+    request_queue_size = 64
+    timeout = POLL_INTERVAL
+    last_request = 0.
+
+    def process_request(self, request, client_address):
+        self.last_request = time.time()
+        socketserver.ForkingMixIn.process_request(self, request, client_address)
+
+
+def serve(path, modules=PRELOAD):
+    """Bind the socket (clients queue from now on), import the modules, then run the stages
+
+    The socket goes in a directory of the job (an existing path is an error, not replaced).
+    """
+    server = StageServer(path, StageHandler)
+    parent = os.getppid()
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
+    try:
+        for module in modules:
+            try:
+                importlib.import_module(module)
+            except Exception:
+                pass
+        server.last_request = time.time()
+        while os.getppid() == parent and (server.active_children or
+                                          time.time() - server.last_request < IDLE_TIMEOUT):
+            server.handle_request()
+    finally:
+        # the job may have removed its directory already
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def run(argv):
+    """Run a stage in the worker of $STAGE_WORKER_SOCKET, or here without one; return its exit code"""
+    path = os.environ.get(SOCKET_ENV)
+    if not path or not hasattr(socket, 'CMSG_LEN'):
+        run_direct(argv)
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    deadline = time.time() + CONNECT_TIMEOUT
+    while True:
+        try:
+            connection.connect(path)
+            break
+        except socket.error:
+            if time.time() > deadline:
+                run_direct(argv)
+            time.sleep(0.1)
+    body = json.dumps({'argv': argv, 'cwd': os.getcwd(), 'env': dict(os.environ)}).encode()
+    sys.stdout.flush()
+    sys.stderr.flush()
+    connection.sendmsg([('%d\n' % len(body)).encode()],
+                       [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', [0, 1, 2]))])
+    connection.sendall(body)
+    stage = connection.makefile('r')
+    pid = int(stage.readline() or 0)
+    signals = []
+
+    def forward(signum, frame):
+        signals.append(signum)
+        os.kill(pid, signum)
+
+    if pid:
+        # a job stopped at its time limit stops its stage too
+        signal.signal(signal.SIGTERM, forward)
+    for line in stage:
+        if line.startswith('exit '):
+            return int(line.split()[1])
+    # the stage died without reporting its exit code (killed)
+    return 128 + signals[0] if signals else 1
+
+
+if __name__ == '__main__':
+    if len(sys.argv)<3 or sys.argv[1] not in ('serve', 'run'):
+        print("========= Syntax ==========")
+        print("python stage_worker.py serve <socket> [<module> ...]")
+        print("python stage_worker.py run <script|command|-c code> [<arg> ...]")
+        exit()
+
+    if sys.argv[1]=='serve':
+        serve(sys.argv[2], sys.argv[3:] or PRELOAD)
+    else:
+        sys.exit(run(sys.argv[2:]))
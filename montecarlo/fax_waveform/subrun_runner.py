@@ -0,0 +1,176 @@
+####################################
+## Node-level runner: several subruns in parallel inside one allocation
+## Runs the task script once per line of a parameter file (the line gives the
+## arguments $1, $2, ... of the script, e.g. "<events> <subrun>" for the fax
+## jobs of MidwayBatch.py), for a range of lines, with up to N pipelines at
+## the same time (one per allocated cpu). Every task writes its own log (the
+## fax task script redirects to <subrun>/submit_<subrun>.log).
+## A new pipeline only starts if the memory of the allocation allows it: the
+## memory taken by the running pipelines (resident size of their processes)
+## plus what a new one needs (the largest peak seen so far, at least the
+## given estimate) must fit in the allocation (Slurm memory, else the free
+## memory of the node), and the node must still have that much available.
+## The tasks get the number of workers in FAX_CONCURRENT_SUBRUNS, to share
+## node-local resources (run_fax.sh splits its /dev/shm quota between them).
+##
+## Usage:
+##   python subrun_runner.py <task script> <parameter file> <first line> <last line> [<workers> [<MB per task>]]
+##   (lines counted from 0, workers default: allocated cpus)
+####################################
+import os
+import subprocess
+import sys
+import time
+
+from runtime_history import parse_time_limit, format_time_limit, MAX_TIME_LIMIT
+
+RUNNER_EXE = os.path.abspath(__file__)
+# memory of one fax pipeline until a larger one is measured
+MEMORY_PER_TASK_MB = 2000
+POLL_INTERVAL = 2.
+# subruns of a multi-core job per core, fewer if the job would exceed MAX_TIME_LIMIT
+SUBRUNS_PER_CORE = 10
+
+
+def read_meminfo():
+    """/proc/meminfo in MB"""
+    info = {}
+    with open('/proc/meminfo') as fmeminfo:
+        for line in fmeminfo:
+            fields = line.split()
+            info[fields[0].rstrip(':')] = int(fields[1]) / 1024.
+    return info
+
+
+def memory_budget():
+    """Memory (MB) the runner may use: the Slurm allocation, else what the node has available"""
+    if 'SLURM_MEM_PER_NODE' in os.environ:
+        return float(os.environ['SLURM_MEM_PER_NODE'])
+    if 'SLURM_MEM_PER_CPU' in os.environ:
+        return float(os.environ['SLURM_MEM_PER_CPU']) * int(os.environ.get('SLURM_CPUS_PER_TASK', 1))
+    return read_meminfo()['MemAvailable']
+
+
+def process_children():
+    """pid -> list of child pids, from /proc"""
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open('/proc/%s/stat' % entry) as fstat:
+                # the command name may contain spaces: the parent pid is after its closing parenthesis
+                ppid = int(fstat.read().rsplit(')', 1)[1].split()[1])
+        except (IOError, OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+    return children
+
+
+def tree_rss(pid, children):
+    """Resident memory (MB) of a process and all its descendants"""
+    rss = 0.
+    pids = [pid]
+    while pids:
+        current = pids.pop()
+        pids.extend(children.get(current, []))
+        try:
+            with open('/proc/%d/status' % current) as fstatus:
+                for line in fstatus:
+                    if line.startswith('VmRSS:'):
+                        rss += int(line.split()[1]) / 1024.
+        except (IOError, OSError):
+            continue
+    return rss
+
+
+class SubrunRunner(object):
+    """Run the tasks of a range of parameter lines with memory-aware admission"""
+
+    def __init__(self, task_script, task_args, num_workers, memory_per_task=MEMORY_PER_TASK_MB,
+                 budget=None, poll_interval=POLL_INTERVAL):
+        self.task_script = task_script
+        self.waiting = list(task_args)
+        self.num_workers = num_workers
+        self.estimate = memory_per_task
+        self.budget = memory_budget() if budget is None else budget
+        self.poll_interval = poll_interval
+        self.running = {}
+        self.exit_codes = []
+        self.env = dict(os.environ, FAX_CONCURRENT_SUBRUNS=str(num_workers))
+
+    def admit(self, used):
+        """Whether one more pipeline fits next to the running ones using `used` MB"""
+        if not self.running:
+            return True
+        if len(self.running) >= self.num_workers:
+            return False
+        needed = self.estimate
+        return used + needed <= self.budget and read_meminfo()['MemAvailable'] >= needed
+
+    def poll(self):
+        """Reap the finished tasks, measure the running ones; return the memory they use (MB)"""
+        children = process_children()
+        used = 0.
+        for (args, process) in list(self.running.items()):
+            if process.poll() is not None:
+                self.exit_codes.append(process.returncode)
+                print("%s: exit code %d" % (' '.join(args), process.returncode))
+                del self.running[args]
+                continue
+            rss = tree_rss(process.pid, children)
+            # a pipeline may still grow: it counts for at least the estimate
+            self.estimate = max(self.estimate, rss)
+            used += max(rss, self.estimate)
+        return used
+
+    def run(self):
+        """:return: number of failed tasks"""
+        while self.waiting or self.running:
+            used = self.poll()
+            while self.waiting and self.admit(used):
+                args = tuple(self.waiting.pop(0))
+                self.running[args] = subprocess.Popen(['bash', self.task_script] + list(args), env=self.env)
+                used += self.estimate
+                print("%s: started, %d running, %d MB of %d MB" % (' '.join(args), len(self.running),
+                                                                    used, self.budget))
+            time.sleep(self.poll_interval)
+        return sum(1 for exit_code in self.exit_codes if exit_code != 0)
+
+
+def runner_groups(num_tasks, cores, time_limit):
+    """Split num_tasks subruns into multi-core jobs
+
+    :param time_limit: Slurm time limit of one subrun
+    :return: list of (first, last) task indices of each job, time limit of a job
+    """
+    waves = max(1, min(SUBRUNS_PER_CORE, MAX_TIME_LIMIT // parse_time_limit(time_limit)))
+    size = waves*cores
+    groups = [(first, min(first + size, num_tasks) - 1) for first in range(0, num_tasks, size)]
+    return groups, format_time_limit(waves*parse_time_limit(time_limit))
+
+
+def read_task_args(param_file, first, last):
+    with open(param_file) as fparams:
+        lines = fparams.readlines()
+    return [line.split() for line in lines[first:last + 1] if line.strip()]
+
+
+if __name__ == '__main__':
+    if len(sys.argv)<5:
+        print("========= Syntax ==========")
+        print("python subrun_runner.py <task script> <parameter file> <first line> <last line> "
+              "[<workers> (default: allocated cpus)] [<MB per task> (default %d)]" % MEMORY_PER_TASK_MB)
+        exit()
+
+    TaskArgs = read_task_args(sys.argv[2], int(sys.argv[3]), int(sys.argv[4]))
+    NumWorkers = int(os.environ.get('SLURM_CPUS_PER_TASK', 1))
+    if len(sys.argv)>5:
+        NumWorkers = int(sys.argv[5])
+    MemoryPerTask = MEMORY_PER_TASK_MB
+    if len(sys.argv)>6:
+        MemoryPerTask = float(sys.argv[6])
+    Runner = SubrunRunner(sys.argv[1], TaskArgs, NumWorkers, MemoryPerTask)
+    NumFailed = Runner.run()
+    print("Runner finished, "+str(NumFailed)+" failed task(s) of "+str(len(TaskArgs)))
+    sys.exit(1 if NumFailed else 0)
@@ -0,0 +1,153 @@
+####################################
+## Task farm: pack many short tasks into a few Slurm allocations
+## The tasks are the lines of a task file, one shell command line per task.
+## Each allocation runs `python task_farm.py run`, whose workers claim the
+## tasks one by one (atomic claim file in the status directory), so any
+## number of allocations drain the same task list.
+## Every task gets its own log and exit code in the status directory:
+##   task_<line>.claim, task_<line>.log, task_<line>.exit
+## A claimed task without exit code was cut by the end of its allocation;
+## `status` lists it, and removing its .claim file makes it run again.
+##
+## Usage:
+##   python task_farm.py run <task file> <status dir> [<number of workers>]
+##   python task_farm.py status <task file> <status dir>
+####################################
+import errno
+import os
+import socket
+import subprocess
+import sys
+import threading
+
+from slurm_submit import render_submit_script, write_file, make_dir, sbatch
+from stage_worker import worker_session
+
+FARM_EXE = os.path.abspath(__file__)
+
+
+def read_tasks(task_file):
+    """Command lines of a task file; the index of a task is its line number"""
+    with open(task_file) as ftasks:
+        return [line.strip() for line in ftasks]
+
+
+def task_path(status_dir, index, suffix):
+    return os.path.join(status_dir, 'task_%d.%s' % (index, suffix))
+
+
+def claim_task(status_dir, index):
+    """Claim a task for this worker, False if another worker (or allocation) has it"""
+    try:
+        fd = os.open(task_path(status_dir, index, 'claim'), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except OSError as error:
+        if error.errno == errno.EEXIST:
+            return False
+        raise
+    os.write(fd, ('%s %s\n' % (socket.gethostname(), os.environ.get('SLURM_JOB_ID', os.getpid()))).encode())
+    os.close(fd)
+    return True
+
+
+def run_task(command, status_dir, index):
+    """Run one task, its output going to its log, and record its exit code"""
+    with open(task_path(status_dir, index, 'log'), 'w') as flog:
+        exit_code = subprocess.call(['bash', '-c', command], stdout=flog, stderr=subprocess.STDOUT)
+    exit_file = task_path(status_dir, index, 'exit')
+    write_file(exit_file + '.tmp', '%d\n' % exit_code)
+    os.rename(exit_file + '.tmp', exit_file)
+    return exit_code
+
+
+def run_farm(task_file, status_dir, num_workers):
+    """Drain the task list with num_workers local workers
+
+    :return: number of failed tasks run by this allocation
+    """
+    tasks = read_tasks(task_file)
+    make_dir(status_dir)
+    failed = []
+
+    def worker():
+        for (index, command) in enumerate(tasks):
+            if command and claim_task(status_dir, index):
+                if run_task(command, status_dir, index) != 0:
+                    failed.append(index)
+
+    workers = [threading.Thread(target=worker) for _ in range(num_workers)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return len(failed)
+
+
+def farm_status(task_file, status_dir):
+    """Task indices by state: done, failed, claimed (running or cut) and waiting"""
+    status = {'done': [], 'failed': [], 'claimed': [], 'waiting': []}
+    for (index, command) in enumerate(read_tasks(task_file)):
+        if not command:
+            continue
+        exit_file = task_path(status_dir, index, 'exit')
+        if os.path.exists(exit_file):
+            with open(exit_file) as fexit:
+                status['done' if int(fexit.read()) == 0 else 'failed'].append(index)
+        elif os.path.exists(task_path(status_dir, index, 'claim')):
+            status['claimed'].append(index)
+        else:
+            status['waiting'].append(index)
+    return status
+
+
+def submit_farm(name, tasks, submit_dir, num_allocations, num_workers, time_limit, node_type,
+                always_account=False, setup=None, warm_worker=False):
+    """Submit tasks as a farm of allocations sharing one task list
+
+    :param name: farm name, used for the task file, status directory and submit files in submit_dir
+    :param tasks: list of shell command lines (use && to chain the commands of a task)
+    :param num_allocations: number of allocations (capped to the number of tasks)
+    :param num_workers: tasks running at the same time in an allocation (one cpu each)
+    :param warm_worker: start a stage_worker.py per allocation, for the Python stages of the tasks
+    :return: list of job ids (None for a failed submission)
+    """
+    make_dir(submit_dir)
+    task_file = os.path.join(submit_dir, name + '_tasks.txt')
+    status_dir = os.path.join(submit_dir, name + '_status')
+    write_file(task_file, ''.join(task + '\n' for task in tasks))
+    make_dir(status_dir, clean=True)
+    job_ids = []
+    for i in range(max(1, min(num_allocations, len(tasks)))):
+        submit_file = os.path.join(submit_dir, '%s_farm_%d.sh' % (name, i))
+        output = os.path.join(submit_dir, '%s_farm_%d.txt' % (name, i))
+        command = ' '.join(['python', FARM_EXE, 'run', task_file, status_dir, str(num_workers)])
+        commands = (worker_session() if warm_worker else []) + [command]
+        write_file(submit_file, render_submit_script(commands, output, output, time_limit, node_type,
+                                                     always_account, setup, cpus_per_task=num_workers))
+        job_id = sbatch(submit_file, cwd=submit_dir)
+        print("Submitted farm allocation %s (%d tasks in total): %s" % (submit_file, len(tasks), job_id))
+        job_ids.append(job_id)
+    return job_ids
+
+
+if __name__ == '__main__':
+    if len(sys.argv)<4 or sys.argv[1] not in ('run', 'status'):
+        print("========= Syntax ==========")
+        print("python task_farm.py run <task file> <status dir> [<number of workers> (default: allocated cpus)]")
+        print("python task_farm.py status <task file> <status dir>")
+        exit()
+
+    TaskFile = sys.argv[2]
+    StatusDir = sys.argv[3]
+    if sys.argv[1]=='run':
+        NumWorkers = int(os.environ.get('SLURM_CPUS_PER_TASK', 1))
+        if len(sys.argv)>4:
+            NumWorkers = int(sys.argv[4])
+        NumFailed = run_farm(TaskFile, StatusDir, NumWorkers)
+        print("Farm finished, "+str(NumFailed)+" failed task(s), see "+StatusDir)
+        sys.exit(1 if NumFailed else 0)
+    else:
+        Status = farm_status(TaskFile, StatusDir)
+        for State in ['done', 'failed', 'claimed', 'waiting']:
+            print(State+": "+str(len(Status[State])))
+        for index in Status['failed']:
+            print("failed: "+task_path(StatusDir, index, 'log'))
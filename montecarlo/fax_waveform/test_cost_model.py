@@ -0,0 +1,102 @@
+####################################
+## Tests of cost_model.py: the coefficients of synthetic productions (timing
+## logs made from known coefficients) are recovered, and the jobs are cut at
+## the predicted budget
+##
+## Usage:
+##   python -m unittest test_cost_model
+####################################
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from CreateFakeCSV import create_instructions, write_instructions
+from cost_model import CostModel, collect_samples, events_within_budget
+
+# job, event, photon, electron
+SINGLE_PASS = {'job': 30., 'event': 0.5, 'photon': 0.002, 'electron': 0.0004}
+TWO_PASS = {'job': 60., 'event': 0.8, 'photon': 0.003, 'electron': 0.001}
+
+
+def runtime(coefficients, instructions):
+    return (coefficients['job'] + coefficients['event']*(instructions['instruction'].max() + 1)
+            + coefficients['photon']*instructions['s1_photons'].sum()
+            + coefficients['electron']*instructions['s2_electrons'].sum())
+
+
+def write_time_log(path, seconds):
+    with open(path, 'w') as flog:
+        flog.write("paxing\n\nreal\t%dm%.3fs\nuser\t0m1.000s\nsys\t0m0.100s\n" % (seconds//60, seconds % 60))
+
+
+class CostModelTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def make_production(self, name, coefficients, save_raw, subruns=8):
+        production = os.path.join(self.dir, name)
+        rng = np.random.RandomState(len(name))
+        for i in range(subruns):
+            subrun = '%06d' % i
+            subrun_path = os.path.join(production, subrun)
+            os.makedirs(subrun_path)
+            instructions = create_instructions('XENON1T', int(rng.randint(20, 200)), 10, int(rng.randint(50, 2000)),
+                                               10, int(rng.randint(50, 5000)), True, None, rng)
+            filename = os.path.join(subrun_path, 'FakeWaveform_XENON1T_%s' % subrun)
+            write_instructions(filename + '.csv', instructions, 'ER')
+            with open(os.path.join(subrun_path, 'submit_%s.sh' % subrun), 'w') as fsubmit:
+                fsubmit.write('#!/bin/bash\n./run_fax.sh 10 2000 10 5000 1 1 100 %s %s 0 none %d 0\n'
+                              % (production, subrun, save_raw))
+            total = runtime(coefficients, instructions)
+            if save_raw:
+                # fax and pax in two paxer runs, their times add up
+                write_time_log(filename + '_raw.log', 0.7*total)
+                write_time_log(filename + '_pax.log', 0.3*total)
+            else:
+                write_time_log(filename + '_pax.log', total)
+        return production
+
+    def assert_coefficients(self, fitted, expected):
+        for (name, value) in expected.items():
+            self.assertAlmostEqual(fitted[name], value, delta=1e-3*value + 1e-5, msg=name)
+
+    def test_recovers_coefficients(self):
+        samples = collect_samples([self.make_production('single', SINGLE_PASS, 0),
+                                   self.make_production('raw', TWO_PASS, 1)])
+        self.assertEqual(len(samples), 16)
+        model = CostModel.fit(samples)
+        self.assert_coefficients(model.coefficients(1, 1, 0), SINGLE_PASS)
+        self.assert_coefficients(model.coefficients(1, 1, 1), TWO_PASS)
+        # other afterpulse settings fall back to the model of their save raw mode
+        self.assert_coefficients(model.coefficients(0, 0, 1), TWO_PASS)
+
+    def test_two_pass_without_raw_log_skipped(self):
+        production = self.make_production('raw', TWO_PASS, 1, subruns=2)
+        os.remove(os.path.join(production, '000001', 'FakeWaveform_XENON1T_000001_raw.log'))
+        self.assertEqual(len(collect_samples([production])), 1)
+
+    def test_save_and_load(self):
+        path = os.path.join(self.dir, 'model.json')
+        CostModel({'all': SINGLE_PASS}).save(path)
+        self.assertEqual(CostModel.load(path).coefficients(0, 1), SINGLE_PASS)
+
+    def test_events_within_budget(self):
+        model = CostModel({'all': {'job': 100., 'event': 1., 'photon': 0.01, 'electron': 0.}})
+        instructions = create_instructions('XENON1T', 50, 100, 101, 10, 11, False, None, np.random.RandomState(1))
+        # every event costs 1 + 0.01*100 = 2 s: 10 of them fit in 21 s
+        kept = events_within_budget(model, instructions, 21., 1, 1)
+        self.assertEqual(kept['instruction'].max() + 1, 10)
+        self.assertEqual(len(kept['instruction']), 20)
+        # at least one event, however small the budget
+        self.assertEqual(events_within_budget(model, instructions, 0., 1, 1)['instruction'].max() + 1, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+####################################
+## Tests of fiducial_volume.py: the sampled points are inside their volume
+## and uniform in it
+##
+## Usage:
+##   python -m unittest test_fiducial_volume
+####################################
+import unittest
+
+import numpy as np
+
+from fiducial_volume import FIDUCIAL_VOLUMES, LinearRadius2Cylinder, get_fiducial_volume
+
+
+class FiducialVolumeTest(unittest.TestCase):
+
+    def test_samples_inside(self):
+        for (detector, fv) in sorted(FIDUCIAL_VOLUMES.items()):
+            x, y, z = fv.sample(10000, np.random.RandomState(1))
+            self.assertEqual((len(x), len(y), len(z)), (10000, 10000, 10000))
+            self.assertTrue(np.all(fv.contains(x, y, z)), detector)
+            self.assertTrue(0. < fv.acceptance <= 1., detector)
+
+    def test_no_samples(self):
+        for fv in FIDUCIAL_VOLUMES.values():
+            for coordinate in fv.sample(0, np.random.RandomState(1)):
+                self.assertEqual(coordinate.shape, (0,))
+
+    def test_uniform_cylinder(self):
+        fv = LinearRadius2Cylinder(z_lower=-90., z_upper=-15., r2_intercept=1750., r2_slope=3.5)
+        n = 200000
+        x, y, z = fv.sample(n, np.random.RandomState(2))
+        # points per z slice proportional to its volume, the integral of radius^2 over the slice
+        edges = np.linspace(fv.z_lower, fv.z_upper, 6)
+        r2_integral = fv.r2_intercept*edges + fv.r2_slope*edges**2/2
+        expected = np.diff(r2_integral)/(r2_integral[-1] - r2_integral[0])*n
+        counts = np.histogram(z, edges)[0]
+        self.assertTrue(np.all(np.abs(counts - expected) < 5*np.sqrt(expected)), (counts, expected))
+        # inside a slice, radius^2/radius^2(z) and the azimuth are uniform
+        u = (x**2 + y**2)/fv.radius2(z)
+        self.assertAlmostEqual(np.mean(u), 0.5, delta=0.005)
+        self.assertAlmostEqual(np.mean(u < 0.25), 0.25, delta=0.005)
+        phi = np.arctan2(y, x)
+        self.assertAlmostEqual(np.mean(phi > 0), 0.5, delta=0.005)
+
+    def test_unknown_detector(self):
+        self.assertRaises(ValueError, get_fiducial_volume, 'XENONnT')
+
+
+if __name__ == '__main__':
+    unittest.main()
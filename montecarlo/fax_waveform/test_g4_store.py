@@ -0,0 +1,91 @@
+####################################
+## Tests of g4_store.py: output tarballs made by package_outputs.py (and by
+## the older packager, as concatenated bz2 streams) are stored by their G4
+## products and found again under their key
+##
+## Usage:
+##   python -m unittest test_g4_store
+####################################
+import bz2
+import os
+import shutil
+import subprocess
+import tarfile
+import tempfile
+import unittest
+
+from g4_store import G4Store, g4_key, g4_tarball
+from package_outputs import package, CHECKSUM_FILE
+
+G4_PRODUCTS = ['1_g4mc_G4.root', '1_g4mc_G4_Sort.root', '1_g4mc_G4_Patch.root', '1_g4mc_G4.log']
+OTHER_PRODUCTS = ['1_g4mc_G4_Sort_pax.root', '1_g4mc_G4_Sort_pax_Basics.root', 'run_sim.log']
+
+
+class G4StoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.output_dir = os.path.join(self.dir, 'output')
+        self.work_dir = os.path.join(self.dir, 'work')
+        self.products_dir = os.path.join(self.dir, 'products')
+        for path in (self.output_dir, self.work_dir, self.products_dir):
+            os.makedirs(path)
+        for name in G4_PRODUCTS + OTHER_PRODUCTS:
+            with open(os.path.join(self.products_dir, name), 'w') as fproduct:
+                fproduct.write(name*1000)
+        self.store = G4Store(os.path.join(self.dir, 'store'))
+        self.key, self.params = g4_key('v0.1.5', 'G4', 'Rn220', 100, 1, [('run_Rn220.mac', None)])
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def stored_products(self, path):
+        extract_dir = os.path.join(self.dir, 'extracted')
+        with tarfile.open(path, 'r|bz2') as tar:
+            tar.extractall(extract_dir)
+        self.assertEqual(subprocess.call(['sha256sum', '--quiet', '-c', CHECKSUM_FILE], cwd=extract_dir), 0)
+        for name in G4_PRODUCTS:
+            with open(os.path.join(extract_dir, name)) as fproduct:
+                self.assertEqual(fproduct.read(), name*1000)
+        return sorted(os.listdir(extract_dir))
+
+    def round_trip(self):
+        tarball = g4_tarball(self.output_dir, '1', self.work_dir)
+        self.assertIsNotNone(tarball)
+        digest = self.store.add(self.key, self.params, tarball)
+        path = self.store.lookup(self.key)
+        self.assertEqual(path, self.store.object_path(digest))
+        self.assertEqual(self.stored_products(path), sorted(G4_PRODUCTS + [CHECKSUM_FILE]))
+
+    def test_output_tarball(self):
+        package(os.path.join(self.output_dir, '1_output.tar.bz2'), self.products_dir)
+        self.round_trip()
+
+    def test_concatenated_streams(self):
+        # output tarball of the former packager: one bz2 stream per block
+        package(os.path.join(self.dir, 'output.tar'), self.products_dir, codec='none')
+        with open(os.path.join(self.dir, 'output.tar'), 'rb') as ftar:
+            data = ftar.read()
+        with open(os.path.join(self.output_dir, '1_output.tar.bz2'), 'wb') as ftarball:
+            for start in range(0, len(data), 4096):
+                ftarball.write(bz2.compress(data[start:start + 4096]))
+        self.round_trip()
+
+    def test_stage_tarball(self):
+        path = os.path.join(self.output_dir, '1_g4.tar.bz2')
+        package(path, self.products_dir, 'g4')
+        self.assertEqual(g4_tarball(self.output_dir, '1', self.work_dir), path)
+        self.store.add(self.key, self.params, path)
+        self.assertEqual(self.stored_products(self.store.lookup(self.key)), sorted(G4_PRODUCTS + [CHECKSUM_FILE]))
+
+    def test_no_g4_products(self):
+        for name in G4_PRODUCTS:
+            os.remove(os.path.join(self.products_dir, name))
+        package(os.path.join(self.output_dir, '1_output.tar.bz2'), self.products_dir)
+        self.assertIsNone(g4_tarball(self.output_dir, '1', self.work_dir))
+        self.assertIsNone(g4_tarball(self.output_dir, '2', self.work_dir))
+        self.assertIsNone(self.store.lookup(self.key))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+####################################
+## Tests of production_budget.py: the job budget of a partition is shared
+## by priority, every production getting at least one job and the total
+## staying within the budget
+##
+## Usage:
+##   python -m unittest test_production_budget
+####################################
+import unittest
+
+from production_budget import share_budget, partition_budgets
+
+
+class ShareBudgetTest(unittest.TestCase):
+
+    def test_proportional(self):
+        self.assertEqual(share_budget({'a': 1., 'b': 1.}, 200), {'a': 100, 'b': 100})
+        self.assertEqual(share_budget({'a': 3., 'b': 1.}, 200), {'a': 150, 'b': 50})
+        # largest remainders get the jobs left by the rounding down
+        self.assertEqual(share_budget({'a': 1., 'b': 1., 'c': 1.}, 64), {'a': 22, 'b': 21, 'c': 21})
+
+    def test_at_least_one_job(self):
+        shares = share_budget({'big': 1000., 'small': 1.}, 64)
+        self.assertEqual(shares, {'big': 63, 'small': 1})
+
+    def test_more_names_than_jobs(self):
+        priorities = dict(('p%d' % i, 1. + i) for i in range(10))
+        self.assertEqual(share_budget(priorities, 4), dict((name, 1) for name in priorities))
+
+    def test_sum_within_max_jobs(self):
+        for max_jobs in (1, 2, 5, 17, 64, 200):
+            for priorities in ({'a': 1.}, {'a': 1., 'b': 100.}, {'a': 5., 'b': 0.01, 'c': 0.01, 'd': 7.},
+                               dict(('p%d' % i, 1.5**i) for i in range(12))):
+                shares = share_budget(priorities, max_jobs)
+                self.assertEqual(set(shares), set(priorities))
+                self.assertTrue(min(shares.values()) >= 1)
+                self.assertTrue(sum(shares.values()) <= max(max_jobs, len(priorities)), (max_jobs, shares))
+
+    def test_no_names(self):
+        self.assertEqual(share_budget({}, 200), {})
+
+    def test_partitions(self):
+        processes = [{'process_name': 'a', 'nodetype': '0', 'priority': '2'},
+                     {'process_name': 'b', 'nodetype': '0'},
+                     {'process_name': 'c', 'nodetype': '1'}]
+        self.assertEqual(partition_budgets(processes, {'0': 30, '1': 64}), {'a': 20, 'b': 10, 'c': 64})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+####################################
+## Tests of queue_throttler.py with stand-in squeue/sbatch scripts
+## (no Slurm needed): the stand-in squeue prints the states listed in a
+## queue file, the stand-in sbatch appends its submit file to it as PENDING
+##
+## Usage:
+##   python -m unittest test_queue_throttler
+####################################
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+
+from queue_throttler import QueueThrottler
+
+SQUEUE = '''#!/bin/bash
+[[ -f {dir}/squeue_fails ]] && exit 1
+cat {dir}/queue
+'''
+SBATCH = '''#!/bin/bash
+# last argument: submit file
+submit_file=${{@: -1}}
+[[ $(basename ${{submit_file}}) == fail* ]] && exit 1
+echo PENDING >> {dir}/queue
+echo ${{submit_file}} >> {dir}/submitted
+echo $(wc -l < {dir}/submitted)
+'''
+
+
+class QueueThrottlerTest(unittest.TestCase):
+
+    def setUp(self):
+        os.environ.pop('FAX_BACKEND', None)
+        self.dir = tempfile.mkdtemp()
+        for (name, script) in [('squeue', SQUEUE), ('sbatch', SBATCH)]:
+            path = os.path.join(self.dir, name)
+            with open(path, 'w') as fscript:
+                fscript.write(script.format(dir=self.dir))
+            os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+        self.set_queue(['RUNNING', 'RUNNING'])
+        self.sleeps = []
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def set_queue(self, states):
+        with open(os.path.join(self.dir, 'queue'), 'w') as fqueue:
+            fqueue.write(''.join(state + '\n' for state in states))
+
+    def throttler(self, max_jobs, sleep=None, **kwargs):
+        return QueueThrottler('xenon1t', 'user', max_jobs, interval=1., max_interval=4.,
+                              squeue_command=os.path.join(self.dir, 'squeue'),
+                              sbatch_command=os.path.join(self.dir, 'sbatch'),
+                              sleep=sleep or self.sleeps.append, **kwargs)
+
+    def submitted(self):
+        path = os.path.join(self.dir, 'submitted')
+        if not os.path.exists(path):
+            return []
+        with open(path) as fsubmitted:
+            return [os.path.basename(line.strip()) for line in fsubmitted]
+
+    def test_submits_up_to_free_slots(self):
+        def sleep(interval):
+            # the running jobs finish while the throttler waits
+            self.sleeps.append(interval)
+            self.set_queue([])
+        job_ids = self.throttler(4, sleep).submit_all([('job%d' % i, self.dir) for i in range(5)])
+        self.assertEqual(job_ids, ['1', '2', '3', '4', '5'])
+        self.assertEqual(self.submitted(), ['job0', 'job1', 'job2', 'job3', 'job4'])
+        self.assertEqual(self.sleeps, [1.])
+
+    def test_failed_sbatch_takes_no_slot(self):
+        throttler = self.throttler(3)
+        job_ids = throttler.submit_all([('fail0', self.dir), ('job1', self.dir)])
+        self.assertEqual(job_ids, [None, '1'])
+        self.assertEqual(throttler.pending, 1)
+
+    def test_backs_off_while_full(self):
+        polls = []
+        def sleep(interval):
+            polls.append(interval)
+            if len(polls) == 4:
+                self.set_queue([])
+        self.assertEqual(self.throttler(2, sleep).submit_all([('job0', self.dir)]), ['1'])
+        self.assertEqual(polls, [1.5, 2.25, 3.375, 4.])
+
+    def test_gives_up_when_squeue_fails(self):
+        open(os.path.join(self.dir, 'squeue_fails'), 'w').close()
+        throttler = self.throttler(4, max_failed_polls=3)
+        self.assertEqual(throttler.submit_all([('job0', self.dir), ('job1', self.dir)]), [None, None])
+        self.assertEqual(self.submitted(), [])
+        self.assertFalse(throttler.wait_until_empty())
+        self.assertEqual(len(self.sleeps), 4)
+
+    def test_wait_until_empty(self):
+        def sleep(interval):
+            self.sleeps.append(interval)
+            self.set_queue(['RUNNING'] if len(self.sleeps) < 2 else [])
+        self.assertTrue(self.throttler(4, sleep).wait_until_empty())
+        self.assertEqual(self.sleeps, [1., 1.5])
+
+
+if __name__ == '__main__':
+    unittest.main()
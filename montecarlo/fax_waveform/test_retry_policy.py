@@ -0,0 +1,112 @@
+####################################
+## Tests of retry_policy.py: actions from exit codes and log signatures, the
+## grid exit codes (classify), the HTCondor expressions and the Slurm
+## resubmission arguments
+##
+## Usage:
+##   python -m unittest test_retry_policy
+####################################
+import os
+import re
+import shutil
+import tempfile
+import unittest
+
+from production_state import ProductionState, state_path
+from retry_policy import (classify, combine_args, condor_profiles, decide, retry_plan, backoff,
+                          RUN_FAX_CODES, RUN_SIM_CODES, MAX_RETRIES, MAX_BACKOFF, RETRY, RETRY_OTHER_HOST, GIVE_UP)
+
+
+class DecideTest(unittest.TestCase):
+
+    def test_exit_codes(self):
+        self.assertEqual(decide(13), (RETRY, backoff(1), 'fax+pax'))
+        self.assertEqual(decide(10), (RETRY_OTHER_HOST, backoff(1), 'Geant4'))
+        self.assertEqual(decide(11), (GIVE_UP, 0, 'patch'))
+        # outputs missing after a successful exit, unknown codes: retried
+        self.assertEqual(decide(0)[0], RETRY)
+        self.assertEqual(decide(42), (RETRY, backoff(1), 'exit code 42'))
+
+    def test_signature_overrides_code(self):
+        self.assertEqual(decide(13, 'pax\nMemoryError\n'), (RETRY_OTHER_HOST, backoff(1), 'fax+pax: out of memory'))
+        self.assertEqual(decide(13, 'ImportError: No module named hax')[0], GIVE_UP)
+        self.assertEqual(decide(12, 'Stale file handle')[0], RETRY)
+        # the first signature of the list wins
+        self.assertEqual(decide(16, 'Segmentation fault\nSyntaxError')[2], 'truth sorting: crash')
+
+    def test_max_retries(self):
+        self.assertEqual(decide(13, '', MAX_RETRIES), (RETRY, backoff(MAX_RETRIES), 'fax+pax'))
+        self.assertEqual(decide(13, '', MAX_RETRIES + 1), (GIVE_UP, 0, 'fax+pax, %d failures' % (MAX_RETRIES + 1)))
+        self.assertEqual(backoff(1), 60)
+        self.assertEqual(backoff(3), 960)
+        self.assertEqual(backoff(10), MAX_BACKOFF)
+
+    def test_classify(self):
+        # 100+code: give up a stage otherwise retried, 200+code: retry a stage otherwise given up
+        self.assertEqual(classify('run_sim', 13, ''), 13)
+        self.assertEqual(classify('run_sim', 13, 'NameError: name'), 113)
+        self.assertEqual(classify('run_sim', 11, ''), 11)
+        self.assertEqual(classify('run_sim', 11, 'Bus error'), 211)
+        self.assertEqual(classify('run_fax', 12, 'Input/output error'), 212)
+        self.assertEqual(classify('python', 1, 'Segmentation fault'), 1)
+
+
+class CondorProfilesTest(unittest.TestCase):
+
+    def test_expressions(self):
+        profiles = dict(condor_profiles(RUN_FAX_CODES))
+        self.assertEqual(sorted(profiles), ['on_exit_hold', 'on_exit_hold_reason', 'periodic_release'])
+        self.assertEqual(profiles['on_exit_hold'],
+                         '(ExitBySignal == False) && (ExitCode == 11 || ExitCode == 13 || ExitCode == 14 || '
+                         'ExitCode == 15 || ExitCode == 16 || ExitCode == 210 || ExitCode == 212) && '
+                         '(NumJobStarts <= 3)')
+        self.assertEqual(profiles['periodic_release'],
+                         '((HoldReasonCode == 3) || (HoldReasonCode == 12) || (HoldReasonCode == 13)) && '
+                         '(NumJobStarts <= 3) && ((time() - EnteredCurrentStatus) > '
+                         'ifThenElse(NumJobStarts <= 1, 60, ifThenElse(NumJobStarts <= 2, 240, 960)))')
+
+    def test_held_codes(self):
+        # retried codes and 200+code of the given up ones are held, never 100+code
+        held = set(int(code) for code in re.findall(r'ExitCode == (\d+)', dict(condor_profiles())['on_exit_hold']))
+        expected = set(code if action != GIVE_UP else 200 + code for (code, (_, action)) in RUN_SIM_CODES.items())
+        self.assertEqual(held, expected)
+
+
+class SlurmRetryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.state = ProductionState(state_path(self.dir))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def add_failure(self, exit_code, host, updated):
+        with self.state.connection:
+            self.state.apply_result({'stage': 'fax', 'unit': '000001', 'status': 'failed', 'exit_code': exit_code,
+                                     'outputs': [], 'host': host, 'updated': updated})
+
+    def test_combine_args(self):
+        self.assertEqual(combine_args([['--begin=now+60', '--exclude=b,a'], [], ['--begin=now+300', '--exclude=c']]),
+                         ['--begin=now+300', '--exclude=a,b,c'])
+        self.assertEqual(combine_args([[], []]), [])
+
+    def test_retry_plan(self):
+        self.assertEqual(retry_plan(self.state, 'fax', '000001', codes=RUN_FAX_CODES), [])
+        self.add_failure(11, 'node1', 1000.)
+        self.assertEqual(retry_plan(self.state, 'fax', '000001', codes=RUN_FAX_CODES, now=1010.), ['--begin=now+50'])
+        # out of memory: away from the hosts it failed on
+        log = os.path.join(self.dir, 'fax.log')
+        with open(log, 'w') as flog:
+            flog.write('std::bad_alloc\n')
+        self.add_failure(11, 'node2', 2000.)
+        self.assertEqual(retry_plan(self.state, 'fax', '000001', [log], RUN_FAX_CODES, now=3000.),
+                         ['--exclude=node1,node2'])
+        self.add_failure(11, 'node3', 3000.)
+        self.add_failure(11, 'node4', 4000.)
+        self.assertIsNone(retry_plan(self.state, 'fax', '000001', codes=RUN_FAX_CODES, now=5000.))
+        self.assertTrue(self.state.is_given_up('fax', '000001'))
+
+
+if __name__ == '__main__':
+    unittest.main()
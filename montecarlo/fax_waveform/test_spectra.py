@@ -0,0 +1,75 @@
+####################################
+## Tests of spectra.py: the samplers follow their weights/pdf and the .npz
+## spectrum files are read back as written
+##
+## Usage:
+##   python -m unittest test_spectra
+####################################
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from spectra import AliasTable, InverseCDFTable, load_spectrum
+
+
+class SpectraTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def assert_frequencies(self, counts, weights):
+        # within 5 sigma of the binomial spread of every index
+        n = counts.sum()
+        expected = np.asarray(weights, dtype=float)/np.sum(weights)*n
+        sigma = np.sqrt(expected*(1. - expected/n))
+        self.assertTrue(np.all(np.abs(counts - expected) <= 5*sigma + 1e-9), (counts, expected))
+
+    def test_alias_frequencies(self):
+        weights = [5., 0., 1., 20., 3., 0.5, 10.]
+        samples = AliasTable(weights).sample(500000, np.random.RandomState(3))
+        self.assert_frequencies(np.bincount(samples, minlength=len(weights)), weights)
+        self.assertEqual(np.sum(samples == 1), 0)
+
+    def test_alias_invalid_weights(self):
+        self.assertRaises(ValueError, AliasTable, [1., -1.])
+        self.assertRaises(ValueError, AliasTable, [0., 0.])
+
+    def test_inverse_cdf(self):
+        # pdf linear in the value: the CDF is quadratic, its median at sqrt(1/2)
+        values = np.linspace(0., 1., 101)
+        samples = InverseCDFTable(values, 2*values).sample(200000, np.random.RandomState(4))
+        self.assertAlmostEqual(np.median(samples), np.sqrt(0.5), delta=0.005)
+        self.assertTrue(np.all((samples >= 0.) & (samples <= 1.)))
+
+    def test_joint_histogram_round_trip(self):
+        photon_edges = np.array([0., 10., 20., 40.])
+        electron_edges = np.array([100., 200., 300.])
+        counts = np.array([[1., 0.], [0., 4.], [2., 3.]])
+        path = os.path.join(self.dir, 'spectrum.npz')
+        np.savez(path, photon_edges=photon_edges, electron_edges=electron_edges, counts=counts)
+        photons, electrons = load_spectrum(path).sample(100000, np.random.RandomState(5))
+        histogram = np.histogram2d(photons, electrons, bins=[photon_edges, electron_edges])[0]
+        self.assert_frequencies(histogram.ravel(), counts.ravel())
+
+    def test_single_axis_round_trip(self):
+        path = os.path.join(self.dir, 'spectrum.npz')
+        np.savez(path, electrons=[0., 1.], electron_pdf=[1., 1.])
+        photons, electrons = load_spectrum(path).sample(1000, np.random.RandomState(6))
+        self.assertIsNone(photons)
+        self.assertEqual(len(electrons), 1000)
+        self.assertTrue(np.all((electrons >= 0.) & (electrons <= 1.)))
+
+    def test_no_spectrum(self):
+        path = os.path.join(self.dir, 'spectrum.npz')
+        np.savez(path, other=[1.])
+        self.assertRaises(ValueError, load_spectrum, path)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -13,10 +13,25 @@ import glob
 import Pegasus.DAX3
 import cStringIO
 
+# retry policy shared with the Slurm productions
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fax_waveform'))
+import retry_policy
+import package_outputs
+import g4_store
+
 MC_PATH = '/cvmfs/xenon.opensciencegrid.org/releases/mc/'
 PAX_PATH = "/cvmfs/xenon.opensciencegrid.org/releases/anaconda/2.4/envs/"
 MC_FLAVORS = ('G4', 'NEST', 'G4p10')
 
+# --per-stage: run_sim.sh stage jobs of a batch, each passing its products to the next one as a tarball:
+# (stage, tarball, transferred to the output site, HTCondor resources)
+STAGE_JOBS = [('g4', "{0}_g4.tar.bz2", True,
+               {'request_disk': '2G', 'request_memory': '2000', 'request_cpus': '1'}),
+              ('fax_pax', "{0}_pax.tar.bz2", False,
+               {'request_disk': '3G', 'request_memory': '4000', 'request_cpus': '2'}),
+              ('hax', "{0}_output.tar.bz2", True,
+               {'request_disk': '2G', 'request_memory': '3000', 'request_cpus': '2'})]
+
 # pegasus constants
 PEGASUSRC_PATH = './pegasusrc'
 
@@ -204,7 +219,11 @@ def generate_mc_workflow(mc_config,
                          preinit_belt,
                          preinit_efield,
                          optical_setup,
-                         source_macro):
+                         source_macro,
+                         output_profile='all',
+                         per_stage=False,
+                         store_path=None,
+                         reprocess=False):
     """
     Generate a Pegasus workflow to do X1T MC processing
 
@@ -221,6 +240,10 @@ def generate_mc_workflow(mc_config,
     :param preinit_efield: macro to use to preinitialize efield (for NEST only)
     :param optical_setup: macro to setup optics
     :param source_macro: macro to use for MC generation
+    :param output_profile: products kept in the output tarball (see package_outputs.py)
+    :param per_stage: one job per stage (STAGE_JOBS) instead of one job doing all the stages
+    :param store_path: G4 store (g4_store.py): the keys of the jobs are written to g4_keys.json
+    :param reprocess: only fax/pax/hax jobs, on the G4 outputs of the jobs found in the G4 store
     :return: number of jobs in the workflow
     """
     dax = Pegasus.DAX3.ADAG('montecarlo')
@@ -324,55 +347,98 @@ def generate_mc_workflow(mc_config,
         optical_macro_input.addPFN(file_pfn)
         dax.addFile(optical_macro_input)
 
+    # the G4 outputs depend on the content of the macros given by the user (on their name otherwise)
+    macros = []
+    for (macro, macro_input) in ((preinit_macro, preinit_macro_input), (preinit_belt, preinit_belt_input),
+                                 (preinit_efield, preinit_efield_input), (optical_setup, optical_macro_input),
+                                 (source_macro, source_macro_input)):
+        macros.append((macro, g4_store.file_digest(macro) if macro_input else None))
+    g4_keys = {}
+    missing_jobs = []
+
     try:
         for job in range(start_job, start_job+num_jobs):
-            run_sim_job = Pegasus.DAX3.Job(id="{0}".format(job), name="run_sim.sh")
+            events = batch_size
             if job == (num_jobs - 1):
                 left_events = num_events % batch_size
-                if left_events == 0:
-                    left_events = batch_size
-                run_sim_job.addArguments(str(job),
-                                         mc_flavor,
-                                         mc_config,
-                                         str(left_events),
-                                         mc_version,
-                                         fax_version,
-                                         pax_version,
-                                         '0',  # don't save raw data
-                                         preinit_macro,
-                                         preinit_belt,
-                                         preinit_efield,
-                                         optical_setup,
-                                         source_macro)
+                if left_events != 0:
+                    events = left_events
+            arguments = [str(job),
+                         mc_flavor,
+                         mc_config,
+                         str(events),
+                         mc_version,
+                         fax_version,
+                         pax_version,
+                         '0',  # don't save raw data
+                         preinit_macro,
+                         preinit_belt,
+                         preinit_efield,
+                         optical_setup,
+                         source_macro,
+                         output_profile]
+            previous_job = None
+            previous_output = None
+            if store_path is not None:
+                g4_keys[job] = g4_store.g4_key(mc_version, mc_flavor, mc_config, events, job, macros)
+            # reprocessing: the fax_pax job starts from the G4 tarball of the store
+            if reprocess:
+                stored = g4_store.G4Store(store_path).lookup(g4_keys[job][0])
+                if stored is None:
+                    missing_jobs.append(str(job))
+                    continue
+                previous_output = Pegasus.DAX3.File("{0}_g4.tar.bz2".format(job))
+                previous_output.addPFN(Pegasus.DAX3.PFN("file://{0}".format(stored), "local"))
+                dax.addFile(previous_output)
+                stages = STAGE_JOBS[1:]
+            # optical photon configurations stop after Geant4: always one job
+            elif per_stage and "optPhot" not in mc_config:
+                stages = STAGE_JOBS
             else:
-                run_sim_job.addArguments(str(job),
-                                         mc_flavor,
-                                         mc_config,
-                                         str(batch_size),
-                                         mc_version,
-                                         fax_version,
-                                         pax_version,
-                                         '0',  # don't save raw data
-                                         preinit_macro,
-                                         preinit_belt,
-                                         preinit_efield,
-                                         optical_setup,
-                                         source_macro)
-            if preinit_macro_input:
-                run_sim_job.uses(preinit_macro_input, link=Pegasus.DAX3.Link.INPUT)
-            if preinit_belt_input:
-                run_sim_job.uses(preinit_belt_input, link=Pegasus.DAX3.Link.INPUT)
-            if preinit_efield_input:
-                run_sim_job.uses(preinit_efield_input, link=Pegasus.DAX3.Link.INPUT)
-            if optical_macro_input:
-                run_sim_job.uses(optical_macro_input, link=Pegasus.DAX3.Link.INPUT)
-            if source_macro_input:
-                run_sim_job.uses(source_macro_input, link=Pegasus.DAX3.Link.INPUT)
-            run_sim_job.addProfile(Pegasus.DAX3.Profile(Pegasus.DAX3.Namespace.CONDOR, "request_disk", "1G"))
-
-            output = Pegasus.DAX3.File("{0}_output.tar.bz2".format(job))
-            run_sim_job.uses(output, link=Pegasus.DAX3.Link.OUTPUT, transfer=True)
-            dax.addJob(run_sim_job)
+                stages = [(None, "{0}_output.tar.bz2", True, {'request_disk': '1G'})]
+            for (stage, output_name, keep_output, resources) in stages:
+                if stage is None:
+                    run_sim_job = Pegasus.DAX3.Job(id="{0}".format(job), name="run_sim.sh")
+                    run_sim_job.addArguments(*arguments)
+                else:
+                    run_sim_job = Pegasus.DAX3.Job(id="{0}_{1}".format(job, stage), name="run_sim.sh")
+                    run_sim_job.addArguments(*(arguments + [stage]))
+                if previous_output is not None:
+                    # the products of the previous stage job
+                    run_sim_job.uses(previous_output, link=Pegasus.DAX3.Link.INPUT)
+                else:
+                    if preinit_macro_input:
+                        run_sim_job.uses(preinit_macro_input, link=Pegasus.DAX3.Link.INPUT)
+                    if preinit_belt_input:
+                        run_sim_job.uses(preinit_belt_input, link=Pegasus.DAX3.Link.INPUT)
+                    if preinit_efield_input:
+                        run_sim_job.uses(preinit_efield_input, link=Pegasus.DAX3.Link.INPUT)
+                    if optical_macro_input:
+                        run_sim_job.uses(optical_macro_input, link=Pegasus.DAX3.Link.INPUT)
+                    if source_macro_input:
+                        run_sim_job.uses(source_macro_input, link=Pegasus.DAX3.Link.INPUT)
+                for (key, value) in sorted(resources.items()):
+                    run_sim_job.addProfile(Pegasus.DAX3.Profile(Pegasus.DAX3.Namespace.CONDOR, key, value))
+                # run_sim.sh failures are retried by the HTCondor policy of retry_policy.py, not by
+                # DAGMan (dagman.retry = 0 in the pegasusrc files); the machines a job ran on are
+                # avoided by the requirements of the site catalog
+                for (key, value) in retry_policy.condor_profiles(retry_policy.RUN_SIM_CODES):
+                    run_sim_job.addProfile(Pegasus.DAX3.Profile(Pegasus.DAX3.Namespace.CONDOR, key, value))
+
+                output = Pegasus.DAX3.File(output_name.format(job))
+                run_sim_job.uses(output, link=Pegasus.DAX3.Link.OUTPUT, transfer=keep_output)
+                dax.addJob(run_sim_job)
+                if previous_job is not None:
+                    dax.depends(parent=previous_job, child=run_sim_job)
+                previous_job = run_sim_job
+                previous_output = output
+        if missing_jobs:
+            sys.stderr.write("No Geant4 outputs in the G4 store for job(s) {0}\n".format(", ".join(missing_jobs)))
+            return 0
+        if store_path is not None and not reprocess:
+            g4_store.write_keys(g4_store.KEYS_FILE, g4_keys)
+            sys.stdout.write("G4 store keys written to {0}, store the G4 outputs with "
+                             "fax_waveform/g4_store.py add once the workflow is done\n".format(g4_store.KEYS_FILE))
         with open('mc_process.xml', 'w') as f:
             dax.writeXML(f)
     except:
@@ -451,8 +517,27 @@ def run_main():
     parser.add_argument('--source-macro', dest='source_macro',
                         action='store', default=None,
                         help='macro to use for MC')
+    parser.add_argument('--output-profile', dest='output_profile',
+                        choices=sorted(package_outputs.PROFILES),
+                        action='store', default='all',
+                        help='products kept in the output tarball of the jobs '
+                             '(default is all)')
+    parser.add_argument('--per-stage', dest='per_stage',
+                        action='store_true', default=False,
+                        help='one job per stage (Geant4, fax+pax, hax+lax) '
+                             'with its own resources and retries')
+    parser.add_argument('--g4-store', dest='g4_store',
+                        action='store', default=None,
+                        help='store of the Geant4 outputs (see fax_waveform/g4_store.py)')
+    parser.add_argument('--reprocess', dest='reprocess',
+                        action='store_true', default=False,
+                        help='only run fax/pax/hax on the Geant4 outputs of the '
+                             'G4 store, for the jobs of the same arguments')
 
     args = parser.parse_args(sys.argv[1:])
+    if args.reprocess and (args.g4_store is None or "optPhot" in args.mc_config):
+        sys.stderr.write("--reprocess needs --g4-store, and a configuration going beyond Geant4\n")
+        return 1
     if args.num_events == 0:
         sys.stdout.write("No events to generate, exiting")
         return 0
@@ -484,7 +569,11 @@ def run_main():
                                             args.preinit_belt,
                                             args.preinit_efield,
                                             args.optical_setup,
-                                            args.source_macro)
+                                            args.source_macro,
+                                            args.output_profile,
+                                            args.per_stage,
+                                            args.g4_store,
+                                            args.reprocess)
     if workflow_info[0] == 0:
         sys.stderr.write("Can't generate workflow, exiting\n")
         try:
@@ -11,12 +11,36 @@
 # $9 - preinit_macro
 # $10 - optical_setup
 # $11 - source_macro
+# $14 - output profile (see fax_waveform/package_outputs.py)
+# $15 - stages: all (default), or g4, fax_pax, hax for the stage jobs of mc_process.py --per-stage
 
 function terminate {
 
-    # tar all files                                                                         
+    # stages still running in the background are stopped before the outputs are packed
+    if [ ${#STAGE_PIDS[@]} -gt 0 ]; then
+        for pid in ${STAGE_PIDS[@]}; do
+            kill_tree ${pid}
+        done
+        wait ${STAGE_PIDS[@]} 2> /dev/null
+    fi
+
+    # exit code for the retry policy of mc_process.py: 100+code when the logs show
+    # a deterministic failure, 200+code for a transient one (see retry_policy.py)
+    EXIT_CODE=$1
+    if [ ${EXIT_CODE} -ne 0 ];
+    then
+        EXIT_CODE=`python ${CVMFSDIR}/releases/processing/montecarlo/fax_waveform/retry_policy.py classify run_sim ${EXIT_CODE} ${OUTDIR}/*.log 2> /dev/null || echo ${EXIT_CODE}`
+    fi
+
+    # tar the products of the output profile, compressed in a thread of their own, with their checksums
+    # (see package_outputs.py); all files with tar without it
+    PACKAGER=${CVMFSDIR}/releases/processing/montecarlo/fax_waveform/package_outputs.py
     cd ${OUTDIR}
-    tar cvjf ${start_dir}/${JOBID}_output.tar.bz2 *
+    if [ -f ${PACKAGER} ]; then
+        python ${PACKAGER} ${start_dir}/${OUTPUT_TARBALL} ${OUTDIR} ${OUTPUT_PROFILE} ${OUTPUT_CODEC}
+    else
+        tar cvjf ${start_dir}/${OUTPUT_TARBALL} *
+    fi
     
     # copy files on stash                                                                    
     #gfal-copy -p file://${G4_FILENAME}.tgz gsiftp://gridftp.grid.uchicago.edu:2811/cephfs/srm/xenon/xenon1t/simulations/mc_$MCVERSION/pax_$PAXVERSION/$MCFLAVOR/$CONFIG/${JOBID}_output.tar.bz2
@@ -26,7 +50,55 @@ function terminate {
     
     cd $start_dir
 
-    exit $1
+    exit ${EXIT_CODE}
+}
+
+# run_stage <stage> <command> [<arg> ...]: run a stage, appending its wall/cpu time,
+# memory and I/O to ${METRICS_FILE} (see stage_metrics.py), or only timed without it
+function run_stage {
+    STAGE_METRICS=${CVMFSDIR}/releases/processing/montecarlo/fax_waveform/stage_metrics.py
+    if [ -f ${STAGE_METRICS} ]; then
+        python ${STAGE_METRICS} run ${METRICS_FILE} $1 ${SUBRUN} "${@:2}"
+    else
+        time "${@:2}"
+    fi
+}
+
+# Stages without dependency between them run concurrently on multi-core slots
+# (HTCondor sets OMP_NUM_THREADS to request_cpus), in sequence otherwise:
+#   start_stage <exit code> <function>: start a stage (a function running its commands)
+#   wait_stage <function>: wait for it, terminate with its exit code if it failed
+# A stage is started once the stages it depends on are over (waited for, or run in the foreground)
+declare -A STAGE_PIDS STAGE_CODES
+function start_stage {
+    if [ ${OMP_NUM_THREADS:-1} -gt 1 ]; then
+        STAGE_CODES[$2]=$1
+        $2 &
+        STAGE_PIDS[$2]=$!
+    else
+        $2 || terminate $1
+    fi
+}
+
+function wait_stage {
+    if [ -n "${STAGE_PIDS[$1]}" ]; then
+        # wait for this stage only: a bare wait would also wait for the stage worker
+        wait ${STAGE_PIDS[$1]}
+        STATUS=$?
+        unset "STAGE_PIDS[$1]"
+        if [ ${STATUS} -ne 0 ]; then
+            terminate ${STAGE_CODES[$1]}
+        fi
+    fi
+}
+
+# kill_tree <pid>: stop a process and its descendants
+function kill_tree {
+    CHILDREN=`pgrep -P $1`
+    kill $1 2> /dev/null
+    for child in ${CHILDREN}; do
+        kill_tree ${child}
+    done
 }
 
 
@@ -170,6 +242,30 @@ else
 fi
 echo "Source macro: $SOURCE_MACRO"
 
+# products kept in the output tarball (profiles of package_outputs.py), and its compression;
+# the tarball name is fixed (<job id>_output.tar.bz2), so the codec stays bz2
+# (compressed by lbzip2 on OMP_NUM_THREADS threads when there are several and it is installed)
+OUTPUT_PROFILE=${14:-all}
+OUTPUT_CODEC=bz2:9
+OUTPUT_TARBALL=${JOBID}_output.tar.bz2
+
+# stages run by this job: all, or one stage job of a per-stage workflow (mc_process.py --per-stage):
+# g4 (Geant4, Patch/nSort), fax_pax (fax, pax, truth sorting), hax (hax, minitree formats, lax).
+# A stage job unpacks the tarball of the previous one, and packs its own products for the next one
+STAGES=${15:-all}
+STAGE_INPUT=
+if [[ ${STAGES} == g4 ]]; then
+    OUTPUT_TARBALL=${JOBID}_g4.tar.bz2
+    OUTPUT_PROFILE=all
+elif [[ ${STAGES} == fax_pax ]]; then
+    STAGE_INPUT=${JOBID}_g4.tar.bz2
+    OUTPUT_TARBALL=${JOBID}_pax.tar.bz2
+    OUTPUT_PROFILE=processed
+elif [[ ${STAGES} == hax ]]; then
+    STAGE_INPUT=${JOBID}_pax.tar.bz2
+fi
+echo "Stages: $STAGES, output profile: $OUTPUT_PROFILE"
+
 # set HOME directory if it's not set
 if [[ ${HOME} == "" ]];
 then
@@ -237,50 +333,75 @@ FILENAME=${OUTDIR}/${FILENUM}
 G4_FILENAME=${FILENAME}_g4mc_${MCFLAVOR}
 G4PATCH_FILENAME=${G4_FILENAME}_Patch
 G4NSORT_FILENAME=${G4_FILENAME}_Sort
+METRICS_FILE=${FILENAME}_metrics.jsonl # resource usage of the stages
 
 # Start of simulations #
 
-# Geant4 stage
-G4EXEC=${RELEASEDIR}/xenon1t_${MCFLAVOR}
-ln -sf ${MACROSDIR} # For reading e.g. input spectra from CWD
+# products of the previous stage job, checked against their checksums
+if [[ ${STAGE_INPUT} != "" ]]; then
+    tar xjf ${start_dir}/${STAGE_INPUT} -C ${OUTDIR} &&
+    if [ -f ${OUTDIR}/SHA256SUMS ]; then
+        (cd ${OUTDIR} && sha256sum -c --quiet SHA256SUMS && rm SHA256SUMS)
+    fi
+    if [ $? -ne 0 ];
+    then
+        terminate 5
+    fi
+fi
 
-(time ${G4EXEC} -p ${PREINIT_MACRO} -b ${PREINIT_BELT} -e ${PREINIT_EFIELD} -s ${OPTICAL_SETUP} -f ${SOURCE_MACRO} -n ${NEVENTS} -o ${G4_FILENAME}.root;) 2>&1 | tee ${G4_FILENAME}.log
-if [ $? -ne 0 ];
-then
-    terminate 10
+if [[ ${STAGES} == all || ${STAGES} == g4 ]]; then
+    # Geant4 stage
+    G4EXEC=${RELEASEDIR}/xenon1t_${MCFLAVOR}
+    ln -sf ${MACROSDIR} # For reading e.g. input spectra from CWD
+
+    run_stage g4 ${G4EXEC} -p ${PREINIT_MACRO} -b ${PREINIT_BELT} -e ${PREINIT_EFIELD} -s ${OPTICAL_SETUP} -f ${SOURCE_MACRO} -n ${NEVENTS} -o ${G4_FILENAME}.root 2>&1 | tee ${G4_FILENAME}.log
+    if [ $? -ne 0 ];
+    then
+        terminate 10
+    fi
+
+    # Skip the rest for optical photons
+    if [[ ${CONFIG} == *"optPhot"* ]]; then
+        terminate 0
+    fi
+
+    source ${CVMFSDIR}/software/mc_old_setup.sh
+
+    if [[ ${MCFLAVOR} == NEST ]]; then
+        # Patch stage
+        if [[ ${PATCHTYPE} != "" ]]; then
+            PATCHEXEC=${RELEASEDIR}/runPatch
+            run_stage patch ${PATCHEXEC} -i ${G4_FILENAME}.root -o ${G4PATCH_FILENAME}.root -t ${PATCHTYPE} 2>&1 | tee ${G4PATCH_FILENAME}.log
+            if [ $? -ne 0 ];
+            then
+              terminate 11
+            fi
+        fi
+    else
+        # nSort Stage
+        NSORTEXEC=${RELEASEDIR}/nSort
+        ln -sf ${RELEASEDIR}/data
+        run_stage nsort ${NSORTEXEC} -s 2 -i ${G4_FILENAME} 2>&1 | tee ${G4NSORT_FILENAME}.log
+        if [ $? -ne 0 ];
+        then
+          terminate 12
+        fi
+    fi
 fi
 
-# Skip the rest for optical photons
-if [[ ${CONFIG} == *"optPhot"* ]]; then
+# G4 stage job: its products are passed to the fax_pax job
+if [[ ${STAGES} == g4 ]]; then
     terminate 0
 fi
 
-source ${CVMFSDIR}/software/mc_old_setup.sh
-
+# input of fax: output of Patch (if any) or of Geant4 for NEST, of nSort otherwise
 if [[ ${MCFLAVOR} == NEST ]]; then
-    # Patch stage
     if [[ ${PATCHTYPE} != "" ]]; then
-        PATCHEXEC=${RELEASEDIR}/runPatch
-        (time ${PATCHEXEC} -i ${G4_FILENAME}.root -o ${G4PATCH_FILENAME}.root -t ${PATCHTYPE};) 2>&1 | tee ${G4PATCH_FILENAME}.log
-        if [ $? -ne 0 ];
-        then
-          terminate 11
-        fi
         PAX_INPUT_FILENAME=${G4PATCH_FILENAME}
-
-    # Some configurations do not require Patch (or are not yet implemented)
     else
         PAX_INPUT_FILENAME=${G4_FILENAME}
     fi
 else
-    # nSort Stage
-    NSORTEXEC=${RELEASEDIR}/nSort
-    ln -sf ${RELEASEDIR}/data
-    (time ${NSORTEXEC} -s 2 -i ${G4_FILENAME};) 2>&1 | tee ${G4NSORT_FILENAME}.log
-    if [ $? -ne 0 ];
-    then
-      terminate 12
-    fi
     PAX_INPUT_FILENAME=${G4NSORT_FILENAME}
 fi
 
@@ -290,6 +411,13 @@ HAX_FILENAME=${PAX_INPUT_FILENAME}_hax
 FAX_FILENAME=${FILENAME}_faxtruth
 LAX_FILENAME=${PAX_INPUT_FILENAME}_lax
 
+# Stage dependencies after Geant4:
+#   fax+pax (or fax, then pax)
+#   truth sorting     <- fax truth         (alongside pax, or hax)
+#   hax ROOT          <- pax output
+#   lax               <- ROOT minitrees    (alongside the minitree conversion)
+#   minitree formats  <- ROOT minitrees
+
 # fax+pax stages
 source deactivate
 source activate pax_${FAXVERSION}
@@ -299,23 +427,48 @@ then
     export LD_LIBRARY_PATH=$PAX_LIB_DIR:$LD_LIBRARY_PATH
 fi
 
+# warm Python worker for the Python stages below (see stage_worker.py): their imports are done once
+STAGE_WORKER=${CVMFSDIR}/releases/processing/montecarlo/fax_waveform/stage_worker.py
+if [ -f ${STAGE_WORKER} ]; then
+    # in the work directory of the job, removed at its end
+    export STAGE_WORKER_SOCKET=${work_dir}/stage_worker.sock
+    python ${STAGE_WORKER} serve ${STAGE_WORKER_SOCKET} &> /dev/null &
+    PYTHON_STAGE="python ${STAGE_WORKER} run"
+else
+    PYTHON_STAGE=python
+fi
+
+# Flatten fax truth info
+FAXSORT_FILENAME=${FAX_FILENAME}_sort
+FAXSORT_OUTPUT_FORMAT=2 # Pickle + ROOT
+function truth_sorting {
+    run_stage truth_sorting ${PYTHON_STAGE} ${CVMFSDIR}/releases/processing/montecarlo/fax_waveform/TruthSorting_arrays.py ${FAX_FILENAME}.csv ${FAXSORT_FILENAME} ${FAXSORT_OUTPUT_FORMAT} 2>&1 | tee ${FAXSORT_FILENAME}.log &&
+    rm ${FAX_FILENAME}.*  # Peak-by-peak file with all photoionization info
+}
+
+# hax stage job: fax+pax were run by the fax_pax job
+if [[ ${STAGES} == hax ]]; then
+    :
+
 # Do not save raw waveforms
-if [[ ${SAVE_RAW} == 0 && ${PAXVERSION} == ${FAXVERSION} ]]; then
-    (time paxer --input ${PAX_INPUT_FILENAME}.root --config_string "[WaveformSimulator]truth_file_name=\"${FAX_FILENAME}\"" --config XENON1T SimulationMCInput --output ${PAX_FILENAME};) 2>&1 | tee ${PAX_FILENAME}.log
+elif [[ ${SAVE_RAW} == 0 && ${PAXVERSION} == ${FAXVERSION} ]]; then
+    run_stage fax_pax paxer --input ${PAX_INPUT_FILENAME}.root --config_string "[WaveformSimulator]truth_file_name=\"${FAX_FILENAME}\"" --config XENON1T SimulationMCInput --output ${PAX_FILENAME} 2>&1 | tee ${PAX_FILENAME}.log
 
     if [ $? -ne 0 ];
     then
 	terminate 13
     fi
+    start_stage 16 truth_sorting
 
 # Save raw waveforms or different fax/pax versions
 else
-    (time paxer --input ${PAX_INPUT_FILENAME}.root --config_string "[WaveformSimulator]truth_file_name=\"${FAX_FILENAME}\"" --config XENON1T reduce_raw_data SimulationMCInput --output ${RAW_FILENAME};) 2>&1 | tee ${RAW_FILENAME}.log
+    run_stage fax paxer --input ${PAX_INPUT_FILENAME}.root --config_string "[WaveformSimulator]truth_file_name=\"${FAX_FILENAME}\"" --config XENON1T reduce_raw_data SimulationMCInput --output ${RAW_FILENAME} 2>&1 | tee ${RAW_FILENAME}.log
 
     if [ $? -ne 0 ];
     then
 	terminate 14
     fi
+    start_stage 16 truth_sorting
 
     if [[ ${PAXVERSION} != ${FAXVERSION} ]];
     then
@@ -328,7 +481,7 @@ else
 
     fi
 
-    (time paxer --ignore_rundb --input ${RAW_FILENAME} --config XENON1T --output ${PAX_FILENAME};) 2>&1 | tee ${PAX_FILENAME}.log
+    run_stage pax paxer --ignore_rundb --input ${RAW_FILENAME} --config XENON1T --output ${PAX_FILENAME} 2>&1 | tee ${PAX_FILENAME}.log
 
     if [ $? -ne 0 ];
     then
@@ -340,6 +493,12 @@ else
     fi
 fi
 
+# fax_pax stage job: its products are passed to the hax job
+if [[ ${STAGES} == fax_pax ]]; then
+    wait_stage truth_sorting
+    terminate 0
+fi
+
 source activate pax_${FAXVERSION}
 # make sure libopcodes is in the LD_LIBRARY_PATH
 if [[ ! `/bin/env` =~ .*${PAX_LIB_DIR}.* ]];
@@ -347,44 +506,39 @@ then
     export LD_LIBRARY_PATH=$PAX_LIB_DIR:$LD_LIBRARY_PATH
 fi
 
-# Flatten fax truth info
-FAXSORT_FILENAME=${FAX_FILENAME}_sort
-FAXSORT_OUTPUT_FORMAT=2 # Pickle + ROOT
-(time python ${CVMFSDIR}/releases/processing/montecarlo/fax_waveform/TruthSorting_arrays.py ${FAX_FILENAME}.csv ${FAXSORT_FILENAME} ${FAXSORT_OUTPUT_FORMAT};) 2>&1 | tee ${FAXSORT_FILENAME}.log
-if [ $? -ne 0 ];
-then
-    terminate 16
-fi
-rm ${FAX_FILENAME}.*  # Peak-by-peak file with all photoionization info
-
-
 # hax stage
 HAX_TREEMAKERS="Basics Fundamentals DoubleScatter LargestPeakProperties TotalProperties Extended"
 
 # ROOT output
-(time haxer --main_data_paths ${OUTDIR} --input ${PAX_FILENAME##*/} --pax_version_policy loose --treemakers ${HAX_TREEMAKERS} --force_reload;) 2>&1 | tee ${HAX_FILENAME}.log
+run_stage hax_root ${PYTHON_STAGE} `which haxer` --main_data_paths ${OUTDIR} --input ${PAX_FILENAME##*/} --pax_version_policy loose --treemakers ${HAX_TREEMAKERS} --force_reload 2>&1 | tee ${HAX_FILENAME}.log
 if [ $? -ne 0 ];
 then
   terminate 17
 fi
+cp *.root ${OUTDIR}
+
+# lax stage
+function lax {
+    run_stage lax ${PYTHON_STAGE} `which laxer` --run_number -1 --pax_version ${PAXVERSION#"v"} --minitree_path ${OUTDIR} --filename ${PAX_FILENAME##*/} --output_path ${LAX_FILENAME} 2>&1 | tee ${LAX_FILENAME}.log
+}
+start_stage 19 lax
 
-# Pickle output
-(time haxer --main_data_paths ${OUTDIR} --input ${PAX_FILENAME##*/} --pax_version_policy loose --treemakers ${HAX_TREEMAKERS} --force_reload --preferred_minitree_format pklz;) 2>&1 | tee -a ${HAX_FILENAME}.log
+# Other formats (comma-separated: pklz, hdf5, parquet), converted from the ROOT
+# minitrees instead of a second haxer pass over the pax output
+MINITREE_FORMATS=pklz
+run_stage minitree_formats ${PYTHON_STAGE} ${CVMFSDIR}/releases/processing/montecarlo/fax_waveform/convert_minitrees.py . ${PAX_FILENAME##*/} ${MINITREE_FORMATS} ${HAX_TREEMAKERS} 2>&1 | tee -a ${HAX_FILENAME}.log
 if [ $? -ne 0 ];
 then
   terminate 18
 fi
 
 # Move hax output
-cp *.root *.pklz ${OUTDIR} 
+for format in ${MINITREE_FORMATS//,/ }; do
+    cp *.${format} ${OUTDIR}
+done
 
-# lax stage
-(time laxer --run_number -1 --pax_version ${PAXVERSION#"v"} --minitree_path ${OUTDIR} --filename ${PAX_FILENAME##*/} --output_path ${LAX_FILENAME};) 2>&1 | tee ${LAX_FILENAME}.log
-
-if [ $? -ne 0 ];
-then
-  terminate 19
-fi
+wait_stage truth_sorting
+wait_stage lax
 
 #rm ${PAX_FILENAME}.root  # Delete pax output for now
 
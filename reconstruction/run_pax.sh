@@ -6,6 +6,17 @@
 # arg3 -- name of output files separated by commas
 # arg4 -- pax configuration to use (allowed values given by 'paxer --help', or pass a .ini for custom config file)
 
+# run_stage <stage> <input file> <command> [<arg> ...]: run a stage, appending its wall/cpu
+# time, memory and I/O to ${metrics_file} (see montecarlo/fax_waveform/stage_metrics.py)
+function run_stage {
+    stage_metrics=/cvmfs/xenon.opensciencegrid.org/releases/processing/montecarlo/fax_waveform/stage_metrics.py
+    if [ -f ${stage_metrics} ]; then
+        python ${stage_metrics} run ${metrics_file} $1 $2 "${@:3}"
+    else
+        "${@:3}"
+    fi
+}
+
 which gfal-copy > /dev/null 2>&1
 if [[ $? -eq 1 ]];
 then
@@ -41,12 +52,14 @@ IFS=',' read -r -a output_files <<< "$3"
 IFS=',' read -r -a configs <<< "$4"
 
 mkdir ${start_dir}/results
+# resource usage of the stages, returned with the results
+metrics_file=${start_dir}/results/${output_files[0]}_metrics.jsonl
 # loop and use gfal-copy before pax gets loaded to avoid
 # gfal using wrong python version/libraries
 for index in "${!input_files[@]}";
 do
     input_filename=`echo ${input_files[index]} | rev | cut -f 1 -d/ | rev`
-    gfal-copy -n2 --cert ${start_dir}/user_cert ${input_files[index]} file://${work_dir}/$input_filename
+    run_stage stage_in ${input_filename} gfal-copy -n2 --cert ${start_dir}/user_cert ${input_files[index]} file://${work_dir}/$input_filename
 done
 
 # load python modules for paxer
@@ -64,7 +77,7 @@ do
     fi
 
     echo paxer --input $input_filename --output ${output_files[index]} --output_type root ${pax_config}
-    paxer --input $input_filename --output ${output_files[index]} --output_type root ${pax_config} --stop_after 2
+    run_stage pax ${input_filename} paxer --input $input_filename --output ${output_files[index]} --output_type root ${pax_config} --stop_after 2
 
 done
 cp *.root ${start_dir}/results